@@ -1,25 +1,176 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
-import faiss
-import pickle
-from sentence_transformers import SentenceTransformer
-from transformers import pipeline
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+from retrieval import QAEngine, QA_MODEL, load_index, load_metadata, load_embedder, load_qa
+from retrieval_profile import PROFILE, QA_SEARCH
+from answer_store import ANSWER_DB, AnswerStore
+from section_index import ITEM_TITLES, get_section, parse_section_request
+from qa_token_cache import load_token_cache
+from live_index import LiveIngestor
+import tracing
+from profiling import maybe_profile
+
+# Set QA_SERVER_URL to share one warm model set (scripts/qa_server.py) across sessions
+QA_SERVER_URL = os.environ.get("QA_SERVER_URL")
 
 st.set_page_config(page_title="SEC 10-K Q&A Agent", layout="wide")
 st.title("Financial file Q&A ")
 st.text("Ask any financial or business question about your chosen company!")
 
 # --- Load Models & Index ---
+# Each asset is its own cached resource, loaded on a single background worker
+# in priority order (index, metadata, embedder, QA model, warm-up), so the page
+# renders immediately and the first question doesn't pay the model warm-up.
+@st.cache_resource
+def loader_pool():
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="asset-loader")
+
+@st.cache_resource
+def index_future():
+    return loader_pool().submit(load_index)
+
+@st.cache_resource
+def metadata_future():
+    return loader_pool().submit(load_metadata)
+
+@st.cache_resource
+def embedder_future():
+    return loader_pool().submit(load_embedder)
+
+@st.cache_resource
+def qa_future():
+    index_f = index_future()
+    def load():
+        qa = load_qa()
+        return qa, load_token_cache(tokenizer_name=QA_MODEL, expected_count=index_f.result().ntotal)
+    return loader_pool().submit(load)
+
+@st.cache_resource
+def engine_future():
+    index_f, metadata_f, embedder_f, qa_f = index_future(), metadata_future(), embedder_future(), qa_future()
+    def build_and_warm_up():
+        qa, token_cache = qa_f.result()
+        engine = QAEngine(index_f.result(), metadata_f.result(), embedder_f.result(), qa, token_cache)
+        # One full query so lazy init (kernels, allocator, tokenizer caches) happens now
+        engine.answer("What was total revenue?", top_k=1)
+        return engine
+    return loader_pool().submit(build_and_warm_up)
+
+@st.cache_resource
+def live_ingestor():
+    # Owns the engine from here on: filings added in the app are swapped into `current`
+    ingestor = LiveIngestor(engine_future().result())
+    ingestor.restore()
+    return ingestor
+
 @st.cache_resource
-def load_assets():
-    index = faiss.read_index("faiss_index.bin")
-    with open("chunk_metadata.pkl", "rb") as f:
-        metadata = pickle.load(f)
-    embedder = SentenceTransformer('all-MiniLM-L6-v2')
-    qa = pipeline('question-answering', model='distilbert-base-cased-distilled-squad')
-    return index, metadata, embedder, qa
+def metrics_server():
+    # Prometheus endpoint for this Streamlit process, enabled with FDI_METRICS_PORT
+    return tracing.start_metrics_server() if tracing.METRICS_PORT else None
 
-index, metadata, embedder, qa = load_assets()
-companies = sorted(list(set(m['company'] for m in metadata)))
+LOAD_STAGES = [("Index", index_future), ("Metadata", metadata_future), ("Embedder", embedder_future),
+               ("QA model", qa_future), ("Warm-up", engine_future)]
+
+@st.cache_resource
+def open_answer_store():
+    return AnswerStore(ANSWER_DB)
+
+def answer_store():
+    # Precomputed answers to the canonical questions (scripts/answer_store.py), once they are materialized;
+    # a missing table is checked again on every call, not cached
+    return open_answer_store() if os.path.exists(ANSWER_DB) else None
+
+@st.cache_resource
+def server_client():
+    from qa_client import QAClient
+    return QAClient(QA_SERVER_URL)
+
+def engine_ready():
+    """True once the engine has loaded and warmed up; False while loading or if a stage failed."""
+    future = engine_future()
+    return future.done() and future.exception() is None
+
+def get_engine():
+    if QA_SERVER_URL:
+        return server_client()
+    future = engine_future()
+    if not future.done():
+        with st.spinner("Models are still loading..."):
+            future.exception()  # Waits without raising
+    if future.exception() is not None:
+        # The readiness panel names the stage that failed
+        st.error(f"Models failed to load: {future.exception()}")
+        st.stop()
+    # One snapshot per query: a filing swapped in mid-answer doesn't change it
+    return live_ingestor().current
+
+def show_readiness():
+    for name, stage in LOAD_STAGES:
+        future = stage()
+        if not future.done():
+            st.write(f"⏳ {name}")
+        elif future.exception():
+            st.error(f"{name} failed: {future.exception()}")
+        else:
+            st.write(f"✅ {name}")
+
+def show_ingest_jobs():
+    for job in reversed(live_ingestor().jobs[-5:]):
+        label = f"{job['ticker']} {job['accession']}: {job['status']}"
+        if job['status'] == 'failed':
+            st.error(f"{label} ({job['error']})")
+        elif job['status'] == 'ready':
+            st.write(f"✅ {label}, {job['chunks']} chunks")
+        else:
+            st.write(f"⏳ {label}")
+
+def add_filing_panel():
+    """Upload or register a 10-K; it is parsed, chunked, embedded and searchable without a restart."""
+    with st.expander("Add a filing"):
+        ticker = st.text_input("Ticker", key="ingest_ticker").strip().upper()
+        upload = st.file_uploader("10-K HTML (named <accession>.htm)", type=["htm", "html"], key="ingest_file")
+        url = st.text_input("...or EDGAR document URL", key="ingest_url").strip()
+        if st.button("Add filing", disabled=not ticker or not (upload or url)):
+            if upload:
+                live_ingestor().submit_upload(ticker, upload.name, upload.getvalue())
+            else:
+                live_ingestor().submit_register(ticker, url)
+        if live_ingestor().jobs:
+            busy = any(job['status'] not in ('ready', 'failed') for job in live_ingestor().jobs)
+            if hasattr(st, "fragment") and busy:
+                st.fragment(run_every=2)(show_ingest_jobs)()
+            else:
+                show_ingest_jobs()
+
+def show_latency_panel():
+    summary = tracing.latency_summary()
+    rows = [{'stage': name, 'calls': s['count'], 'p50 ms': round(s['p50_ms'], 1),
+             'p95 ms': round(s['p95_ms'], 1), 'errors': s['errors']}
+            for name, s in sorted(summary.items()) if name.startswith('query')]
+    if rows:
+        st.dataframe(rows, hide_index=True)
+    else:
+        st.caption("No queries yet.")
+
+metrics_server()
+if QA_SERVER_URL:
+    companies = server_client().companies()
+    years = server_client().years()
+else:
+    for _, stage in LOAD_STAGES:
+        stage()  # queue every stage now, in priority order
+    if engine_ready():
+        # Includes filings added while the app is running
+        companies, years = get_engine().companies(), get_engine().years()
+    elif metadata_future().done() and metadata_future().exception() is not None:
+        companies, years = [], []  # Shown as failed in the readiness panel
+    else:
+        companies = sorted(set(m['company'] for m in metadata_future().result()))
+        years = sorted(set(int(m.get('fiscal_year') or m['year']) for m in metadata_future().result()
+                           if m.get('fiscal_year') or m.get('year')))
 
 # --- Session state for chat ---
 if "chat_history" not in st.session_state:
@@ -35,6 +186,28 @@ with st.sidebar:
     if st.button("Restart Session (Clear Chat)"):
         st.session_state.chat_history = []
     st.session_state.selected_company = company
+    year_range = None
+    if len(years) > 1:
+        year_range = st.select_slider("Fiscal years", options=years, value=(years[0], years[-1]))
+        if year_range == (years[0], years[-1]):
+            year_range = None  # Full range: no restriction
+    item_options = ["All"] + [f"Item {key}. {title}" for key, title in ITEM_TITLES.items()]
+    item_choice = st.selectbox("10-K Item", item_options, help="Only search chunks from this section of the filings")
+    selected_item = None if item_choice == "All" else item_choice.split(".")[0].split()[1]
+    if not QA_SERVER_URL:
+        st.subheader("Readiness")
+        still_loading = not all(stage().done() for _, stage in LOAD_STAGES)
+        if hasattr(st, "fragment") and still_loading:
+            st.fragment(run_every=1)(show_readiness)()
+        else:
+            show_readiness()
+        if engine_ready():
+            add_filing_panel()
+    compare_mode = st.checkbox("Compare across filings",
+                               help="Answer for every company x fiscal year in the selection and show a table")
+    profile_queries = st.checkbox("Profile questions", help="Write cProfile, flamegraph and allocation files per question to profiles/")
+    st.subheader("Latency breakdown")
+    show_latency_panel()
 
 # --- Chat Interface (streamlit 1.23+ supports st.chat_message and st.chat_input) ---
 for role, message in st.session_state.chat_history:
@@ -43,57 +216,105 @@ for role, message in st.session_state.chat_history:
 
 user_input = st.chat_input("Ask a financial question...")
 
-def search_chunks(question, top_k=5, company=None):
-    q_emb = embedder.encode([question])
-    D, I = index.search(q_emb, 20)
-    results = []
-    count = 0
-    for idx in I[0]:
-        meta = metadata[idx]
-        if company and meta['company'].lower() != company.lower():
-            continue
-        if meta.get('type') == 'table':
-            continue
-        if len(meta['text'].split()) < 10:
-            continue
-        results.append({'text': meta['text'], 'meta': meta})
-        count += 1
-        if count >= top_k:
-            break
-    return results
-
-def answer_question(question, company=None):
-    chunks = search_chunks(question, top_k=5, company=company)
-    if not chunks:
+def search_chunks(question, top_k=None, company=None, years=None):
+    # top_k/candidates/min_words default to the tuned profile (tune_retrieval.py)
+    return get_engine().search(question, top_k=top_k, company=company, years=years, **QA_SEARCH)
+
+def answer_events(question, company=None, years=None, item=None):
+    """A precomputed answer as one 'done' event, else the engine's streamed sources and interim answers."""
+    engine = get_engine()
+    if not QA_SERVER_URL and answer_store() is not None and not item:
+        served = answer_store().lookup(engine, question, company, years)
+        if served is not None:
+            yield {'type': 'done', 'best': served[0], 'answers': served[1]}
+            return
+    yield from engine.answer_stream(question, company=company, years=years, item=item, **QA_SEARCH, **PROFILE['qa'])
+
+def answer_question(question, company=None, years=None, item=None):
+    """
+    Render into the current chat message as results arrive: the sources as
+    soon as retrieval returns, the best answer so far after each QA pass,
+    then the final answer. A rerun (new question, widget change) stops the
+    script, which closes the generator and skips the remaining QA passes.
+    """
+    sources, status = st.empty(), st.empty()
+    best = None
+    for event in answer_events(question, company=company, years=years, item=item):
+        if event['type'] == 'sources' and event['chunks']:
+            sources.markdown("**Sources:** " + "; ".join(f"{c['meta'].get('company')} FY{c['meta'].get('year')} "
+                                                        f"{c['meta'].get('section') or ''}".strip()
+                                                        for c in event['chunks']))
+        elif event['type'] == 'answer':
+            status.markdown(f"**Answer so far:** {event['best']['answer']}  (score: {event['best']['score']:.3f}) "
+                            f"· checking {event['done']}/{event['total']}")
+        elif event['type'] == 'done':
+            best = event['best']
+    sources.empty()
+    status.empty()
+    if not best:
         return "No relevant information found."
-    answers = []
-    for chunk in chunks:
-        ans = qa({'question': question, 'context': chunk['text']})
-        answers.append({
-            'answer': ans['answer'],
-            'score': ans['score'],
-            'context': chunk['text'],
-            'meta': chunk['meta']
-        })
-    answers = sorted(answers, key=lambda x: x['score'], reverse=True)
-    best = answers[0]
     meta = best['meta']
     result = f"**Answer:** {best['answer']}  (score: {best['score']:.3f})\n\n" \
              f"**Section:** {meta.get('section')} | **Subheading:** {meta.get('subheading')}\n\n" \
-             f"**Source:** {meta['company']} {meta['year']} | *File: {meta['filename']}*"
+             f"**Source:** {meta['company']} FY{meta['year']} | *File: {meta['filename']}*"
+    if best.get('duplicates'):
+        result += "\n\n*Same passage also in:* " + ", ".join(f"{d['company']} {d['year']}" for d in best['duplicates'])
+    if best.get('materialized'):
+        result += "\n\n*Precomputed answer*"
     with st.expander("Show Context"):
         st.markdown(best['context'][:700] + "...")
     return result
 
+def compare_answers(question, company=None, years=None, item=None):
+    """Markdown table of the best answer per fiscal year (rows) and company (columns)."""
+    year_list = list(range(years[0], years[1] + 1)) if years else None
+    rows = get_engine().compare(question, companies=[company] if company else None, years=year_list, top_k=3,
+                                candidates=PROFILE['qa']['candidates'], item=item, **QA_SEARCH)
+    columns = list(dict.fromkeys(row['company'] for row in rows))
+    table = {}
+    for row in rows:
+        best = row['best']
+        cell = f"{best['answer']} ({best['score']:.2f})".replace('|', ' ').replace('\n', ' ') if best else "-"
+        table.setdefault(row['year'], {})[row['company']] = cell
+    lines = ["| FY | " + " | ".join(columns) + " |", "|---" * (len(columns) + 1) + "|"]
+    for year, cells in table.items():
+        lines.append(f"| {year} | " + " | ".join(cells.get(c, "-") for c in columns) + " |")
+    return "\n".join(lines)
+
+def show_section(request, company=None, years=None):
+    """A directly requested section ("show me Item 7 for TSLA 2022"), read from the section index."""
+    company = request['company'] or company
+    year = request['year'] or (years[1] if years else None)
+    if not company:
+        return "Select a company or name one to read a section from (e.g. *show Item 7 for TSLA 2022*)."
+    found = get_section(company, request['item'], year)
+    if found is None:
+        return f"No Item {request['item']} found for {company} {year or '(latest filing)'}."
+    section, text = found
+    with st.expander(f"Item {section['item']}. {section['title']} ({len(text):,} characters)", expanded=True):
+        st.text(text)
+    return f"**Item {section['item']}. {section['title']}** | {company} {year or '(latest filing)'}"
+
 if user_input:
     with st.chat_message("user"):
         st.markdown(user_input)
     st.session_state.chat_history.append(("user", user_input))
 
-    # Get answer
+    # Get answer; single questions stream into the assistant message, comparisons wait for the whole table
     selected_company = None if st.session_state.selected_company == "All" else st.session_state.selected_company
-    with st.spinner("Searching and answering..."):
-        answer = answer_question(user_input, company=selected_company)
+    request = parse_section_request(user_input, companies)
     with st.chat_message("assistant"):
+        with maybe_profile(profile_queries, 'query', user_input) as profile_prefix, \
+                tracing.span('query', company=selected_company, years=year_range):
+            if request:
+                answer = show_section(request, company=selected_company, years=year_range)
+            elif compare_mode:
+                with st.spinner("Searching and answering..."):
+                    answer = compare_answers(user_input, company=selected_company, years=year_range,
+                                             item=selected_item)
+            else:
+                answer = answer_question(user_input, company=selected_company, years=year_range, item=selected_item)
         st.markdown(answer)
+    if profile_prefix:
+        st.caption(f"Profile saved to {profile_prefix}.prof / .folded / .alloc.txt")
     st.session_state.chat_history.append(("assistant", answer))
@@ -0,0 +1,253 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+
+from retrieval import QA_MODEL, filing_year
+from retrieval_profile import PROFILE, QA_SEARCH
+from tracing import span, count
+
+# ----------------- CONFIGURATION -----------------
+ANSWER_DB = 'data/answers.sqlite'
+QUESTIONS_PATH = 'data/canonical_questions.json'  # [{"id", "question", "aliases"}]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS questions (
+    norm TEXT PRIMARY KEY,          -- normalized wording (question or alias)
+    question_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS slices (
+    company TEXT NOT NULL,
+    fiscal_year INTEGER NOT NULL,
+    chunks_hash TEXT NOT NULL,      -- chunk texts + QA model + retrieval settings the answers were computed from
+    materialized_at REAL NOT NULL,
+    PRIMARY KEY (company, fiscal_year)
+);
+CREATE TABLE IF NOT EXISTS answers (
+    question_id TEXT NOT NULL,
+    company TEXT NOT NULL,
+    fiscal_year INTEGER NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT,                    -- NULL when no chunk survived retrieval
+    score REAL,
+    start_char INTEGER,             -- answer offsets into context
+    end_char INTEGER,
+    context TEXT,
+    meta TEXT,                      -- JSON chunk metadata: filename, chunk_id, section, accession, ...
+    duplicates TEXT,
+    answers TEXT,                   -- JSON list of the slice's other candidate answers
+    qa_model TEXT NOT NULL,
+    chunks_hash TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (question_id, company, fiscal_year)
+);
+"""
+
+def normalize(question):
+    """Lower-case words only, so 'What was total revenue?' and 'what was total  revenue' match."""
+    return ' '.join(re.findall(r"[a-z0-9&%$]+", question.lower()))
+
+def load_questions(path=QUESTIONS_PATH):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def settings():
+    """Retrieval used when materializing: the live QA settings (QA_SEARCH) plus the tuned profile."""
+    return dict(PROFILE['qa'], **QA_SEARCH)
+
+def slice_hashes(metadata, search_settings=None):
+    """{(company, fiscal year): hash of its chunk texts, the QA model and the retrieval settings}."""
+    header = json.dumps([QA_MODEL, search_settings or settings()], sort_keys=True).encode('utf-8')
+    hashes = {}
+    for meta in metadata:
+        year = filing_year(meta)
+        if year is None:
+            continue  # Can't be addressed by a fiscal-year filter, so never materialized
+        key = (meta['company'], year)
+        if key not in hashes:
+            hashes[key] = hashlib.sha1(header)
+        hashes[key].update(meta['text'].encode('utf-8'))
+        hashes[key].update(b'\0')
+    return {key: h.hexdigest() for key, h in hashes.items()}
+
+def connect(db_path=ANSWER_DB):
+    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+    con = sqlite3.connect(db_path)
+    con.executescript(SCHEMA)
+    return con
+
+# ----------------- MATERIALIZATION -----------------
+
+def materialize(engine, questions=None, db_path=ANSWER_DB, force=False):
+    """
+    Answer every catalog question for each company/fiscal-year slice whose
+    chunks changed since it was last materialized (all slices with `force`).
+    Each question is asked of all stale slices in one batched search + QA
+    call, and the table is updated in one transaction. Returns the slices redone.
+    """
+    questions = load_questions() if questions is None else questions
+    search_settings = settings()
+    current = slice_hashes(engine.metadata, search_settings)
+    con = connect(db_path)
+    try:
+        stored = {(c, y): h for c, y, h in con.execute("SELECT company, fiscal_year, chunks_hash FROM slices")}
+        have = set(con.execute("SELECT question_id, question, company, fiscal_year FROM answers"))
+        # Redo slices whose chunks changed, and slices missing a catalog question (added or reworded)
+        stale = sorted(s for s, h in current.items()
+                       if force or stored.get(s) != h or any((q['id'], q['question']) + s not in have for q in questions))
+        gone = [s for s in stored if s not in current]
+        now = time.time()
+        rows = []
+        with span('materialize', items=len(stale) * len(questions)):
+            for q in questions if stale else []:
+                hits = engine.search_batch([q['question']] * len(stale), companies=[c for c, _ in stale],
+                                           years=[(y, y) for _, y in stale], **search_settings)
+                answers = engine.answer_batch([q['question']] * len(stale), hits)
+                for (company, year), ans in zip(stale, answers):
+                    best = ans[0] if ans else {}
+                    rows.append((q['id'], company, year, q['question'], best.get('answer'), best.get('score'),
+                                 best.get('start'), best.get('end'), best.get('context'),
+                                 json.dumps(best.get('meta')), json.dumps(best.get('duplicates', [])),
+                                 json.dumps([_candidate(a) for a in ans[1:]]),
+                                 QA_MODEL, current[(company, year)], now))
+        with con:
+            con.execute("DELETE FROM questions")
+            con.executemany("INSERT OR REPLACE INTO questions VALUES (?, ?)",
+                            [(normalize(text), q['id']) for q in questions for text in [q['question']] + q.get('aliases', [])])
+            ids = [q['id'] for q in questions]
+            con.execute(f"DELETE FROM answers WHERE question_id NOT IN ({','.join('?' * len(ids))})", ids)
+            for company, year in stale + gone:
+                con.execute("DELETE FROM answers WHERE company = ? AND fiscal_year = ?", (company, year))
+                con.execute("DELETE FROM slices WHERE company = ? AND fiscal_year = ?", (company, year))
+            con.executemany("INSERT INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            con.executemany("INSERT INTO slices VALUES (?, ?, ?, ?)", [(c, y, current[(c, y)], now) for c, y in stale])
+    finally:
+        con.close()
+    count('answers.materialized', len(rows))
+    return stale
+
+def _candidate(ans):
+    return {k: ans[k] for k in ('answer', 'score', 'start', 'end', 'context', 'meta', 'duplicates')}
+
+# ----------------- LOOKUP -----------------
+
+class AnswerStore:
+    """
+    Read side of the answer table. A question is served only if it is in the
+    catalog, the query's company/year scope is exactly one slice, and that
+    slice was materialized from the engine's current chunks; otherwise
+    lookup() returns None and the caller runs the normal search + QA path.
+    """
+
+    def __init__(self, db_path=ANSWER_DB):
+        self.con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._current = (None, None, None)  # (metadata object, its slice hashes, companies with yearless chunks)
+        self._parsed = {}             # question_id -> parsed rows, until the table is written again
+        self._version = None
+
+    @classmethod
+    def open(cls, db_path=ANSWER_DB):
+        return cls(db_path) if os.path.exists(db_path) else None
+
+    def current_slices(self, engine):
+        """
+        (slice hashes, lower-cased companies with chunks that have no fiscal
+        year) of the engine's chunks; computed once per engine snapshot.
+        """
+        metadata, current, yearless = self._current
+        if metadata is not engine.metadata:
+            metadata, current = engine.metadata, slice_hashes(engine.metadata)
+            yearless = {m['company'].lower() for m in metadata if filing_year(m) is None}
+            self._current = (metadata, current, yearless)
+        return current, yearless
+
+    def scope_slice(self, engine, company=None, years=None):
+        """
+        The one slice whose chunks are exactly what a live search with this
+        company/year filter would search, or None. Materialized answers are a
+        top-k within one slice, which is only the live answer when the live
+        search covers that slice and nothing else.
+        """
+        current, yearless = self.current_slices(engine)
+        slices = [(c, y) for c, y in current
+                  if (not company or c.lower() == company.lower())
+                  and (not years or ((years[0] is None or y >= int(years[0])) and (years[1] is None or y <= int(years[1]))))]
+        if len(slices) != 1:
+            return None
+        if not years and (yearless if not company else company.lower() in yearless):
+            return None  # The live search would also cover chunks no fiscal-year slice holds
+        return slices[0]
+
+    def _rows(self, question):
+        """(question_id, [(company, year, chunks_hash, answers)]) for a catalog question, or None."""
+        with self._lock:
+            version = self.con.execute("PRAGMA data_version").fetchone()[0]  # Changes when materialize() commits
+            if version != self._version:
+                self._parsed, self._version = {}, version
+            row = self.con.execute("SELECT question_id FROM questions WHERE norm = ?", (normalize(question),)).fetchone()
+            if row is None:
+                return None
+            question_id = row[0]
+            if question_id not in self._parsed:
+                rows = self.con.execute(
+                    "SELECT company, fiscal_year, answer, score, start_char, end_char, context, meta, duplicates, "
+                    "answers, qa_model, chunks_hash, created FROM answers WHERE question_id = ?", (question_id,)).fetchall()
+                parsed = []
+                for company, year, answer, score, start, end, context, meta, dups, others, qa_model, chunks_hash, created in rows:
+                    provenance = {'question_id': question_id, 'qa_model': qa_model, 'chunks_hash': chunks_hash,
+                                  'created': created}
+                    answers = []
+                    if answer is not None:
+                        answers.append({'answer': answer, 'score': score, 'start': start, 'end': end, 'context': context,
+                                        'meta': json.loads(meta), 'duplicates': json.loads(dups),
+                                        'materialized': provenance})
+                        answers.extend(dict(a, materialized=provenance) for a in json.loads(others))
+                    parsed.append((company, year, chunks_hash, answers))
+                self._parsed[question_id] = parsed
+            return question_id, self._parsed[question_id]
+
+    def lookup(self, engine, question, company=None, years=None):
+        """(best, answers) like QAEngine.answer, from the table; None if it can't be served from it."""
+        key = self.scope_slice(engine, company, years)
+        if key is None:
+            return None
+        found = self._rows(question)
+        if found is None:
+            count('answers.misses')
+            return None
+        current, _ = self.current_slices(engine)
+        for company_, year, chunks_hash, answers in found[1]:
+            if (company_, year) == key and chunks_hash == current[key]:
+                count('answers.hits')
+                return (answers[0] if answers else None), answers
+        count('answers.stale')
+        return None  # Not yet re-materialized since the slice's chunks changed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute answers to the canonical question catalog for every filing.")
+    parser.add_argument('--questions', type=str, default=QUESTIONS_PATH)
+    parser.add_argument('--db', type=str, default=ANSWER_DB)
+    parser.add_argument('--force', action='store_true', help="Recompute every slice, not only those whose chunks changed")
+    parser.add_argument('--two_stage', nargs='?', const='index_coarse', default=None, metavar='COARSE_DIR',
+                        help="Materialize through the coarse-to-fine search (as the CLIs would serve it)")
+    parser.add_argument('--tiny', action='store_true', help="Use hashing/overlap stand-in models (no downloads)")
+    args = parser.parse_args()
+
+    if args.tiny:
+        from benchmark_queries import build_tiny_engine
+        engine = build_tiny_engine()
+    else:
+        from retrieval import QAEngine, INDEX_PATH, META_PATH
+        engine = QAEngine.load(INDEX_PATH, META_PATH, coarse_dir=args.two_stage)
+    questions = load_questions(args.questions)
+    start = time.perf_counter()
+    redone = materialize(engine, questions, args.db, force=args.force)
+    print(f"Materialized {len(questions)} questions for {len(redone)} company/year slices "
+          f"in {time.perf_counter() - start:.1f}s -> {args.db}")
+    for company, year in redone:
+        print(f"  {company} FY{year}")
@@ -0,0 +1,115 @@
+import time
+import random
+import argparse
+import numpy as np
+
+from retrieval import INDEX_PATH, META_PATH, EMBED_MODEL, QA_MODEL, load_index, load_metadata
+from inference_backends import BACKENDS, load_embedder, load_qa
+
+# Questions used to compare retrieval rankings and QA answers across backends
+QUESTIONS = [
+    "What was the total net sales?",
+    "What are the main risk factors?",
+    "How much was spent on research and development?",
+    "What was net income for the year?",
+    "How many full-time employees does the company have?",
+    "What are the company's reportable segments?",
+    "How much cash and cash equivalents does the company hold?",
+    "What was the gross margin percentage?",
+    "Who is the independent registered public accounting firm?",
+    "What are the company's main products?",
+]
+
+def time_calls(fn, items, batch_size, repeats=1):
+    """Run fn over items in batches; return (per-item latency ms, items/sec)."""
+    fn(items[:batch_size])  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for i in range(0, len(items), batch_size):
+            fn(items[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+    n = len(items) * repeats
+    return 1000 * elapsed / n, n / elapsed
+
+def bench_embedder(backend, texts, questions, index, k, baseline):
+    embedder = load_embedder(EMBED_MODEL, backend)
+    encode = lambda batch: embedder.encode(batch, convert_to_numpy=True)
+    single_ms, _ = time_calls(encode, questions, batch_size=1, repeats=3)
+    batch_ms, throughput = time_calls(encode, texts, batch_size=32)
+    q_embs = np.asarray(encode(questions), dtype='float32')
+    _, I = index.search(q_embs, k)
+    row = {'backend': backend, 'query_ms': single_ms, 'batch_ms_per_text': batch_ms,
+           'texts_per_sec': throughput, 'ids': I, 'embs': q_embs}
+    if baseline:
+        # Ranking drift: overlap of top-k ids and mean cosine of query embeddings vs fp32
+        overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(I, baseline['ids'])])
+        top1 = np.mean(I[:, 0] == baseline['ids'][:, 0])
+        a = q_embs / np.linalg.norm(q_embs, axis=1, keepdims=True)
+        b = baseline['embs'] / np.linalg.norm(baseline['embs'], axis=1, keepdims=True)
+        row.update({'topk_overlap': overlap, 'top1_agree': top1, 'cosine': float(np.mean((a * b).sum(axis=1)))})
+    return row
+
+def bench_qa(backend, pairs, baseline):
+    qa = load_qa(QA_MODEL, backend)
+    run = lambda batch: qa([{'question': q, 'context': c} for q, c in batch], batch_size=len(batch))
+    single_ms, _ = time_calls(run, pairs, batch_size=1)
+    batch_ms, throughput = time_calls(run, pairs, batch_size=8)
+    outputs = run(pairs)
+    outputs = [outputs] if isinstance(outputs, dict) else outputs
+    row = {'backend': backend, 'qa_ms': single_ms, 'batch_ms_per_pair': batch_ms,
+           'pairs_per_sec': throughput, 'outputs': outputs}
+    if baseline:
+        same = [o['answer'].strip() == b['answer'].strip() for o, b in zip(outputs, baseline['outputs'])]
+        diff = [abs(o['score'] - b['score']) for o, b in zip(outputs, baseline['outputs'])]
+        row.update({'answer_agree': float(np.mean(same)), 'score_abs_diff': float(np.mean(diff))})
+    return row
+
+def print_table(rows, columns):
+    print("  ".join(f"{c:>18}" for c in columns))
+    for row in rows:
+        cells = []
+        for c in columns:
+            v = row.get(c, '-')
+            cells.append(f"{v:>18.3f}" if isinstance(v, float) else f"{str(v):>18}")
+        print("  ".join(cells))
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fp32, int8 and ONNX inference backends.")
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument('--n_texts', type=int, default=512, help="Chunk texts used for embedding throughput")
+    parser.add_argument('--k', type=int, default=10, help="Top-k used for ranking overlap")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    index = load_index(INDEX_PATH)
+    metadata = load_metadata(META_PATH)
+    rng = random.Random(args.seed)
+    texts = [m['text'] for m in rng.sample(metadata, min(args.n_texts, len(metadata)))]
+    backends = ['fp32'] + [b for b in args.backends if b != 'fp32']
+
+    embed_rows, base = [], None
+    for backend in backends:
+        row = bench_embedder(backend, texts, QUESTIONS, index, args.k, base)
+        base = base or row
+        embed_rows.append(row)
+
+    # QA pairs: each question against its top fp32 chunk, so every backend sees identical input
+    pairs = [(q, metadata[ids[0]]['text']) for q, ids in zip(QUESTIONS, embed_rows[0]['ids'])]
+    qa_rows, base = [], None
+    for backend in backends:
+        row = bench_qa(backend, pairs, base)
+        base = base or row
+        qa_rows.append(row)
+
+    print("\nEmbedder (all-MiniLM-L6-v2)")
+    print_table(embed_rows, ['backend', 'query_ms', 'batch_ms_per_text', 'texts_per_sec',
+                             'topk_overlap', 'top1_agree', 'cosine'])
+    print("\nQA (distilbert-base-cased-distilled-squad)")
+    print_table(qa_rows, ['backend', 'qa_ms', 'batch_ms_per_pair', 'pairs_per_sec',
+                          'answer_agree', 'score_abs_diff'])
+    for rows, key in ((embed_rows, 'query_ms'), (qa_rows, 'qa_ms')):
+        for row in rows[1:]:
+            print(f"{row['backend']}: {rows[0][key] / row[key]:.2f}x {key} speed-up vs fp32")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import os
+# Never reach for the network: use locally cached models (or --tiny stand-ins)
+os.environ.setdefault('HF_HUB_OFFLINE', '1')
+os.environ.setdefault('TRANSFORMERS_OFFLINE', '1')
+
+import re
+import json
+import atexit
+import shutil
+import time
+import hashlib
+import argparse
+import resource
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from retrieval import QAEngine, INDEX_PATH, META_PATH
+
+QUESTIONS_PATH = "data/eval/questions.json"
+STAGES = ['encode', 'search', 'filter', 'qa', 'summarize']
+
+# ----------------- TINY STAND-IN MODELS -----------------
+
+class HashingEmbedder:
+    """Bag-of-words feature hashing; stands in for the sentence embedder with no model download."""
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def encode(self, sentences, **kwargs):
+        out = np.zeros((len(sentences), self.dim), dtype=np.float32)
+        for i, text in enumerate(sentences):
+            for word in re.findall(r"\w+", text.lower()):
+                h = int(hashlib.md5(word.encode('utf-8')).hexdigest()[:8], 16)
+                out[i, h % self.dim] += 1.0
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return out / np.clip(norms, 1e-12, None)
+
+class OverlapQA:
+    """Returns the context sentence with the most question-word overlap; mimics the QA pipeline's output."""
+
+    def __call__(self, inputs, **kwargs):
+        single = isinstance(inputs, dict)
+        outputs = [self._answer(x['question'], x['context']) for x in ([inputs] if single else inputs)]
+        return outputs[0] if single else outputs
+
+    @staticmethod
+    def _answer(question, context):
+        q_words = set(re.findall(r"\w+", question.lower()))
+        best = (0.0, 0, len(context))
+        for m in re.finditer(r"[^.]+\.?", context):
+            words = set(re.findall(r"\w+", m.group().lower()))
+            score = len(q_words & words) / (len(q_words) or 1)
+            if score > best[0]:
+                best = (score, m.start(), m.end())
+        score, start, end = best
+        return {'answer': context[start:end].strip(), 'score': score, 'start': start, 'end': end}
+
+def build_tiny_engine():
+    """Index every chunk with the hashing embedder in a temporary memory-mapped index."""
+    from embed_chunks import CHUNKS_DIR, load_chunks
+    from index_store import MemmapFlatIndex, write_memmap_index
+    texts, metadata = load_chunks(CHUNKS_DIR)
+    embedder = HashingEmbedder()
+    index_dir = tempfile.mkdtemp(prefix="bench_index_")
+    atexit.register(shutil.rmtree, index_dir, ignore_errors=True)
+    write_memmap_index(embedder.encode(texts), index_dir)
+    return QAEngine(MemmapFlatIndex(index_dir), metadata, embedder, OverlapQA())
+
+# ----------------- MEASUREMENT -----------------
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 if os.uname().sysname == 'Linux' else rss / (1024 * 1024)  # KB on Linux, bytes on macOS
+
+def run_query(engine, item, args, summarizer=None):
+    """One question end to end; returns (per-stage seconds, total seconds, best answer, chunks)."""
+    timings = {}
+    start = time.perf_counter()
+    chunks = engine.search(item['question'], top_k=args.top_k, company=item.get('company'),
+                           candidates=args.candidates, diversify=args.diversify, timings=timings)
+    best = None
+    if chunks:
+        best = engine.answer_batch([item['question']], [chunks], timings=timings)[0][0]
+        if summarizer is not None:
+            from summarize import map_reduce_summarize
+            t = time.perf_counter()
+            map_reduce_summarize(item['question'], [c['text'] for c in chunks], summarizer)
+            timings['summarize'] = time.perf_counter() - t
+    return timings, time.perf_counter() - start, best, chunks
+
+def is_hit(item, chunks):
+    relevant = {(r['filename'], r['chunk_id']) for r in item.get('relevant', [])}
+    return any((c['meta']['filename'], c['meta']['chunk_id']) in relevant for c in chunks)
+
+def is_correct(item, best):
+    if not best:
+        return False
+    return any(a.lower() in best['answer'].lower() for a in item.get('answers', []))
+
+def percentiles(values):
+    if not values:
+        return {'p50': float('nan'), 'p95': float('nan'), 'p99': float('nan')}
+    ms = np.asarray(values) * 1000
+    return {'p50': float(np.percentile(ms, 50)), 'p95': float(np.percentile(ms, 95)),
+            'p99': float(np.percentile(ms, 99))}
+
+def throughput(engine, questions, args, workers, summarizer=None):
+    jobs = questions * args.repeats
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda item: run_query(engine, item, args, summarizer), jobs))
+    return len(jobs) / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a labelled question set and report per-stage latency.")
+    parser.add_argument('--questions', type=str, default=QUESTIONS_PATH)
+    parser.add_argument('--repeats', type=int, default=5, help="Times the question set is replayed")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--top_k', type=int, default=5)
+    parser.add_argument('--candidates', type=int, default=20)
+    parser.add_argument('--diversify', action='store_true')
+    parser.add_argument('--summarizer', type=str, default=None, help="Also time map-reduce summarisation (e.g. distilbart)")
+    parser.add_argument('--tiny', action='store_true', help="Use hashing/overlap stand-in models (no downloads)")
+    parser.add_argument('--out', type=str, default=None, help="Write the report as JSON")
+    args = parser.parse_args()
+
+    with open(args.questions, encoding='utf-8') as f:
+        questions = json.load(f)
+
+    start = time.perf_counter()
+    engine = build_tiny_engine() if args.tiny else QAEngine.load(INDEX_PATH, META_PATH)
+    summarizer = None
+    if args.summarizer and not args.tiny:
+        from summarize import load_summarizer
+        summarizer = load_summarizer(args.summarizer)
+    load_s = time.perf_counter() - start
+    run_query(engine, questions[0], args, summarizer)  # warm-up, not measured
+
+    stage_times = {stage: [] for stage in STAGES}
+    totals, hits, correct = [], 0, 0
+    for rep in range(args.repeats):
+        for item in questions:
+            timings, total, best, chunks = run_query(engine, item, args, summarizer)
+            for stage in STAGES:
+                if stage in timings:
+                    stage_times[stage].append(timings[stage])
+            totals.append(total)
+            if rep == 0:
+                hits += is_hit(item, chunks)
+                correct += is_correct(item, best)
+
+    report = {
+        'mode': 'tiny' if args.tiny else 'models',
+        'load_seconds': load_s,
+        'queries': len(totals),
+        'latency_ms': {stage: percentiles(v) for stage, v in stage_times.items() if v},
+        'hit_rate': hits / len(questions),
+        'answer_match_rate': correct / len(questions),
+    }
+    report['latency_ms']['total'] = percentiles(totals)
+    report['throughput_qps'] = {str(w): throughput(engine, questions, args, w, summarizer) for w in args.concurrency}
+    report['peak_rss_mb'] = peak_rss_mb()
+
+    print(f"\nLoaded in {load_s:.1f}s, {len(totals)} timed queries ({report['mode']})")
+    print(f"{'stage':>10}  {'p50 ms':>10}  {'p95 ms':>10}  {'p99 ms':>10}")
+    for stage, p in report['latency_ms'].items():
+        print(f"{stage:>10}  {p['p50']:>10.2f}  {p['p95']:>10.2f}  {p['p99']:>10.2f}")
+    print("\nThroughput:")
+    for workers, qps in report['throughput_qps'].items():
+        print(f"  concurrency {workers:>2}: {qps:.2f} queries/s")
+    print(f"\nRetrieval hit rate (labelled chunk in top-{args.top_k}): {report['hit_rate']:.2%}")
+    print(f"Answer match rate: {report['answer_match_rate']:.2%}")
+    print(f"Peak RSS: {report['peak_rss_mb']:.0f} MB")
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
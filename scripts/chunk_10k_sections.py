@@ -3,6 +3,12 @@ import re
 import json
 import argparse
 
+from tracing import span
+from profiling import maybe_profile
+from filing_catalog import chunk_fields, load_catalog, resolve
+from retrieval_profile import PROFILE
+from section_index import load_sections, section_at
+
 def is_heading(line):
     if re.match(r'^(PART\s+[IVXLC]+|ITEM\s+\d+[A-Z]?\.?.*)$', line, re.IGNORECASE):
         return True
@@ -81,8 +87,13 @@ def chunk_txt_file_section_based(input_path, company=None, year=None, min_chunk_
 
 
 def chunk_txt_file_fine(input_path, company=None, year=None, max_paragraph_len=800, min_chunk_words=8):
+    """Fine chunks of one processed text file; 'start'/'end' are the byte range of each chunk's lines in it."""
     with open(input_path, 'r', encoding='utf-8') as f:
         lines = [l.rstrip('\n') for l in f.readlines()]
+    # Byte offset of each line in the file (one newline per line)
+    offsets = [0]
+    for l in lines:
+        offsets.append(offsets[-1] + len(l.encode('utf-8')) + 1)
 
     chunks = []
     chunk_counter = 1
@@ -95,8 +106,8 @@ def chunk_txt_file_fine(input_path, company=None, year=None, max_paragraph_len=8
         "section": None,
         "subheading": None,
         "type": "info",
-        "start": 0,
-        "end": len(info_text),
+        "start": None,  # Not part of the text file
+        "end": None,
         "company": company,
         "year": year
     })
@@ -105,20 +116,23 @@ def chunk_txt_file_fine(input_path, company=None, year=None, max_paragraph_len=8
     parent_section = None
     current_subheading = None
     last_heading = None
+    heading_idx = None
     buffer = []
-    char_cursor = len(info_text) + 1  # Account for info chunk
+    buffer_idx = []  # Line numbers of the buffered lines
     current_type = "paragraph"
 
     def flush_chunk():
-        nonlocal buffer, parent_section, current_subheading, last_heading, chunk_counter, char_cursor
+        nonlocal buffer, parent_section, current_subheading, last_heading, heading_idx, chunk_counter
         if buffer:
             content = "\n".join(buffer).strip()
+            first = buffer_idx[0]
             if last_heading:
                 content = f"{last_heading}\n{content}"
+                first = heading_idx
                 last_heading = None
             if content and len(content.split()) >= min_chunk_words:
-                start = char_cursor
-                end = start + len(content)
+                start = offsets[first]
+                end = offsets[buffer_idx[-1] + 1] - 1
                 chunks.append({
                     "chunk_id": chunk_counter,
                     "text": content,
@@ -131,9 +145,9 @@ def chunk_txt_file_fine(input_path, company=None, year=None, max_paragraph_len=8
                     "year": year
                 })
                 chunk_counter += 1
-                char_cursor = end + 1
         buffer.clear()
-        
+        buffer_idx.clear()
+
 
     idx = 0
     while idx < len(lines):
@@ -142,7 +156,6 @@ def chunk_txt_file_fine(input_path, company=None, year=None, max_paragraph_len=8
         if not line_strip:
             if buffer and len("\n".join(buffer)) > max_paragraph_len:
                 flush_chunk()
-            char_cursor += len(line) + 1
             idx += 1
             continue
 
@@ -154,6 +167,7 @@ def chunk_txt_file_fine(input_path, company=None, year=None, max_paragraph_len=8
             else:
                 current_subheading = line_strip
             last_heading = line_strip
+            heading_idx = idx
             idx += 1
             continue
 
@@ -171,8 +185,8 @@ def chunk_txt_file_fine(input_path, company=None, year=None, max_paragraph_len=8
                     break
             table_content = "\n".join(table_buffer).strip()
             if len(table_content.split()) >= min_chunk_words:
-                start = char_cursor
-                end = start + len(table_content)
+                start = offsets[idx]
+                end = offsets[next_idx] - 1
                 chunks.append({
                     "chunk_id": chunk_counter,
                     "text": table_content,
@@ -185,28 +199,54 @@ def chunk_txt_file_fine(input_path, company=None, year=None, max_paragraph_len=8
                     "year": year
                 })
                 chunk_counter += 1
-                char_cursor = end + 1
             idx = next_idx
             buffer.clear()
+            buffer_idx.clear()
             current_type = "paragraph"
             continue
 
         if current_type != "paragraph":
             flush_chunk()
         buffer.append(line_strip)
+        buffer_idx.append(idx)
         current_type = "paragraph"
         if len("\n".join(buffer)) > max_paragraph_len:
             flush_chunk()
-        char_cursor += len(line) + 1
         idx += 1
 
     flush_chunk()
     return chunks
 
-def chunk_txt_dir_fine(txt_dir, output_dir):
+def chunk_file(input_path, out_json, company=None, filing=None, max_paragraph_len=None, min_chunk_words=None):
+    """
+    Fine-chunk one processed text file and write the chunks as JSON. `filing`
+    is its catalog record (filing_catalog.py): the fiscal year labels the
+    chunks and the CIK, accession and dates are carried on each one. Each
+    chunk also gets the ITEM/PART its byte range starts in (section_index.py).
+    Paragraph size and word cutoff default to the tuned profile.
+    """
+    year = filing.get('fiscal_year') if filing else None
+    tuned = PROFILE['chunking']
+    with span('chunk', file=input_path) as sp:
+        chunks = chunk_txt_file_fine(input_path, company=company, year=year,
+                                     max_paragraph_len=max_paragraph_len or tuned['max_paragraph_len'],
+                                     min_chunk_words=tuned['min_chunk_words'] if min_chunk_words is None else min_chunk_words)
+        fields = chunk_fields(filing)
+        sections = load_sections(input_path)
+        for chunk in chunks:
+            chunk.update(fields)
+            chunk.update(section_at(sections, chunk['start']))
+        os.makedirs(os.path.dirname(out_json), exist_ok=True)
+        with open(out_json, 'w', encoding='utf-8') as out:
+            json.dump(chunks, out, indent=2)
+        sp.update(items=len(chunks), bytes=os.path.getsize(input_path))
+    return chunks
+
+def chunk_txt_dir_fine(txt_dir, output_dir, profile=False):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    catalog = load_catalog()
     for company in os.listdir(txt_dir):
         company_dir = os.path.join(txt_dir, company)
         if not os.path.isdir(company_dir):
@@ -214,20 +254,17 @@ def chunk_txt_dir_fine(txt_dir, output_dir):
         for filename in os.listdir(company_dir):
             if filename.endswith('.txt'):
                 input_path = os.path.join(company_dir, filename)
-                # Extract year from filename (expects a 4-digit year in filename)
-                match = re.search(r'(20\d{2})', filename)
-                year = match.group(1) if match else None
-                chunks = chunk_txt_file_fine(input_path, company=company, year=year)
-                output_company_dir = os.path.join(output_dir, company)
-                os.makedirs(output_company_dir, exist_ok=True)
-                out_json = os.path.join(output_company_dir, filename.replace('.txt', '_fine_chunks.json'))
-                with open(out_json, 'w', encoding='utf-8') as out:
-                    json.dump(chunks, out, indent=2)
+                # Year and filing details come from the catalog, not the filename
+                filing = resolve(company, os.path.splitext(filename)[0], input_path, catalog)
+                out_json = os.path.join(output_dir, company, filename.replace('.txt', '_fine_chunks.json'))
+                with maybe_profile(profile, 'chunk', input_path):
+                    chunk_file(input_path, out_json, company=company, filing=filing)
                 print(f"Chunked {input_path} -> {out_json}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Fine chunk 10-K text files for RAG.")
     parser.add_argument('--txt_dir', type=str, required=True, help="Input directory (processed/10k_text)")
     parser.add_argument('--output_dir', type=str, required=True, help="Output directory for chunked JSON files")
+    parser.add_argument('--profile', action='store_true', help="Write cProfile/flamegraph/allocation profiles per filing to profiles/")
     args = parser.parse_args()
-    chunk_txt_dir_fine(args.txt_dir, args.output_dir)
+    chunk_txt_dir_fine(args.txt_dir, args.output_dir, profile=args.profile)
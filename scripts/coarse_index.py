@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+import index_store
+from index_store import MemmapFlatIndex, write_memmap_index
+from retrieval import get_vectors
+from tracing import span
+
+# ----------------- CONFIGURATION -----------------
+COARSE_INDEX_DIR = "index_coarse"
+MAX_GROUP = 32       # Consecutive chunks of one section per centroid; long Items are split
+N_SECTIONS = 16      # Centroids kept by the coarse stage; their chunks are scored exactly
+BUILD_BLOCK = 4096   # Chunk vectors read per block when computing centroids
+
+# ----------------- BUILD -----------------
+
+def section_groups(metadata, max_group=MAX_GROUP):
+    """
+    Split chunk ids into runs of consecutive chunks from the same filing and
+    PART/ITEM section, at most max_group long. Returns (group_of, groups).
+    """
+    group_of = np.empty(len(metadata), dtype=np.int64)
+    groups = []
+    prev = None
+    for i, meta in enumerate(metadata):
+        key = (meta.get('filename'), meta.get('section'))
+        if key != prev or groups[-1]['size'] >= max_group:
+            groups.append({'filename': key[0], 'section': key[1], 'company': meta.get('company'),
+                           'year': meta.get('year'), 'start': i, 'size': 0})
+            prev = key
+        groups[-1]['size'] += 1
+        group_of[i] = len(groups) - 1
+    return group_of, groups
+
+def build_coarse_index(index, metadata, out_dir=COARSE_INDEX_DIR, max_group=MAX_GROUP):
+    """
+    Write one centroid per section group (the mean of its fine-chunk vectors,
+    read back from the fine index, so no re-embedding) plus the id mapping.
+    """
+    group_of, groups = section_groups(metadata, max_group)
+    with span('coarse_build', items=len(groups)):
+        sums = np.zeros((len(groups), index.d), dtype=np.float64)
+        for b in range(0, len(metadata), BUILD_BLOCK):
+            ids = np.arange(b, min(b + BUILD_BLOCK, len(metadata)))
+            np.add.at(sums, group_of[ids], get_vectors(index, ids))
+        sizes = np.array([g['size'] for g in groups], dtype=np.float64)
+        centroids = (sums / sizes[:, None]).astype(np.float32)
+        write_memmap_index(centroids, os.path.join(out_dir, 'centroids'))
+        np.save(os.path.join(out_dir, 'group_of.npy'), group_of)
+        with open(os.path.join(out_dir, 'groups.json'), 'w', encoding='utf-8') as f:
+            json.dump({'ntotal': len(metadata), 'max_group': max_group, 'groups': groups}, f)
+    print(f"Coarse index saved to {out_dir}: {len(groups)} section centroids over {len(metadata)} chunks.")
+
+# ----------------- SEARCH -----------------
+
+class TwoStageIndex:
+    """
+    Coarse-to-fine search over a fine index: find the nearest section
+    centroids, then score only their chunks exactly. Same search()/
+    reconstruct interface as the fine index, so QAEngine can use it directly.
+    """
+
+    supports_subset = True
+
+    def __init__(self, fine, coarse_dir=COARSE_INDEX_DIR, n_sections=N_SECTIONS):
+        with open(os.path.join(coarse_dir, 'groups.json'), encoding='utf-8') as f:
+            info = json.load(f)
+        if info['ntotal'] != fine.ntotal:
+            raise ValueError(f"Coarse index covers {info['ntotal']} chunks but the index has {fine.ntotal}; rebuild it.")
+        self.fine = fine
+        self.coarse = MemmapFlatIndex(os.path.join(coarse_dir, 'centroids'))
+        self.group_of = np.load(os.path.join(coarse_dir, 'group_of.npy'), mmap_mode='r')
+        self.starts = np.array([g['start'] for g in info['groups']], dtype=np.int64)
+        self.sizes = np.array([g['size'] for g in info['groups']], dtype=np.int64)
+        self.n_sections = n_sections
+        self.ntotal = fine.ntotal
+        self.d = fine.d
+
+    def reconstruct(self, i):
+        return self.fine.reconstruct(i)
+
+    def reconstruct_batch(self, ids):
+        return get_vectors(self.fine, ids)
+
+    def members(self, group_ids):
+        group_ids = group_ids[group_ids >= 0]
+        if not len(group_ids):
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.arange(s, s + n) for s, n in zip(self.starts[group_ids], self.sizes[group_ids])])
+
+    def search(self, q, k, subset=None, n_sections=None):
+        n_sections = n_sections or self.n_sections
+        q = np.ascontiguousarray(q, dtype=np.float32).reshape(-1, self.d)
+        group_subset = None
+        if subset is not None:
+            subset = np.unique(np.asarray(subset, dtype=np.int64))
+            group_subset = np.unique(self.group_of[subset])  # Only sections that can satisfy the filter
+        _, G = self.coarse.search(q, n_sections, subset=group_subset)
+        D = np.full((len(q), k), np.inf, dtype=np.float32)
+        I = np.full((len(q), k), -1, dtype=np.int64)
+        for i in range(len(q)):
+            ids = self.members(G[i])
+            if subset is not None:
+                ids = np.intersect1d(ids, subset, assume_unique=True)
+            if len(ids):
+                D[i:i + 1], I[i:i + 1] = index_store.search_subset(self.fine, q[i:i + 1], k, ids)
+        return D, I
+
+# ----------------- RECALL BENCHMARK -----------------
+
+def recall_benchmark(fine, two_stage, queries, k=20, n_sections_list=(4, 8, 16, 32, 64)):
+    """Recall@k of the two-stage search against exact flat search, with per-query latency."""
+    start = time.perf_counter()
+    _, exact = fine.search(queries, k)
+    flat_ms = 1000 * (time.perf_counter() - start) / len(queries)
+    rows = [{'method': 'flat', 'n_sections': None, 'recall': 1.0, 'ms_per_query': flat_ms,
+             'chunks_scored': fine.ntotal}]
+    for n in n_sections_list:
+        start = time.perf_counter()
+        _, got = two_stage.search(queries, k, n_sections=n)
+        ms = 1000 * (time.perf_counter() - start) / len(queries)
+        hits = [len(set(g[g >= 0]) & set(e[e >= 0])) / max(1, (e >= 0).sum()) for g, e in zip(got, exact)]
+        _, G = two_stage.coarse.search(queries, n)
+        scored = np.mean([two_stage.sizes[g[g >= 0]].sum() for g in G])
+        rows.append({'method': 'two_stage', 'n_sections': n, 'recall': float(np.mean(hits)),
+                     'ms_per_query': ms, 'chunks_scored': float(scored)})
+    return rows
+
+def benchmark_queries(questions_path, embedder, metadata, n_random=200, seed=0):
+    """Labelled questions (if any) plus random chunk texts used as queries."""
+    texts = []
+    if questions_path and os.path.exists(questions_path):
+        with open(questions_path, encoding='utf-8') as f:
+            texts += [q['question'] for q in json.load(f)]
+    rng = np.random.default_rng(seed)
+    texts += [metadata[i]['text'] for i in rng.choice(len(metadata), size=min(n_random, len(metadata)), replace=False)]
+    return np.asarray(embedder.encode(texts), dtype=np.float32)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the section-centroid coarse index or benchmark its recall.")
+    parser.add_argument('--out_dir', type=str, default=None,
+                        help=f"Where to write the coarse index (default {COARSE_INDEX_DIR}; --tiny uses a temp dir)")
+    parser.add_argument('--max_group', type=int, default=MAX_GROUP, help="Max consecutive chunks per centroid")
+    parser.add_argument('--benchmark', action='store_true', help="Report recall@k vs flat search instead of building")
+    parser.add_argument('--k', type=int, default=20, help="k for recall@k (the engine's candidate count)")
+    parser.add_argument('--n_sections', type=int, nargs='+', default=[4, 8, 16, 32, 64])
+    parser.add_argument('--questions', type=str, default='data/eval/questions.json')
+    parser.add_argument('--tiny', action='store_true', help="Use the hashing stand-in embedder and a temp index (no models)")
+    args = parser.parse_args()
+
+    # Stand-in centroids never go to the real index_coarse/: the chunk count matches, so they would load silently
+    scratch = tempfile.TemporaryDirectory(prefix='coarse_tiny_') if args.tiny and args.out_dir is None else None
+    out_dir = scratch.name if scratch else args.out_dir or COARSE_INDEX_DIR
+    if args.tiny:
+        from benchmark_queries import build_tiny_engine
+        engine = build_tiny_engine()
+        index, metadata, embedder = engine.index, engine.metadata, engine.embedder
+    else:
+        from retrieval import INDEX_PATH, META_PATH, load_index, load_metadata
+        index, metadata = load_index(INDEX_PATH), load_metadata(META_PATH)
+        embedder = None
+    if not args.benchmark or args.tiny:
+        build_coarse_index(index, metadata, out_dir, args.max_group)
+    if args.benchmark:
+        if embedder is None:
+            from retrieval import load_embedder
+            embedder = load_embedder()
+        two_stage = TwoStageIndex(index, out_dir)
+        queries = benchmark_queries(args.questions, embedder, metadata)
+        print(f"\nRecall@{args.k} vs flat search over {len(queries)} queries, {index.ntotal} chunks")
+        print(f"{'method':<10} {'sections':>8} {'recall':>7} {'ms/query':>9} {'chunks scored':>14}")
+        for row in recall_benchmark(index, two_stage, queries, args.k, args.n_sections):
+            print(f"{row['method']:<10} {str(row['n_sections'] or '-'):>8} {row['recall']:>7.3f} "
+                  f"{row['ms_per_query']:>9.2f} {row['chunks_scored']:>14.0f}")
+    if scratch:
+        scratch.cleanup()
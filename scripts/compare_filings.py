@@ -0,0 +1,66 @@
+import argparse
+
+from retrieval import QAEngine, INDEX_PATH, META_PATH
+from retrieval_profile import PROFILE, QA_SEARCH
+from inference_backends import BACKENDS, DEFAULT_BACKEND
+from profiling import maybe_profile
+
+# ----------------- CONFIGURATION -----------------
+CELL_WIDTH = 28  # Characters per answer cell in the printed table
+
+def get_engine(server=None, backend=DEFAULT_BACKEND, coarse_dir=None):
+    """Use a running qa_server.py when given its URL, otherwise load everything locally."""
+    if server:
+        from qa_client import QAClient
+        return QAClient(server)
+    return QAEngine.load(INDEX_PATH, META_PATH, backend=backend, coarse_dir=coarse_dir)
+
+def compare_question(engine, question, companies=None, years=None, top_k=3):
+    """Answer the question for each company x fiscal year; years is an inclusive (start, end) range."""
+    year_list = list(range(years[0], years[1] + 1)) if years else None
+    return engine.compare(question, companies=companies, years=year_list, top_k=top_k,
+                          candidates=PROFILE['qa']['candidates'], **QA_SEARCH)
+
+def answer_table(rows):
+    """Align compare() rows as {year: {company: best answer or None}}, newest year first."""
+    table = {}
+    for row in rows:
+        table.setdefault(row['year'], {})[row['company']] = row['best']
+    return table
+
+def format_table(rows, width=CELL_WIDTH):
+    companies = list(dict.fromkeys(row['company'] for row in rows))
+    cell = lambda text: (text if len(text) <= width else text[:width - 3] + '...').ljust(width)
+    lines = ['FY    ' + ' | '.join(cell(c) for c in companies)]
+    lines.append('-' * len(lines[0]))
+    for year, by_company in answer_table(rows).items():
+        answers = []
+        for company in companies:
+            best = by_company.get(company)
+            answers.append(cell(f"{best['answer']} ({best['score']:.2f})" if best else '-'))
+        lines.append(f"{year:<6}" + ' | '.join(answers))
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ask one question across companies and fiscal years.")
+    parser.add_argument('--companies', nargs='*', default=None, help="Tickers to compare (default: all indexed)")
+    parser.add_argument('--years', type=int, nargs=2, metavar=('START', 'END'), default=None,
+                        help="Fiscal years START..END (default: all indexed)")
+    parser.add_argument('--server', type=str, default=None, help="URL of a running qa_server.py (e.g. http://127.0.0.1:8765)")
+    parser.add_argument('--backend', choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help="Local inference backend: fp32 PyTorch, dynamic int8 or ONNX Runtime")
+    parser.add_argument('--two_stage', nargs='?', const='index_coarse', default=None, metavar='COARSE_DIR',
+                        help="Coarse-to-fine search through section centroids built by coarse_index.py")
+    parser.add_argument('--profile', action='store_true', help="Profile each question into profiles/ (cProfile, flamegraph, allocations)")
+    args = parser.parse_args()
+
+    engine = get_engine(args.server, args.backend, args.two_stage)
+    companies = [c.upper() for c in args.companies] if args.companies else None
+    while True:
+        q = input("\nAsk a question to compare across filings (or type 'exit'): ")
+        if q.lower() == 'exit':
+            break
+        with maybe_profile(args.profile, 'compare', q):
+            rows = compare_question(engine, q, companies=companies, years=args.years)
+        print()
+        print(format_table(rows))
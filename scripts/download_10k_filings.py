@@ -1,8 +1,13 @@
 import os
+import re
 import requests
 from tqdm import tqdm
 from datetime import datetime
 
+from tracing import span, count
+from filing_catalog import make_record, upsert
+from raw_store import raw_name, write_raw
+
 # ----------------- CONFIGURATION -----------------
 TICKERS = ['AAPL', 'MSFT', 'TSLA']  # List of company tickers to fetch filings for
 YEARS = ['2019', '2020', '2021', '2022', '2023']  # Target filing years
@@ -30,10 +35,11 @@ def get_cik(ticker):
             return str(item['cik_str']).zfill(10)
     return None
 
-def get_10k_urls(cik):
+def get_10k_filings(cik, ticker=None):
     """
-    For a given CIK, fetch the list of 10-K filing document URLs from SEC.
-    Filters only 10-K forms from the specified YEARS.
+    For a given CIK, fetch catalog records (see filing_catalog.py) for its
+    10-K filings from the specified YEARS: accession, document URL, filing
+    date and fiscal period end (reportDate).
     """
     url = f'https://data.sec.gov/submissions/CIK{cik}.json'
     res = requests.get(url, headers=HEADERS)
@@ -45,8 +51,9 @@ def get_10k_urls(cik):
     accession_numbers = filings.get('accessionNumber', [])
     primary_docs = filings.get('primaryDocument', [])
     filing_dates = filings.get('filingDate', [])
+    report_dates = filings.get('reportDate', [''] * len(forms))
 
-    urls = []
+    records = []
     for i, form in enumerate(forms):
         if form == '10-K':
             year = filing_dates[i][:4]
@@ -57,31 +64,51 @@ def get_10k_urls(cik):
             cik_stripped = str(int(cik))  # Remove leading zeros
             file_url = f"{SEC_API}/Archives/edgar/data/{cik_stripped}/{accession}/{primary_doc}"
             if primary_doc.endswith(('.htm', '.html')):  # Only include HTML-based documents
-                urls.append((accession, file_url))
+                records.append(make_record(ticker, accession, cik=cik, filing_date=filing_dates[i],
+                                           period_end=report_dates[i], form=form, url=file_url))
 
-    return urls
+    return records
+
+def get_10k_urls(cik):
+    """
+    For a given CIK, fetch the list of 10-K filing document URLs from SEC.
+    Filters only 10-K forms from the specified YEARS.
+    """
+    return [(rec['accession'], rec['url']) for rec in get_10k_filings(cik)]
 
 def download_filing(ticker, cik, accession, url):
     """
-    Download the 10-K filing HTML document from the given URL
-    and save it to the appropriate ticker folder.
+    Download the 10-K filing HTML document from the given URL and save the
+    response bytes, compressed, to the appropriate ticker folder (see raw_store.py).
+    Returns the saved path, or None if the download failed.
     """
     if not url.endswith(('.htm', '.html')):
         print(f"Skipped (not .htm or .html): {url}")
-        return
-
-    try:
-        res = requests.get(url, headers=HEADERS, timeout=10)
-        if res.status_code == 200:
-            ext = '.html' if url.endswith('.html') else '.htm'
-            filename = f"{BASE_DIR}/{ticker}/{accession}{ext}"
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(res.text)
-            print(f" Saved: {filename}")
-        else:
-            print(f" Failed ({res.status_code}) for {ticker}: {url}")
-    except Exception as e:
-        print(f" Exception for {ticker} at {url}: {e}")
+        return None
+    filename = None
+
+    with span('download', ticker=ticker, accession=accession) as sp:
+        try:
+            res = requests.get(url, headers=HEADERS, timeout=10)
+            sp['status'] = res.status_code
+            if res.status_code == 200:
+                ext = '.html' if url.endswith('.html') else '.htm'
+                filename = f"{BASE_DIR}/{ticker}/{raw_name(accession, ext)}"
+                # Original bytes; the charset is only recorded if the server declared one
+                charset = re.search(r'charset=([\w.:-]+)', res.headers.get('Content-Type', ''), re.IGNORECASE)
+                info = write_raw(filename, res.content, encoding=charset.group(1) if charset else None)
+                sp['items'], sp['bytes'], sp['bytes_out'] = 1, len(res.content), info['stored']
+                print(f" Saved: {filename}")
+            else:
+                count('download.failures')
+                filename = None
+                print(f" Failed ({res.status_code}) for {ticker}: {url}")
+        except Exception as e:
+            count('download.failures')
+            sp['exception'] = str(e)
+            filename = None
+            print(f" Exception for {ticker} at {url}: {e}")
+    return filename
 
 # ----------------- MAIN LOGIC -----------------
 
@@ -95,10 +122,12 @@ def main():
             print(f"Ticker not found: {ticker}")
             continue
         print(f"CIK for {ticker}: {cik}")
-        urls = get_10k_urls(cik)
-        print(f"Found {len(urls)} 10-K URLs")
-        for accession, url in tqdm(urls, desc=f" Downloading {ticker}"):
-            download_filing(ticker, cik, accession, url)
+        filings = get_10k_filings(cik, ticker)
+        print(f"Found {len(filings)} 10-K URLs")
+        for rec in tqdm(filings, desc=f" Downloading {ticker}"):
+            if download_filing(ticker, cik, rec['accession'], rec['url']):
+                # Authoritative ticker/CIK/dates for parse, chunk and index to carry along
+                upsert([rec])
 
 # ----------------- RUN -----------------
 
@@ -1,50 +1,236 @@
 import os
 import json
+import argparse
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
 import pickle
+import tempfile
+from itertools import islice
+
+from qa_token_cache import TOKEN_CACHE_DIR, build_token_cache
+from index_store import (MMAP_INDEX_DIR, SHARD_ROWS, MemmapFlatIndex, MemmapShardWriter, ivfdata_path, publish_dir,
+                         write_memmap_index)
+from tracing import span
+from profiling import maybe_profile
+from retrieval_profile import PROFILE
 
 # Path to directory with JSON chunk files (one subfolder per company)
 CHUNKS_DIR = "data/chunks/10k_chunks"
 INDEX_PATH = "faiss_index.bin"
 META_PATH = "chunk_metadata.pkl"
+META_JSONL_PATH = "chunk_metadata.jsonl"  # Written line by line by the streaming build
+STREAM_BATCH = 256  # Chunks encoded per batch in the streaming build
+IVF_TRAIN_SAMPLE = 100000  # Max vectors sampled from the shards to train an IVF index
+IVF_NLIST = 1024  # Inverted lists of the streamed IVF index (--nlist)
+EMBED_MODEL = 'all-MiniLM-L6-v2'
+EMBED_DIM = 384
+QA_MODEL = 'distilbert-base-cased-distilled-squad'  # Tokenizer used for the QA token cache
+
+def chunk_records(fpath, company, min_words=None):
+    """Indexable chunk texts and metadata from one chunk file (info chunks and tiny fragments are skipped)."""
+    min_words = PROFILE['chunking']['min_chunk_words'] if min_words is None else min_words
+    texts = []
+    metadata = []
+    fname = os.path.basename(fpath)
+    with open(fpath, 'r', encoding='utf-8') as f:
+        chunks = json.load(f)
+        for chunk in chunks:
+            if chunk.get("type") != "info" and len(chunk['text'].split()) >= min_words:
+                texts.append(chunk['text'])
+                meta = chunk.copy()
+                meta['company'] = company
+                meta['filename'] = fname
+                metadata.append(meta)
+    return texts, metadata
 
-texts = []
-metadata = []
+def load_chunks(chunks_dir=CHUNKS_DIR, min_words=None):
+    """Collect indexable chunk texts and their metadata for every company."""
+    texts = []
+    metadata = []
+    for company in os.listdir(chunks_dir):
+        company_dir = os.path.join(chunks_dir, company)
+        if not os.path.isdir(company_dir):
+            continue
+        for fname in os.listdir(company_dir):
+            if not fname.endswith('.json'):
+                continue
+            file_texts, file_meta = chunk_records(os.path.join(company_dir, fname), company, min_words)
+            texts.extend(file_texts)
+            metadata.extend(file_meta)
+    return texts, metadata
 
-for company in os.listdir(CHUNKS_DIR):
-    company_dir = os.path.join(CHUNKS_DIR, company)
-    if not os.path.isdir(company_dir):
-        continue
-    for fname in os.listdir(company_dir):
-        if not fname.endswith('.json'):
+def iter_chunks(chunks_dir=CHUNKS_DIR):
+    """Yield (text, metadata) one chunk at a time; only one chunk file is open at once."""
+    for company in sorted(os.listdir(chunks_dir)):
+        company_dir = os.path.join(chunks_dir, company)
+        if not os.path.isdir(company_dir):
             continue
-        fpath = os.path.join(company_dir, fname)
-        with open(fpath, 'r', encoding='utf-8') as f:
-            chunks = json.load(f)
-            for chunk in chunks:
-                 if chunk.get("type") != "info" and len(chunk['text'].split()) >= 8:
-                    texts.append(chunk['text'])
-                    meta = chunk.copy()
-                    meta['company'] = company
-                    meta['filename'] = fname
-                    metadata.append(meta)
-
-print(f"Loaded {len(texts)} chunks.")
-
-# Load MiniLM model from sentence-transformers
-model = SentenceTransformer('all-MiniLM-L6-v2')
-embeddings = model.encode(texts, show_progress_bar=True, convert_to_numpy=True)
-
-# Create FAISS index
-d = embeddings.shape[1]
-index = faiss.IndexFlatL2(d)
-index.add(embeddings)
-faiss.write_index(index, INDEX_PATH)
-
-# Save metadata
-with open(META_PATH, 'wb') as meta_file:
-    pickle.dump(metadata, meta_file)
-
-print(f"FAISS index and metadata saved. Indexed {len(texts)} chunks.")
+        for fname in sorted(os.listdir(company_dir)):
+            if fname.endswith('.json'):
+                yield from zip(*chunk_records(os.path.join(company_dir, fname), company))
+
+def load_embedder():
+    # Load MiniLM model from sentence-transformers
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBED_MODEL)
+
+def embed_chunk_file(model, chunk_path, company, out_prefix):
+    """Embed one filing's chunks and save <out_prefix>.npy (vectors) and <out_prefix>.json (metadata)."""
+    texts, metadata = chunk_records(chunk_path, company)
+    with span('embed', file=chunk_path, items=len(texts)):
+        embeddings = model.encode(texts, convert_to_numpy=True) if texts else np.zeros((0, EMBED_DIM), dtype=np.float32)
+    os.makedirs(os.path.dirname(out_prefix), exist_ok=True)
+    np.save(out_prefix + '.npy', np.asarray(embeddings, dtype=np.float32))
+    with open(out_prefix + '.json', 'w', encoding='utf-8') as f:
+        json.dump(metadata, f)
+    return len(texts)
+
+def load_embedded_files(prefixes):
+    """Concatenate per-filing embeddings and metadata written by embed_chunk_file()."""
+    parts, metadata = [], []
+    for prefix in prefixes:
+        parts.append(np.load(prefix + '.npy'))
+        with open(prefix + '.json', encoding='utf-8') as f:
+            metadata.extend(json.load(f))
+    embeddings = np.vstack(parts) if parts else np.zeros((0, EMBED_DIM), dtype=np.float32)
+    return embeddings, metadata
+
+def build_index(embeddings, metadata, profile=False):
+    """Write the FAISS index, memory-mapped index, metadata pickle and QA token cache."""
+    texts = [m['text'] for m in metadata]
+    with maybe_profile(profile, 'index_build', INDEX_PATH), span('index_build', items=len(texts)) as sp:
+        # Create FAISS index
+        d = embeddings.shape[1]
+        index = faiss.IndexFlatL2(d)
+        index.add(embeddings)
+        # Every file is written aside and renamed into place: a running app or server may have it mapped
+        faiss.write_index(index, INDEX_PATH + '.tmp')
+        os.replace(INDEX_PATH + '.tmp', INDEX_PATH)
+        if os.path.exists(ivfdata_path(INDEX_PATH)):
+            os.remove(ivfdata_path(INDEX_PATH))  # Lists of an earlier streamed IVF build
+        # Same vectors in a memory-mappable layout: near-instant, shared-page-cache loading
+        write_memmap_index(embeddings, MMAP_INDEX_DIR)
+
+        # Save metadata
+        with open(META_PATH + '.tmp', 'wb') as meta_file:
+            pickle.dump(metadata, meta_file)
+        os.replace(META_PATH + '.tmp', META_PATH)
+        sp['bytes'] = int(embeddings.nbytes)
+
+    # Pre-tokenize every chunk for the QA model; row i matches FAISS id i
+    with maybe_profile(profile, 'token_cache_build', TOKEN_CACHE_DIR), span('token_cache_build', items=len(texts)):
+        build_token_cache(texts, QA_MODEL, TOKEN_CACHE_DIR)
+
+def fill_faiss_index(index_dir, out_path=INDEX_PATH, nlist=IVF_NLIST):
+    """
+    Build an IVF index from memory-mapped shards without holding the vectors:
+    it is trained on a sample of the shards, each block is added to its own
+    copy of the trained index and written aside, and the blocks are merged
+    into inverted lists on disk (ivfdata_path(out_path)) that FAISS maps on load.
+    """
+    from faiss.contrib.ondisk import merge_ondisk
+    store = MemmapFlatIndex(index_dir)
+    quantizer = faiss.IndexFlatL2(store.d)
+    index = faiss.IndexIVFFlat(quantizer, store.d, nlist)
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(store.ntotal, size=min(store.ntotal, IVF_TRAIN_SAMPLE), replace=False))
+    with span('index_train', items=len(sample)):
+        index.train(store.reconstruct_batch(sample))
+    ivfdata = ivfdata_path(out_path)
+    with span('index_fill', items=store.ntotal), \
+            tempfile.TemporaryDirectory(prefix='ivf_blocks_', dir=os.path.dirname(os.path.abspath(out_path))) as tmp:
+        blocks, first = [], 0
+        for vectors in store.vectors:
+            for b in range(0, len(vectors), SHARD_ROWS):
+                rows = np.ascontiguousarray(vectors[b:b + SHARD_ROWS])
+                block = faiss.clone_index(index)
+                block.add_with_ids(rows, np.arange(first, first + len(rows), dtype=np.int64))
+                blocks.append(os.path.join(tmp, f'block{len(blocks)}.index'))
+                faiss.write_index(block, blocks[-1])
+                first += len(rows)
+                del block, rows
+        # Merged under a temporary name: a running app or server may have the old lists mapped
+        merge_ondisk(index, blocks, ivfdata + '.tmp')
+    faiss.downcast_InvertedLists(index.invlists).filename = ivfdata
+    index.make_direct_map()  # MMR/diversify reconstructs vectors by id
+    os.replace(ivfdata + '.tmp', ivfdata)
+    faiss.write_index(index, out_path + '.tmp')
+    os.replace(out_path + '.tmp', out_path)
+    return index
+
+def stream_build(chunks_dir=CHUNKS_DIR, batch_size=STREAM_BATCH, shard_rows=SHARD_ROWS, nlist=0, profile=False):
+    """
+    Bounded-memory index build: chunks are read lazily, encoded in fixed-size
+    batches and appended to on-disk shards, and metadata is written one JSON
+    line per chunk. Peak memory is one batch plus the model, not the corpus.
+    """
+    model = load_embedder()
+    staging = MMAP_INDEX_DIR + '.building'
+    writer = None
+    records = iter_chunks(chunks_dir)
+    with maybe_profile(profile, 'embed', chunks_dir), span('embed', streaming=True) as sp, \
+            open(META_JSONL_PATH + '.tmp', 'w', encoding='utf-8') as meta_file:
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            texts = [text for text, _ in batch]
+            embeddings = model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+            if writer is None:
+                writer = MemmapShardWriter(staging, embeddings.shape[1], shard_rows=shard_rows)
+            writer.append(embeddings)
+            for _, meta in batch:
+                meta_file.write(json.dumps(meta) + '\n')
+            sp['items'] = writer.ntotal
+            print(f"Embedded {writer.ntotal} chunks", end='\r')
+    if writer is None:
+        print("No chunks found.")
+        return
+    writer.close()
+    publish_dir(staging, MMAP_INDEX_DIR)
+    os.replace(META_JSONL_PATH + '.tmp', META_JSONL_PATH)
+
+    if nlist:
+        with maybe_profile(profile, 'index_build', INDEX_PATH), span('index_build', items=writer.ntotal):
+            fill_faiss_index(MMAP_INDEX_DIR, INDEX_PATH, nlist=nlist)
+    else:
+        # Flat search is served straight from the shards; drop an older FAISS file so it isn't picked up instead
+        for path in (INDEX_PATH, ivfdata_path(INDEX_PATH)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def texts_from_metadata():
+        with open(META_JSONL_PATH, encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)['text']
+
+    with maybe_profile(profile, 'token_cache_build', TOKEN_CACHE_DIR), span('token_cache_build', items=writer.ntotal):
+        build_token_cache(texts_from_metadata(), QA_MODEL, TOKEN_CACHE_DIR)
+    print(f"Streaming build done. Indexed {writer.ntotal} chunks; metadata in {META_JSONL_PATH}.")
+
+def main(profile=False):
+    with maybe_profile(profile, 'load_chunks', CHUNKS_DIR), span('load_chunks') as sp:
+        texts, metadata = load_chunks(CHUNKS_DIR)
+        sp.update(items=len(texts), bytes=sum(len(t) for t in texts))
+    print(f"Loaded {len(texts)} chunks.")
+
+    model = load_embedder()
+    with maybe_profile(profile, 'embed', CHUNKS_DIR), span('embed', items=len(texts)):
+        embeddings = model.encode(texts, show_progress_bar=True, convert_to_numpy=True)
+
+    build_index(embeddings, metadata, profile=profile)
+    print(f"FAISS index and metadata saved. Indexed {len(texts)} chunks.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Embed chunk files and build the search index.")
+    parser.add_argument('--profile', action='store_true', help="Write cProfile/flamegraph/allocation profiles per stage to profiles/")
+    parser.add_argument('--stream', action='store_true', help="Bounded-memory build: encode in batches straight into on-disk shards")
+    parser.add_argument('--batch_size', type=int, default=STREAM_BATCH, help="Chunks per encode batch (--stream)")
+    parser.add_argument('--shard_rows', type=int, default=SHARD_ROWS, help="Vectors per shard file (--stream)")
+    parser.add_argument('--nlist', type=int, default=0, help="Also build an IVF index with on-disk inverted lists and this many lists (--stream; "
+                        "default: search the shards directly)")
+    args = parser.parse_args()
+    if args.stream:
+        stream_build(CHUNKS_DIR, batch_size=args.batch_size, shard_rows=args.shard_rows, nlist=args.nlist, profile=args.profile)
+    else:
+        main(profile=args.profile)
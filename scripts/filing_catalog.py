@@ -0,0 +1,121 @@
+import os
+import re
+import json
+import argparse
+import threading
+from datetime import datetime
+
+# ----------------- CONFIGURATION -----------------
+CATALOG_PATH = 'data/filings_catalog.json'  # {"TICKER/accession": filing record}
+TEXT_DIR = 'data/processed/10k_text'
+# Fields copied onto every chunk and metadata record
+CHUNK_FIELDS = ('cik', 'accession', 'filing_date', 'period_end', 'fiscal_year')
+PERIOD_RE = re.compile(r'fiscal\s+year\s+ended\s+([A-Za-z]+\.?\s+\d{1,2}\s*,\s*\d{4})', re.IGNORECASE)
+SCAN_LINES = 200  # The cover page is at the top of the text
+
+_lock = threading.Lock()
+
+# ----------------- RECORDS -----------------
+
+def fiscal_year(period_end):
+    """Fiscal year of a filing: the calendar year its fiscal period ends in ('2019-09-28' -> '2019')."""
+    return period_end[:4] if period_end else None
+
+def make_record(ticker, accession, cik=None, filing_date=None, period_end=None, form='10-K', url=None, source='edgar'):
+    return {
+        'ticker': ticker,
+        'cik': cik,
+        'accession': accession,
+        'form': form,
+        'filing_date': filing_date or None,
+        'period_end': period_end or None,
+        'fiscal_year': fiscal_year(period_end) or (filing_date[:4] if filing_date else None),
+        'url': url,
+        'source': source,  # 'edgar' = submissions API, 'text' = read off the cover page
+    }
+
+def period_end_from_text(text_path):
+    """Fiscal period end ('YYYY-MM-DD') from the 'For the fiscal year ended ...' cover-page line."""
+    with open(text_path, 'r', encoding='utf-8', errors='ignore') as f:
+        for i, line in enumerate(f):
+            if i >= SCAN_LINES:
+                break
+            m = PERIOD_RE.search(line)
+            if m:
+                raw = re.sub(r'\s+', ' ', m.group(1).replace('.', '')).replace(' ,', ',')
+                for fmt in ('%B %d, %Y', '%b %d, %Y'):
+                    try:
+                        return datetime.strptime(raw, fmt).strftime('%Y-%m-%d')
+                    except ValueError:
+                        continue
+    return None
+
+# ----------------- CATALOG FILE -----------------
+
+def load_catalog(path=CATALOG_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_catalog(catalog, path=CATALOG_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(catalog, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+def upsert(records, path=CATALOG_PATH):
+    """Add or replace records. EDGAR records are never overwritten by text-derived ones."""
+    with _lock:
+        catalog = load_catalog(path)
+        for rec in records:
+            key = f"{rec['ticker']}/{rec['accession']}"
+            if rec['source'] != 'edgar' and catalog.get(key, {}).get('source') == 'edgar':
+                continue
+            catalog[key] = rec
+        save_catalog(catalog, path)
+    return catalog
+
+def lookup(ticker, accession, catalog=None):
+    catalog = load_catalog() if catalog is None else catalog
+    return catalog.get(f"{ticker}/{accession}")
+
+def resolve(ticker, accession, text_path=None, catalog=None):
+    """Catalog record for a filing, or one read off its text if the catalog doesn't have it."""
+    rec = lookup(ticker, accession, catalog)
+    if rec is None and text_path and os.path.exists(text_path):
+        rec = make_record(ticker, accession, period_end=period_end_from_text(text_path), source='text')
+    return rec
+
+def chunk_fields(rec):
+    """The catalog fields carried on each chunk."""
+    return {k: rec.get(k) for k in CHUNK_FIELDS} if rec else {}
+
+def backfill_from_text(text_dir=TEXT_DIR, path=CATALOG_PATH):
+    """Catalog filings that were not downloaded by this repo (no EDGAR record) from their cover pages."""
+    catalog = load_catalog(path)
+    records = []
+    for ticker in sorted(os.listdir(text_dir)):
+        folder = os.path.join(text_dir, ticker)
+        if not os.path.isdir(folder):
+            continue
+        for fname in sorted(os.listdir(folder)):
+            accession, ext = os.path.splitext(fname)
+            if ext == '.txt' and f"{ticker}/{accession}" not in catalog:
+                records.append(make_record(ticker, accession, period_end=period_end_from_text(os.path.join(folder, fname)),
+                                           source='text'))
+    if records:
+        upsert(records, path)
+    return records
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show the filing catalog or backfill it from processed text.")
+    parser.add_argument('--backfill', action='store_true', help="Add filings found in --text_dir that are not cataloged")
+    parser.add_argument('--text_dir', type=str, default=TEXT_DIR)
+    args = parser.parse_args()
+    if args.backfill:
+        added = backfill_from_text(args.text_dir)
+        print(f"Added {len(added)} filings from text.")
+    for key, rec in sorted(load_catalog().items()):
+        print(f"{key:<28} FY{rec['fiscal_year']}  period end {rec['period_end']}  filed {rec['filing_date']}  ({rec['source']})")
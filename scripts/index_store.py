@@ -0,0 +1,243 @@
+import os
+import json
+import shutil
+import numpy as np
+
+# ----------------- CONFIGURATION -----------------
+MMAP_INDEX_DIR = "index_mmap"
+MANIFEST = "manifest.json"
+SEARCH_BLOCK_ROWS = 65536  # Rows scored per matrix product; bounds temporary memory
+SHARD_ROWS = 262144  # Rows per shard file written by MemmapShardWriter (~400 MB at d=384)
+
+# ----------------- WRITE -----------------
+
+def write_memmap_index(embeddings, out_dir=MMAP_INDEX_DIR):
+    """
+    Save vectors as a memory-mappable flat index: one float32 .npy of vectors
+    plus their squared norms, described by manifest.json. Written to a staging
+    directory and swapped in whole, so processes that have the old files
+    mapped keep reading them and no shards from an earlier build are left over.
+    """
+    staging = out_dir.rstrip(os.sep) + ".building"
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    np.save(os.path.join(staging, "vectors_0000.npy"), embeddings)
+    np.save(os.path.join(staging, "norms_0000.npy"), (embeddings ** 2).sum(axis=1))
+    manifest = {
+        "metric": "l2",
+        "dim": int(embeddings.shape[1]),
+        "shards": [{"vectors": "vectors_0000.npy", "norms": "norms_0000.npy", "rows": int(len(embeddings))}],
+    }
+    _write_manifest(staging, manifest)
+    publish_dir(staging, out_dir)
+    print(f"Memory-mapped index saved to {out_dir}: {len(embeddings)} vectors.")
+
+class MemmapShardWriter:
+    """
+    Build a memory-mapped flat index incrementally: append() batches of vectors
+    as they are encoded and they go straight to fixed-size on-disk shards, so
+    memory stays bounded by one batch whatever the corpus size. close() trims
+    the last shard and writes the manifest.
+    """
+
+    def __init__(self, out_dir, dim, shard_rows=SHARD_ROWS):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.dim = dim
+        self.shard_rows = shard_rows
+        self.shards = []
+        self.ntotal = 0
+        self._vectors = self._norms = None
+        self._fill = 0
+
+    def _open_shard(self):
+        n = len(self.shards)
+        names = {"vectors": f"vectors_{n:04d}.npy", "norms": f"norms_{n:04d}.npy", "rows": 0}
+        self._vectors = np.lib.format.open_memmap(os.path.join(self.out_dir, names["vectors"]), mode='w+',
+                                                  dtype=np.float32, shape=(self.shard_rows, self.dim))
+        self._norms = np.lib.format.open_memmap(os.path.join(self.out_dir, names["norms"]), mode='w+',
+                                                dtype=np.float32, shape=(self.shard_rows,))
+        self._fill = 0
+        self.shards.append(names)
+
+    def _close_shard(self):
+        names = self.shards[-1]
+        names["rows"] = self._fill
+        if self._fill < self.shard_rows:
+            # .npy shapes are fixed: copy the filled rows into a right-sized file
+            for key, arr in (("vectors", self._vectors), ("norms", self._norms)):
+                path = os.path.join(self.out_dir, names[key])
+                trimmed = np.lib.format.open_memmap(path + ".tmp", mode='w+', dtype=np.float32,
+                                                    shape=(self._fill,) + arr.shape[1:])
+                for b in range(0, self._fill, SEARCH_BLOCK_ROWS):
+                    trimmed[b:b + SEARCH_BLOCK_ROWS] = arr[b:min(b + SEARCH_BLOCK_ROWS, self._fill)]
+                trimmed.flush()
+                del trimmed
+                os.replace(path + ".tmp", path)
+        else:
+            self._vectors.flush()
+            self._norms.flush()
+        self._vectors = self._norms = None
+
+    def append(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        start = 0
+        while start < len(vectors):
+            if self._vectors is None:
+                self._open_shard()
+            take = min(len(vectors) - start, self.shard_rows - self._fill)
+            block = vectors[start:start + take]
+            self._vectors[self._fill:self._fill + take] = block
+            self._norms[self._fill:self._fill + take] = (block ** 2).sum(axis=1)
+            self._fill += take
+            self.ntotal += take
+            start += take
+            if self._fill == self.shard_rows:
+                self._close_shard()
+
+    def close(self):
+        if self._vectors is not None:
+            self._close_shard()
+        manifest = {"metric": "l2", "dim": int(self.dim), "shards": self.shards}
+        _write_manifest(self.out_dir, manifest)
+        print(f"Memory-mapped index saved to {self.out_dir}: {self.ntotal} vectors in {len(self.shards)} shards.")
+        return manifest
+
+def publish_dir(staging_dir, target_dir):
+    """Swap a freshly built directory into place, then delete the old one."""
+    old = target_dir + ".old"
+    if os.path.exists(old):
+        shutil.rmtree(old)
+    if os.path.exists(target_dir):
+        os.rename(target_dir, old)
+    os.rename(staging_dir, target_dir)
+    if os.path.exists(old):
+        shutil.rmtree(old)
+
+def ivfdata_path(index_path):
+    """On-disk inverted lists that go with a streamed IVF index file."""
+    return os.path.splitext(index_path)[0] + ".ivfdata"
+
+def _write_manifest(out_dir, manifest):
+    # Write then rename, so readers never see a half-written manifest
+    tmp = os.path.join(out_dir, MANIFEST + ".tmp")
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(out_dir, MANIFEST))
+
+# ----------------- READ & SEARCH -----------------
+
+def _topk_merge(D, I, d_new, i_new, k):
+    """Merge a block's candidates into the running top-k (both sorted ascending)."""
+    d = np.concatenate([D, d_new], axis=1)
+    i = np.concatenate([I, i_new], axis=1)
+    order = np.argsort(d, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(d, order, axis=1), np.take_along_axis(i, order, axis=1)
+
+class MemmapFlatIndex:
+    """
+    Exact L2 search over read-only memory-mapped vectors, with the same
+    search()/ntotal/d interface as faiss.IndexFlatL2. Opening it only maps the
+    files, so startup cost does not grow with the index, and every process on
+    the host shares one page-cache copy of the vectors.
+    """
+
+    supports_subset = True
+
+    def __init__(self, index_dir=MMAP_INDEX_DIR):
+        with open(os.path.join(index_dir, MANIFEST), encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        self.d = self.manifest["dim"]
+        self.vectors, self.norms, self.offsets = [], [], []
+        offset = 0
+        for shard in self.manifest["shards"]:
+            self.vectors.append(np.load(os.path.join(index_dir, shard["vectors"]), mmap_mode='r'))
+            self.norms.append(np.load(os.path.join(index_dir, shard["norms"]), mmap_mode='r'))
+            self.offsets.append(offset)
+            offset += shard["rows"]
+        self.ntotal = offset
+
+    def _shard_of(self, ids):
+        return np.searchsorted(self.offsets, ids, side='right') - 1
+
+    def reconstruct(self, i):
+        s = int(self._shard_of(np.asarray([i]))[0])
+        return np.array(self.vectors[s][i - self.offsets[s]])
+
+    def reconstruct_batch(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        out = np.empty((len(ids), self.d), dtype=np.float32)
+        shards = self._shard_of(ids)
+        for s in np.unique(shards):
+            rows = np.flatnonzero(shards == s)
+            out[rows] = self.vectors[s][ids[rows] - self.offsets[s]]
+        return out
+
+    def _score(self, q, q_norms, vectors, norms):
+        return norms[None, :] - 2.0 * (q @ vectors.T) + q_norms[:, None]
+
+    def search(self, q, k, subset=None):
+        """
+        Return (D, I) like faiss: squared L2 distances and ids, -1 padded.
+        If `subset` (array of ids) is given only those rows are scored.
+        """
+        q = np.ascontiguousarray(q, dtype=np.float32).reshape(-1, self.d)
+        q_norms = (q ** 2).sum(axis=1)
+        D = np.full((len(q), k), np.inf, dtype=np.float32)
+        I = np.full((len(q), k), -1, dtype=np.int64)
+        if subset is not None:
+            ids = np.unique(np.asarray(subset, dtype=np.int64))
+            for b in range(0, len(ids), SEARCH_BLOCK_ROWS):
+                block = ids[b:b + SEARCH_BLOCK_ROWS]
+                vecs = self.reconstruct_batch(block)
+                dist = self._score(q, q_norms, vecs, (vecs ** 2).sum(axis=1))
+                D, I = self._merge_block(D, I, dist, block, k)
+            return D, I
+        for vectors, norms, offset in zip(self.vectors, self.norms, self.offsets):
+            for b in range(0, len(vectors), SEARCH_BLOCK_ROWS):
+                dist = self._score(q, q_norms, vectors[b:b + SEARCH_BLOCK_ROWS], norms[b:b + SEARCH_BLOCK_ROWS])
+                block = np.arange(offset + b, offset + b + dist.shape[1], dtype=np.int64)
+                D, I = self._merge_block(D, I, dist, block, k)
+        return D, I
+
+    @staticmethod
+    def _merge_block(D, I, dist, block_ids, k):
+        kk = min(k, dist.shape[1])
+        if kk == 0:
+            return D, I
+        part = np.argpartition(dist, kk - 1, axis=1)[:, :kk]
+        d_new = np.take_along_axis(dist, part, axis=1).astype(np.float32)
+        return _topk_merge(D, I, d_new, block_ids[part], k)
+
+def search_subset(index, q, k, ids):
+    """Search only the given ids: natively for our own index classes, via an IDSelector for FAISS indexes."""
+    if getattr(index, 'supports_subset', False):
+        return index.search(q, k, subset=ids)
+    import faiss
+    sel = faiss.IDSelectorBatch(np.asarray(ids, dtype=np.int64))
+    if hasattr(index, 'nprobe'):
+        params = faiss.SearchParametersIVF(sel=sel, nprobe=index.nprobe)
+    else:
+        params = faiss.SearchParameters(sel=sel)
+    return index.search(np.ascontiguousarray(q, dtype=np.float32), k, params=params)
+
+def load_index(path):
+    """
+    Open an index for search. A directory is a memory-mapped flat index
+    (MemmapFlatIndex) or a company/year ShardedIndex; a file is read by FAISS with mmap IO flags where the
+    index type supports them, else read normally.
+    """
+    if os.path.isdir(path):
+        from sharded_index import ShardedIndex, is_sharded
+        if is_sharded(path):
+            return ShardedIndex(path)
+        return MemmapFlatIndex(path)
+    import faiss
+    if os.path.exists(ivfdata_path(path)):
+        return faiss.read_index(path)  # On-disk inverted lists map their own file; IO_FLAG_MMAP breaks them
+    try:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except (RuntimeError, AttributeError):
+        return faiss.read_index(path)
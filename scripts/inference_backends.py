@@ -0,0 +1,91 @@
+import os
+import numpy as np
+
+# ----------------- CONFIGURATION -----------------
+BACKENDS = ('fp32', 'int8', 'onnx')
+DEFAULT_BACKEND = os.environ.get('INFERENCE_BACKEND', 'fp32')
+ONNX_DIR = 'models/onnx'  # Exported graphs are cached here, one folder per model
+
+def _onnx_path(model_name):
+    return os.path.join(ONNX_DIR, model_name.replace('/', '__'))
+
+def _quantize_int8(model):
+    """Dynamic int8 quantization of every nn.Linear (weights int8, activations quantized on the fly)."""
+    import torch
+    model.eval()
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def _export_onnx(ort_class, model_name):
+    """Load a cached ONNX export of `model_name`, exporting it on first use."""
+    path = _onnx_path(model_name)
+    if os.path.isdir(path):
+        return ort_class.from_pretrained(path)
+    model = ort_class.from_pretrained(model_name, export=True)
+    model.save_pretrained(path)
+    return model
+
+class OnnxEmbedder:
+    """
+    ONNX Runtime version of a sentence-transformers model with the same
+    encode() call. Mean pooling + L2 normalisation match all-MiniLM-L6-v2.
+    """
+
+    def __init__(self, model_name, normalize=True):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        self.model = _export_onnx(ORTModelForFeatureExtraction, model_name)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.normalize = normalize
+        self.max_seq_length = min(self.tokenizer.model_max_length, 256)
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, convert_to_numpy=True, **kwargs):
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+        out = []
+        for i in range(0, len(sentences), batch_size):
+            enc = self.tokenizer(sentences[i:i + batch_size], padding=True, truncation=True,
+                                 max_length=self.max_seq_length, return_tensors='np')
+            hidden = self.model(**enc).last_hidden_state
+            hidden = hidden.numpy() if hasattr(hidden, 'numpy') else np.asarray(hidden)
+            mask = enc['attention_mask'][..., None].astype(np.float32)
+            emb = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.normalize:
+                emb = emb / np.clip(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12, None)
+            out.append(emb.astype(np.float32))
+        emb = np.vstack(out) if out else np.zeros((0, 0), dtype=np.float32)
+        return emb[0] if single else emb
+
+def load_embedder(model_name, backend=DEFAULT_BACKEND):
+    """Return an object with SentenceTransformer's encode() for the chosen backend, falling back to fp32."""
+    from sentence_transformers import SentenceTransformer
+    if backend == 'onnx':
+        try:
+            return OnnxEmbedder(model_name)
+        except Exception as e:
+            print(f"ONNX embedder unavailable ({e}); falling back to fp32.")
+    model = SentenceTransformer(model_name, device='cpu' if backend == 'int8' else None)
+    if backend == 'int8':
+        try:
+            return _quantize_int8(model)
+        except Exception as e:
+            print(f"int8 quantization failed ({e}); falling back to fp32.")
+    return model
+
+def load_qa(model_name, backend=DEFAULT_BACKEND):
+    """Return a question-answering pipeline running on the chosen backend, falling back to fp32."""
+    from transformers import AutoModelForQuestionAnswering, AutoTokenizer, pipeline
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if backend == 'onnx':
+        try:
+            from optimum.onnxruntime import ORTModelForQuestionAnswering
+            model = _export_onnx(ORTModelForQuestionAnswering, model_name)
+            return pipeline('question-answering', model=model, tokenizer=tokenizer)
+        except Exception as e:
+            print(f"ONNX QA model unavailable ({e}); falling back to fp32.")
+    model = AutoModelForQuestionAnswering.from_pretrained(model_name)
+    if backend == 'int8':
+        try:
+            model = _quantize_int8(model)
+        except Exception as e:
+            print(f"int8 quantization failed ({e}); falling back to fp32.")
+    return pipeline('question-answering', model=model, tokenizer=tokenizer, device=-1)
@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import filing_catalog
+import index_store
+from answer_store import ANSWER_DB, materialize
+from raw_store import raw_name, write_raw
+from index_store import _topk_merge
+from qa_token_cache import QATokenCache, build_token_cache
+from retrieval import QAEngine, QA_MODEL, get_vectors
+from tracing import span, count
+
+# ----------------- CONFIGURATION -----------------
+RAW_DIR = 'data/raw/10k_filings'
+TEXT_DIR = 'data/processed/10k_text'
+CHUNKS_DIR = 'data/chunks/10k_chunks'
+EMBED_DIR = 'data/embeddings'  # Same per-filing layout as pipeline.py, so a full rebuild picks these up
+LIVE_LOG = 'data/live_ingested.json'  # Filings ingested since the index was built; re-applied at startup
+
+# ----------------- APPENDED INDEX -----------------
+
+class AppendedIndex:
+    """
+    A read-only base index plus vectors appended after it was built. Ids
+    continue after the base (base.ntotal + i); search merges both top-k lists.
+    """
+
+    supports_subset = True
+
+    def __init__(self, base, delta=None):
+        self.base = base
+        self.delta = np.zeros((0, base.d), dtype=np.float32) if delta is None else delta
+        self.delta_norms = (self.delta ** 2).sum(axis=1)
+        self.d = base.d
+        self.ntotal = base.ntotal + len(self.delta)
+
+    def append(self, vectors):
+        """A new index with the vectors added; this one is left unchanged for in-flight queries."""
+        return AppendedIndex(self.base, np.vstack([self.delta, np.asarray(vectors, dtype=np.float32)]))
+
+    def reconstruct(self, i):
+        return self.reconstruct_batch([i])[0]
+
+    def reconstruct_batch(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        out = np.empty((len(ids), self.d), dtype=np.float32)
+        in_base = ids < self.base.ntotal
+        if in_base.any():
+            out[in_base] = get_vectors(self.base, ids[in_base])
+        if (~in_base).any():
+            out[~in_base] = self.delta[ids[~in_base] - self.base.ntotal]
+        return out
+
+    def search(self, q, k, subset=None):
+        q = np.ascontiguousarray(q, dtype=np.float32).reshape(-1, self.d)
+        n_base = self.base.ntotal
+        delta_ids = np.arange(len(self.delta), dtype=np.int64)
+        if subset is None:
+            D, I = self.base.search(q, k)
+        else:
+            subset = np.asarray(subset, dtype=np.int64)
+            base_ids = subset[subset < n_base]
+            delta_ids = subset[subset >= n_base] - n_base
+            D = np.full((len(q), k), np.inf, dtype=np.float32)
+            I = np.full((len(q), k), -1, dtype=np.int64)
+            if len(base_ids):
+                D, I = index_store.search_subset(self.base, q, k, base_ids)
+        if len(delta_ids):
+            vecs = self.delta[delta_ids]
+            dist = self.delta_norms[delta_ids][None, :] - 2.0 * (q @ vecs.T) + (q ** 2).sum(axis=1)[:, None]
+            kk = min(k, len(delta_ids))
+            part = np.argpartition(dist, kk - 1, axis=1)[:, :kk]
+            D, I = _topk_merge(np.asarray(D, dtype=np.float32), np.asarray(I, dtype=np.int64),
+                               np.take_along_axis(dist, part, axis=1).astype(np.float32),
+                               delta_ids[part] + n_base, k)
+        return D, I
+
+class AppendedTokenCache:
+    """QA token cache over the base rows plus one cache per appended filing."""
+
+    def __init__(self, base, parts=()):
+        self.base = base
+        self.parts = list(parts)  # [(first id, QATokenCache)]
+        self.info = base.info
+
+    def append(self, first_id, cache):
+        return AppendedTokenCache(self.base, self.parts + [(first_id, cache)])
+
+    def __len__(self):
+        return len(self.base) + sum(len(c) for _, c in self.parts)
+
+    def get(self, chunk_id):
+        for first, cache in reversed(self.parts):
+            if chunk_id >= first:
+                return cache.get(chunk_id - first)
+        return self.base.get(chunk_id)
+
+# ----------------- INGESTION -----------------
+
+class LiveIngestor:
+    """
+    Adds filings to a running app. A single background worker saves, parses,
+    chunks and embeds each filing, then builds a new engine over the appended
+    index and swaps it in with one assignment. Queries that already took
+    `current` keep answering from their snapshot; the next query sees the filing.
+    """
+
+    def __init__(self, engine):
+        if not isinstance(engine.index, AppendedIndex):
+            cache = engine.pretokenized_qa.cache if engine.pretokenized_qa is not None else None
+            engine = QAEngine(AppendedIndex(engine.index), engine.metadata, engine.embedder, engine.qa,
+                              AppendedTokenCache(cache) if cache is not None else None)
+        self.current = engine
+        self.jobs = []  # Newest last: {'ticker', 'accession', 'status', 'error', 'chunks', 'started'}
+        self._swap_lock = threading.Lock()
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="live-ingest")
+
+    # --- public API ---
+
+    def submit_upload(self, ticker, filename, data):
+        """Queue an uploaded HTML filing (bytes). The accession is taken from the file name."""
+        accession = os.path.splitext(os.path.basename(filename))[0]
+        ext = os.path.splitext(filename)[1].lower() or '.htm'
+        return self._submit(ticker.upper(), accession, lambda path: write_raw(path, data), ext)
+
+    def submit_register(self, ticker, url, accession=None, cik=None):
+        """Queue a filing to download from EDGAR by document URL."""
+        from download_10k_filings import download_filing
+        accession = accession or url.rstrip('/').split('/')[-2]
+        ext = '.html' if url.endswith('.html') else '.htm'
+
+        def fetch(path):
+            if not download_filing(ticker.upper(), cik, accession, url):
+                raise RuntimeError(f"download failed: {url}")
+        return self._submit(ticker.upper(), accession, fetch, ext)
+
+    def restore(self):
+        """Re-apply filings ingested after the index was built (e.g. after an app restart)."""
+        if not os.path.exists(LIVE_LOG):
+            return 0
+        with open(LIVE_LOG, encoding='utf-8') as f:
+            entries = json.load(f)
+        indexed = {m['filename'] for m in self.current.metadata}
+        restored = 0
+        for entry in entries:
+            prefix = entry['prefix']
+            if entry['chunk_file'] in indexed or not os.path.exists(prefix + '.npy'):
+                continue
+            self._swap_in(prefix)
+            restored += 1
+        return restored
+
+    # --- worker ---
+
+    def _submit(self, ticker, accession, fetch, ext):
+        job = {'ticker': ticker, 'accession': accession, 'status': 'queued', 'error': None, 'chunks': 0,
+               'started': time.time()}
+        self.jobs.append(job)
+        self._worker.submit(self._ingest, job, fetch, ext)
+        return job
+
+    def _ingest(self, job, fetch, ext):
+        from parse_html_to_text import convert_file
+        from chunk_10k_sections import chunk_file
+        from embed_chunks import embed_chunk_file
+        ticker, accession = job['ticker'], job['accession']
+        raw = os.path.join(RAW_DIR, ticker, raw_name(accession, ext))
+        text = os.path.join(TEXT_DIR, ticker, accession + '.txt')
+        chunks = os.path.join(CHUNKS_DIR, ticker, accession + '_fine_chunks.json')
+        prefix = os.path.join(EMBED_DIR, ticker, accession)
+        try:
+            if any(m['filename'] == os.path.basename(chunks) for m in self.current.metadata):
+                raise ValueError(f"{ticker} {accession} is already indexed")
+            with span('live_ingest', ticker=ticker, accession=accession) as sp:
+                job['status'] = 'saving'
+                os.makedirs(os.path.dirname(raw), exist_ok=True)
+                fetch(raw)
+                job['status'] = 'parsing'
+                os.makedirs(os.path.dirname(text), exist_ok=True)
+                convert_file(raw, text)
+                filing = filing_catalog.resolve(ticker, accession, text)
+                filing_catalog.upsert([filing])
+                job['status'] = 'chunking'
+                chunk_file(text, chunks, company=ticker, filing=filing)
+                job['status'] = 'embedding'
+                job['chunks'] = embed_chunk_file(self.current.embedder, chunks, ticker, prefix)
+                if self.current.pretokenized_qa is not None:
+                    with open(prefix + '.json', encoding='utf-8') as f:
+                        build_token_cache((m['text'] for m in json.load(f)), QA_MODEL, prefix + '.tokens')
+                job['status'] = 'indexing'
+                self._swap_in(prefix)
+                _log_ingested(prefix, os.path.basename(chunks))
+                if os.path.exists(ANSWER_DB) and self.current.qa is not None:
+                    # Answer the canonical questions for the new filing; other slices are unchanged
+                    job['status'] = 'materializing'
+                    materialize(self.current)
+                sp['items'] = job['chunks']
+            job['status'] = 'ready'
+            count('live_ingest.filings')
+        except Exception as e:
+            count('live_ingest.failures')
+            job['status'], job['error'] = 'failed', f"{type(e).__name__}: {e}"
+
+    def _swap_in(self, prefix):
+        """Build the next engine snapshot with one filing's rows appended and publish it."""
+        vectors = np.load(prefix + '.npy')
+        with open(prefix + '.json', encoding='utf-8') as f:
+            metadata = json.load(f)
+        with self._swap_lock:
+            old = self.current
+            first_id = old.index.ntotal
+            cache = old.pretokenized_qa.cache if old.pretokenized_qa is not None else None
+            if cache is not None:
+                if os.path.exists(os.path.join(prefix + '.tokens', 'meta.json')):
+                    cache = cache.append(first_id, QATokenCache(prefix + '.tokens'))
+                else:
+                    cache = None  # Can't serve the new rows from the cache; use the plain QA pipeline
+            new = QAEngine(old.index.append(vectors), old.metadata + metadata, old.embedder, old.qa, cache)
+            self.current = new  # Atomic publish; in-flight queries keep `old`
+
+def _log_ingested(prefix, chunk_file):
+    entries = []
+    if os.path.exists(LIVE_LOG):
+        with open(LIVE_LOG, encoding='utf-8') as f:
+            entries = json.load(f)
+    entries = [e for e in entries if e['prefix'] != prefix] + [{'prefix': prefix, 'chunk_file': chunk_file}]
+    os.makedirs(os.path.dirname(LIVE_LOG) or '.', exist_ok=True)
+    tmp = LIVE_LOG + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, indent=2)
+    os.replace(tmp, LIVE_LOG)
@@ -3,6 +3,11 @@ import shutil
 import html2text
 import re
 
+from tracing import span, count
+from profiling import maybe_profile
+from raw_store import iter_text, split_raw_name
+from section_index import write_sections
+
 def ensure_output_dirs(raw_dir, text_dir):
     if os.path.exists(text_dir):
         shutil.rmtree(text_dir)
@@ -11,6 +16,7 @@ def ensure_output_dirs(raw_dir, text_dir):
         os.makedirs(os.path.join(text_dir, company), exist_ok=True)
 
 def html_to_markdown_lines(html_content):
+    """Markdown lines for an HTML string, or for an iterable of text blocks fed to the parser as they arrive."""
     # Configure html2text to preserve heading markers
     text_maker = html2text.HTML2Text()
     text_maker.body_width = 0
@@ -18,7 +24,15 @@ def html_to_markdown_lines(html_content):
     text_maker.ignore_images = True
     text_maker.single_line_break = True
     text_maker.ignore_emphasis = False
-    markdown_text = text_maker.handle(html_content)
+    if isinstance(html_content, str):
+        markdown_text = text_maker.handle(html_content)
+    else:
+        # Same steps as HTML2Text.handle, one decompressed block at a time
+        text_maker.start = True
+        for block in html_content:
+            text_maker.feed(block)
+        text_maker.feed("")
+        markdown_text = text_maker.optwrap(text_maker.finish())
     # Remove any html2text '***' lines (markdown horizontal rules)
     markdown_text = re.sub(r'^\*{3,}$', '', markdown_text, flags=re.MULTILINE)
     return markdown_text.splitlines()
@@ -144,7 +158,32 @@ def add_blank_lines(lines):
         output.pop()
     return output
 
-def convert_html_to_text_with_html2text(raw_dir, text_dir):
+def convert_file(in_file, out_file):
+    """
+    Convert one raw HTML filing (compressed or not, see raw_store.py) to
+    cleaned plain text, and index its ITEM byte ranges (section_index.py).
+    """
+    with span('parse', file=in_file) as sp:
+        chars = 0
+
+        def blocks():
+            nonlocal chars
+            for block in iter_text(in_file):
+                chars += len(block)
+                yield block
+        lines = html_to_markdown_lines(blocks())
+        lines = clean_xbrl_junk_lines(lines)
+        #lines = process_lines_for_toc(lines)
+        lines = align_tables_and_format(lines)
+        lines = [line.replace('|', ' ') for line in lines]
+        lines = add_blank_lines(lines)
+        clean_text = '\n'.join(lines)
+        with open(out_file, 'w', encoding='utf-8') as out:
+            out.write(clean_text)
+        sections = write_sections(out_file, clean_text.split('\n'))
+        sp.update(sections=len(sections), items=1, bytes=os.path.getsize(in_file), chars=chars, bytes_out=len(clean_text), lines=len(lines))
+
+def convert_html_to_text_with_html2text(raw_dir, text_dir, profile=False):
     ensure_output_dirs(raw_dir, text_dir)
     for company in os.listdir(raw_dir):
         raw_path = os.path.join(raw_dir, company)
@@ -153,23 +192,16 @@ def convert_html_to_text_with_html2text(raw_dir, text_dir):
         processed_path = os.path.join(text_dir, company)
         os.makedirs(processed_path, exist_ok=True)
         for filename in os.listdir(raw_path):
-            if filename.endswith(('.html', '.htm')):
+            parsed = split_raw_name(filename)
+            if parsed:
                 in_file = os.path.join(raw_path, filename)
-                out_file = os.path.join(processed_path, os.path.splitext(filename)[0] + '.txt')
+                out_file = os.path.join(processed_path, parsed[0] + '.txt')
                 try:
-                    with open(in_file, 'r', encoding='utf-8', errors='ignore') as f:
-                        html_content = f.read()
-                    lines = html_to_markdown_lines(html_content)
-                    lines = clean_xbrl_junk_lines(lines)
-                    #lines = process_lines_for_toc(lines)
-                    lines = align_tables_and_format(lines)
-                    lines = [line.replace('|', ' ') for line in lines]
-                    lines = add_blank_lines(lines)
-                    clean_text = '\n'.join(lines)
-                    with open(out_file, 'w', encoding='utf-8') as out:
-                        out.write(clean_text)
+                    with maybe_profile(profile, 'parse', in_file):
+                        convert_file(in_file, out_file)
                     print(f"{filename} -> {out_file}")
                 except Exception as e:
+                    count('parse.failures')
                     print(f"Error processing {in_file}: {e}")
 
 if __name__ == '__main__':
@@ -177,9 +209,10 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Convert 10-K HTML to plain text using html2text.")
     parser.add_argument('--raw_dir', type=str, help='Directory with company folders of HTML files')
     parser.add_argument('--text_dir', type=str, help='Directory to save processed text')
+    parser.add_argument('--profile', action='store_true', help='Write cProfile/flamegraph/allocation profiles per filing to profiles/')
     args = parser.parse_args()
 
     if args.raw_dir and args.text_dir:
-        convert_html_to_text_with_html2text(args.raw_dir, args.text_dir)
+        convert_html_to_text_with_html2text(args.raw_dir, args.text_dir, profile=args.profile)
     else:
         print("Provide --raw_dir and --text_dir.")
\ No newline at end of file
@@ -0,0 +1,397 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import filing_catalog
+from raw_store import find_raw, raw_name, split_raw_name
+from retrieval_profile import PROFILE
+from tracing import span, count
+
+# ----------------- CONFIGURATION -----------------
+PIPELINE_VERSION = 1  # Bump to invalidate every cached task
+RAW_DIR = 'data/raw/10k_filings'
+TEXT_DIR = 'data/processed/10k_text'
+CHUNKS_DIR = 'data/chunks/10k_chunks'
+EMBED_DIR = 'data/embeddings'  # Per-filing vectors + metadata, concatenated by the index task
+STATE_PATH = 'data/.pipeline_state.json'
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+# Source files whose contents are part of each stage's fingerprint
+STAGE_CODE = {
+    'download': ['download_10k_filings.py', 'raw_store.py'],
+    'parse': ['parse_html_to_text.py', 'raw_store.py', 'section_index.py'],
+    'chunk': ['chunk_10k_sections.py', 'filing_catalog.py', 'section_index.py'],
+    'embed': ['embed_chunks.py'],
+    'index': ['embed_chunks.py', 'index_store.py', 'qa_token_cache.py'],
+    'materialize': ['answer_store.py'],
+}
+# Where each stage runs: 'io' threads (network), 'cpu' processes, 'model' = one thread holding the embedder
+STAGE_POOL = {'download': 'io', 'parse': 'cpu', 'chunk': 'cpu', 'embed': 'model', 'index': 'model',
+              'materialize': 'model'}
+
+# ----------------- TASKS -----------------
+
+class Task:
+    """One unit of work: fn(*args) reads `inputs` and must produce every path in `outputs`."""
+
+    def __init__(self, name, stage, fn, args=(), inputs=(), outputs=(), deps=(), params=None, immutable=False,
+                 skip_failed=False):
+        self.name = name
+        self.stage = stage
+        self.fn = fn
+        self.args = args
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.params = params or {}
+        self.immutable = immutable  # Output never changes once written (downloaded filings)
+        # A failed dep doesn't block this task: its outputs are left out of `inputs`, and fn(inputs, *args) runs on the rest
+        self.skip_failed = skip_failed
+
+    def without(self, dropped):
+        """Copy with the `dropped` paths taken out of its inputs, for a skip_failed run."""
+        inputs = [p for p in self.inputs if p not in dropped]
+        return Task(self.name, self.stage, self.fn, self.args, inputs, self.outputs, self.deps, self.params,
+                    self.immutable, self.skip_failed)
+
+def _download(ticker, cik, accession, url):
+    from download_10k_filings import download_filing
+    os.makedirs(os.path.join(RAW_DIR, ticker), exist_ok=True)
+    if not download_filing(ticker, cik, accession, url):
+        raise RuntimeError(f"download failed: {url}")
+
+def _parse(in_file, out_file):
+    from parse_html_to_text import convert_file
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    convert_file(in_file, out_file)
+
+def _chunk(in_file, out_json, company, accession):
+    from chunk_10k_sections import chunk_file
+    from filing_catalog import resolve
+    chunk_file(in_file, out_json, company=company, filing=resolve(company, accession, in_file))
+
+_model = None
+_model_lock = threading.Lock()
+
+def _embedder():
+    global _model
+    with _model_lock:
+        if _model is None:
+            from embed_chunks import load_embedder
+            _model = load_embedder()
+        return _model
+
+def _embed(chunk_path, company, out_prefix):
+    from embed_chunks import embed_chunk_file
+    embed_chunk_file(_embedder(), chunk_path, company, out_prefix)
+
+def _build_index(inputs):
+    from embed_chunks import load_embedded_files, build_index
+    prefixes = [os.path.splitext(p)[0] for p in inputs if p.endswith('.npy')]
+    embeddings, metadata = load_embedded_files(prefixes)
+    build_index(embeddings, metadata)
+    print(f"Index rebuilt from {len(prefixes)} filings ({len(metadata)} chunks).")
+
+def _materialize():
+    from answer_store import materialize
+    from retrieval import QAEngine, load_index, load_metadata, load_qa
+    # Only company/year slices whose chunks changed are re-answered
+    redone = materialize(QAEngine(load_index(), load_metadata(), _embedder(), load_qa()))
+    print(f"Precomputed answers refreshed for {len(redone)} company/year slices.")
+
+# ----------------- GRAPH -----------------
+
+def discover_filings(tickers, offline=False):
+    """
+    {(ticker, accession): {'cik', 'url', 'raw', 'text'}} for every known filing:
+    EDGAR listings (unless offline) plus whatever raw/text files are already on disk.
+    """
+    filings = {}
+    if not offline:
+        from download_10k_filings import get_cik, get_10k_filings
+        for ticker in tickers:
+            try:
+                cik = get_cik(ticker)
+                records = get_10k_filings(cik, ticker) if cik else []
+            except Exception as e:
+                print(f"Listing failed for {ticker} ({e}); using files on disk.")
+                continue
+            # Catalog entries are written here, in the main process, before any task runs
+            filing_catalog.upsert(records)
+            for rec in records:
+                ext = '.html' if rec['url'].endswith('.html') else '.htm'
+                folder = os.path.join(RAW_DIR, ticker)
+                # A filing already on disk (compressed or legacy) counts as downloaded
+                raw = find_raw(folder, rec['accession']) or os.path.join(folder, raw_name(rec['accession'], ext))
+                filings[(ticker, rec['accession'])] = {'cik': cik, 'url': rec['url'], 'raw': raw}
+    for ticker in tickers:
+        folder = os.path.join(RAW_DIR, ticker)
+        if os.path.isdir(folder):
+            for fname in sorted(os.listdir(folder)):
+                parsed = split_raw_name(fname)
+                if parsed:
+                    filings.setdefault((ticker, parsed[0]), {}).setdefault('raw', find_raw(folder, parsed[0]))
+        folder = os.path.join(TEXT_DIR, ticker)
+        if os.path.isdir(folder):
+            for fname in sorted(os.listdir(folder)):
+                accession, ext = os.path.splitext(fname)
+                if ext == '.txt':
+                    filings.setdefault((ticker, accession), {})['text'] = os.path.join(folder, fname)
+    return filings
+
+def build_graph(filings):
+    """
+    download -> parse -> chunk -> embed per filing, then one index task over
+    every filing whose embeddings were produced (a failed filing is left out).
+    """
+    catalog = filing_catalog.load_catalog()
+    tasks = []
+    prefixes = []
+    embed_names = []
+    for (ticker, accession), info in sorted(filings.items()):
+        tag = f"{ticker}/{accession}"
+        text_path = os.path.join(TEXT_DIR, ticker, accession + '.txt')
+        chunk_path = os.path.join(CHUNKS_DIR, ticker, accession + '_fine_chunks.json')
+        prefix = os.path.join(EMBED_DIR, ticker, accession)
+        deps = []
+        if info.get('raw'):
+            if info.get('url'):
+                tasks.append(Task(f"download:{tag}", 'download', _download,
+                                  (ticker, info['cik'], accession, info['url']),
+                                  outputs=[info['raw']], params={'url': info['url']}, immutable=True))
+                deps = [f"download:{tag}"]
+            tasks.append(Task(f"parse:{tag}", 'parse', _parse, (info['raw'], text_path),
+                              inputs=[info['raw']], outputs=[text_path], deps=deps))
+            deps = [f"parse:{tag}"]
+        # Filings with only a text file on disk start at the chunk stage.
+        # The catalog record and tuned chunking are parameters, so changing either re-chunks the filing.
+        tasks.append(Task(f"chunk:{tag}", 'chunk', _chunk, (text_path, chunk_path, ticker, accession),
+                          inputs=[text_path], outputs=[chunk_path], deps=deps,
+                          params={'filing': catalog.get(tag), 'chunking': PROFILE['chunking']}))
+        tasks.append(Task(f"embed:{tag}", 'embed', _embed, (chunk_path, ticker, prefix),
+                          inputs=[chunk_path], outputs=[prefix + '.npy', prefix + '.json'], deps=[f"chunk:{tag}"],
+                          params={'min_words': PROFILE['chunking']['min_chunk_words']}))
+        prefixes.append(prefix)
+        embed_names.append(f"embed:{tag}")
+    if prefixes:
+        from embed_chunks import INDEX_PATH, META_PATH
+        from index_store import MMAP_INDEX_DIR, MANIFEST
+        from qa_token_cache import TOKEN_CACHE_DIR
+        tasks.append(Task('index', 'index', _build_index,
+                          inputs=[p + ext for p in prefixes for ext in ('.npy', '.json')],
+                          outputs=[INDEX_PATH, META_PATH, os.path.join(MMAP_INDEX_DIR, MANIFEST),
+                                   os.path.join(TOKEN_CACHE_DIR, 'meta.json')],
+                          deps=embed_names, skip_failed=True))
+        from answer_store import ANSWER_DB, QUESTIONS_PATH
+        if os.path.exists(QUESTIONS_PATH):
+            tasks.append(Task('materialize', 'materialize', _materialize, (),
+                              inputs=[META_PATH, QUESTIONS_PATH], outputs=[ANSWER_DB], deps=['index'],
+                              params={'qa': PROFILE['qa']}))
+    return tasks
+
+# ----------------- STATE & FINGERPRINTS -----------------
+
+class PipelineState:
+    """Fingerprint of every successful task plus a content-hash cache keyed by (size, mtime)."""
+
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        self.data = {'tasks': {}, 'files': {}}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.data = json.load(f)
+        self._lock = threading.Lock()
+        self._code = {}
+
+    def file_hash(self, path):
+        st = os.stat(path)
+        key = [st.st_size, st.st_mtime_ns]
+        cached = self.data['files'].get(path)
+        if cached and cached[:2] == key:
+            return cached[2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digest = h.hexdigest()
+        with self._lock:
+            self.data['files'][path] = key + [digest]
+        return digest
+
+    def code_version(self, stage):
+        if stage not in self._code:
+            h = hashlib.sha256(str(PIPELINE_VERSION).encode())
+            for fname in STAGE_CODE[stage]:
+                with open(os.path.join(SCRIPTS_DIR, fname), 'rb') as f:
+                    h.update(f.read())
+            self._code[stage] = h.hexdigest()
+        return self._code[stage]
+
+    def fingerprint(self, task):
+        payload = {
+            'code': self.code_version(task.stage),
+            'params': task.params,
+            'inputs': [[p, self.file_hash(p)] for p in task.inputs],
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def up_to_date(self, task, fp):
+        if not all(os.path.exists(p) for p in task.outputs):
+            return False
+        return task.immutable or self.data['tasks'].get(task.name) == fp
+
+    def mark_done(self, task, fp):
+        with self._lock:
+            self.data['tasks'][task.name] = fp
+            self.save()
+
+    def forget(self, task):
+        with self._lock:
+            self.data['tasks'].pop(task.name, None)
+            self.save()
+
+    def save(self):
+        # Written after every task so an interrupted run resumes where it stopped
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+
+# ----------------- RUNNER -----------------
+
+def run(tasks, state, jobs=4, force_stages=(), dry_run=False):
+    """
+    Run tasks in dependency order across the stage pools. Up-to-date tasks are
+    skipped; a failed task only blocks its own downstream tasks, and a
+    skip_failed task runs without the failed task's outputs.
+    """
+    by_name = {t.name: t for t in tasks}
+    waiting = {t.name: set(t.deps) & by_name.keys() for t in tasks}
+    dependents = {t.name: [] for t in tasks}
+    for t in tasks:
+        for d in waiting[t.name]:
+            dependents[d].append(t.name)
+    status = {}
+    pools = {
+        'io': ThreadPoolExecutor(max_workers=jobs),
+        'cpu': ProcessPoolExecutor(max_workers=jobs),
+        'model': ThreadPoolExecutor(max_workers=1),
+    }
+    running = {}
+    left_out = {}  # skip_failed task -> deps it ran without
+
+    def block(name):
+        for child in dependents[name]:
+            if by_name[child].skip_failed:
+                waiting[child].discard(name)
+            elif child not in status:
+                status[child] = 'blocked'
+                block(child)
+
+    def without_failed(task):
+        failed = sorted(d for d in task.deps if d in by_name and status.get(d) not in ('ok', 'cached', 'would_run'))
+        if failed:
+            left_out[task.name] = failed
+            print(f"{task.name}: leaving out {len(failed)} failed or blocked inputs")
+        return task.without({p for d in failed for p in by_name[d].outputs})
+
+    def finish(name, result):
+        status[name] = result
+        if result not in ('ok', 'cached', 'would_run'):
+            block(name)
+            return
+        for child in dependents[name]:
+            waiting[child].discard(name)
+
+    def ready():
+        return [n for n, deps in waiting.items() if not deps and n not in status and n not in running.values()]
+
+    start = time.perf_counter()
+    try:
+        while True:
+            for name in ready():
+                task = by_name[name]
+                if task.skip_failed:
+                    task = by_name[name] = without_failed(task)
+                    if not task.inputs:
+                        finish(name, 'blocked')
+                        continue
+                fp = state.fingerprint(task) if all(os.path.exists(p) for p in task.inputs) else None
+                if fp and task.stage not in force_stages and state.up_to_date(task, fp):
+                    count('pipeline.cached')
+                    finish(name, 'cached')
+                    continue
+                if dry_run:
+                    print(f"would run {name}")
+                    finish(name, 'would_run')
+                    continue
+                if fp is None and task.inputs:
+                    print(f"FAILED {name}: missing inputs")
+                    finish(name, 'failed')
+                    continue
+                state.forget(task)
+                print(f"run {name}")
+                args = (task.inputs,) + tuple(task.args) if task.skip_failed else task.args
+                running[pools[STAGE_POOL[task.stage]].submit(task.fn, *args)] = name
+            if not running:
+                if not ready():
+                    break
+                continue
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                task = by_name[name]
+                try:
+                    future.result()
+                    missing = [p for p in task.outputs if not os.path.exists(p)]
+                    if missing:
+                        raise RuntimeError(f"outputs not written: {missing}")
+                except Exception as e:
+                    count('pipeline.failures')
+                    print(f"FAILED {name}: {e}")
+                    finish(name, 'failed')
+                    continue
+                state.mark_done(task, state.fingerprint(task))
+                finish(name, 'ok')
+    finally:
+        for pool in pools.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+    state.save()
+
+    summary = {}
+    for result in status.values():
+        summary[result] = summary.get(result, 0) + 1
+    print(f"Pipeline finished in {time.perf_counter() - start:.1f}s: "
+          + ', '.join(f"{n} {k}" for k, n in sorted(summary.items())))
+    for name, result in sorted(status.items()):
+        if result in ('failed', 'blocked'):
+            print(f"  {result}: {name}")
+    for name, deps in sorted(left_out.items()):
+        print(f"  {name} left out: {', '.join(d.split(':', 1)[1] for d in deps)}")
+    return status
+
+def main(tickers, offline=False, jobs=4, force_stages=(), dry_run=False):
+    with span('pipeline', tickers=','.join(tickers)) as sp:
+        filings = discover_filings(tickers, offline=offline)
+        filing_catalog.backfill_from_text(TEXT_DIR)  # Filings on disk that EDGAR listing didn't cover
+        print(f"{len(filings)} filings for {', '.join(tickers)}")
+        tasks = build_graph(filings)
+        status = run(tasks, PipelineState(), jobs=jobs, force_stages=force_stages, dry_run=dry_run)
+        sp.update(items=len(tasks), failed=sum(1 for s in status.values() if s == 'failed'))
+    return status
+
+if __name__ == '__main__':
+    from download_10k_filings import TICKERS
+    parser = argparse.ArgumentParser(description="Incremental download -> parse -> chunk -> embed -> index pipeline.")
+    parser.add_argument('--tickers', nargs='+', default=TICKERS, help="Companies to process")
+    parser.add_argument('--offline', action='store_true', help="Don't list/download from EDGAR; process files already on disk")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 4, help="Parallel downloads / parse+chunk processes")
+    parser.add_argument('--force', nargs='*', default=[], choices=list(STAGE_CODE), help="Re-run these stages even if cached")
+    parser.add_argument('--dry_run', action='store_true', help="Only print the tasks that would run")
+    args = parser.parse_args()
+    status = main(args.tickers, offline=args.offline, jobs=args.jobs, force_stages=set(args.force), dry_run=args.dry_run)
+    raise SystemExit(1 if any(s == 'failed' for s in status.values()) else 0)
@@ -0,0 +1,103 @@
+import os
+import re
+import sys
+import time
+import hashlib
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# ----------------- CONFIGURATION -----------------
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Under the repo root wherever a script is run from, like the trace file
+PROFILE_DIR = os.environ.get('FDI_PROFILE_DIR', os.path.join(REPO_ROOT, 'profiles'))
+SAMPLE_INTERVAL = 0.005  # Seconds between stack samples
+TOP_ALLOCATIONS = 30
+
+def _slug(stage, tag):
+    """File-safe name carrying the stage and what triggered it (filing path or question)."""
+    tag = str(tag or '')
+    readable = re.sub(r'[^A-Za-z0-9]+', '-', os.path.basename(tag) if os.sep in tag else tag).strip('-')[:48]
+    digest = hashlib.sha1(tag.encode('utf-8')).hexdigest()[:8]
+    return f"{time.strftime('%Y%m%d-%H%M%S')}_{stage}_{readable}_{digest}"
+
+class StackSampler:
+    """
+    Samples one thread's Python stack every `interval` seconds and counts
+    collapsed stacks ("outer;inner;leaf") in the flamegraph.pl/speedscope format.
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def write_folded(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, n in self.stacks.most_common():
+                f.write(f"{stack} {n}\n")
+
+def _write_allocations(snapshot, path, tag, stage, peak):
+    stats = snapshot.statistics('lineno')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"stage: {stage}\ntag: {tag}\npeak traced memory: {peak / 1e6:.1f} MB\n\n")
+        f.write(f"Top {TOP_ALLOCATIONS} allocation sites still alive at stage end:\n")
+        for stat in stats[:TOP_ALLOCATIONS]:
+            f.write(f"{stat.size / 1e6:10.2f} MB  {stat.count:8d} blocks  {stat.traceback}\n")
+
+@contextmanager
+def profile_stage(stage, tag=None, out_dir=PROFILE_DIR, interval=SAMPLE_INTERVAL):
+    """
+    Profile the enclosed block with cProfile, a stack sampler and tracemalloc.
+    Writes <name>.prof (pstats / snakeviz), <name>.folded (flamegraph input)
+    and <name>.alloc.txt (allocation snapshot). Yields the output path prefix.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    prefix = os.path.join(out_dir, _slug(stage, tag))
+    sampler = StackSampler(threading.get_ident(), interval)
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(25)
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield prefix
+    finally:
+        profiler.disable()
+        sampler.stop()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if started_tracemalloc:
+            tracemalloc.stop()
+        profiler.dump_stats(prefix + '.prof')
+        sampler.write_folded(prefix + '.folded')
+        _write_allocations(snapshot, prefix + '.alloc.txt', tag, stage, peak)
+        print(f"Profile written: {prefix}.{{prof,folded,alloc.txt}}")
+
+def maybe_profile(enabled, stage, tag=None):
+    """profile_stage() when enabled, otherwise a no-op context."""
+    return profile_stage(stage, tag) if enabled else nullcontext()
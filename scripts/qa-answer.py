@@ -1,55 +1,88 @@
-import faiss
-import pickle
-from sentence_transformers import SentenceTransformer
-from transformers import pipeline
+import argparse
+import threading
 
-INDEX_PATH = "faiss_index.bin"
-META_PATH = "chunk_metadata.pkl"
+from retrieval import QAEngine, INDEX_PATH, META_PATH
+from retrieval_profile import PROFILE, QA_SEARCH
+from answer_store import AnswerStore
+from section_index import get_section, parse_section_request
+from inference_backends import BACKENDS, DEFAULT_BACKEND
+from profiling import maybe_profile
 
-# Load index and metadata
-index = faiss.read_index(INDEX_PATH)
-with open(META_PATH, 'rb') as f:
-    metadata = pickle.load(f)
+def get_engine(server=None, backend=DEFAULT_BACKEND, coarse_dir=None):
+    """Use a running qa_server.py when given its URL, otherwise load everything locally."""
+    if server:
+        from qa_client import QAClient
+        return QAClient(server)
+    return QAEngine.load(INDEX_PATH, META_PATH, backend=backend, coarse_dir=coarse_dir)
 
-embedder = SentenceTransformer('all-MiniLM-L6-v2')
-qa = pipeline('question-answering', model='distilbert-base-cased-distilled-squad')
+# ----------------- CONFIGURATION -----------------
+SECTION_PREVIEW = 4000  # Characters of a directly requested section printed (section_index.py prints all)
 
-def search_chunks(question, top_k=5, company=None):
-    q_emb = embedder.encode([question])
-    D, I = index.search(q_emb, 20)
-    results = []
-    count = 0
-    for idx in I[0]:
-        meta = metadata[idx]
-        if company and meta['company'].lower() != company.lower():
-            continue
-        if len(meta['text'].split()) < 10:
-            continue
-        text = meta['text']
-        results.append({'text': text, 'meta': meta})
-        count += 1
-        if count >= top_k:
-            break
-    return results
+def answer_question(engine, question, company=None, diversify=True, years=None, answers=None, item=None):
+    # Catalog questions are served from the precomputed answer table (answer_store.py) when it is current
+    if answers is not None and diversify == QA_SEARCH['diversify'] and not item:
+        served = answers.lookup(engine, question, company, years)
+        if served is not None:
+            return served
+    # Diversify so repeated year-over-year paragraphs cost one QA pass, not five
+    # top_k, candidates and min_words come from the tuned profile (tune_retrieval.py)
+    return engine.answer(question, company=company, diversify=diversify, years=years, item=item,
+                         skip_tables=QA_SEARCH['skip_tables'], **PROFILE['qa'])
 
-def answer_question(question, company=None):
-    chunks = search_chunks(question, top_k=5, company=company)
-    if not chunks:
-        return None, []
-    answers = []
-    for chunk in chunks:
-        ans = qa({'question': question, 'context': chunk['text']})
-        answers.append({
-            'answer': ans['answer'],
-            'score': ans['score'],
-            'context': chunk['text'],
-            'meta': chunk['meta']
-        })
-    answers = sorted(answers, key=lambda x: x['score'], reverse=True)
-    return answers[0], answers
+def answer_question_stream(engine, question, company=None, diversify=True, years=None, answers=None, cancel=None,
+                           item=None):
+    """answer_question as the events of QAEngine.answer_stream; a precomputed answer is a single 'done' event."""
+    if answers is not None and diversify == QA_SEARCH['diversify'] and not item:
+        served = answers.lookup(engine, question, company, years)
+        if served is not None:
+            yield {'type': 'done', 'best': served[0], 'answers': served[1]}
+            return
+    yield from engine.answer_stream(question, company=company, diversify=diversify, years=years, cancel=cancel,
+                                    item=item, skip_tables=QA_SEARCH['skip_tables'], **PROFILE['qa'])
+
+def show_section(request, company=None, years=None):
+    """Print a directly requested section ("show me Item 7 for TSLA 2022") read from the section index."""
+    company = request['company'] or company
+    year = request['year'] or (years[1] if years else None)
+    if not company:
+        print("Name a company to read a section from (e.g. 'show Item 7 for TSLA 2022').")
+        return
+    found = get_section(company, request['item'], year)
+    if found is None:
+        print(f"No Item {request['item']} found for {company} {year or '(latest filing)'}.")
+        return
+    section, text = found
+    print(f"\nItem {section['item']}. {section['title']} | {company} {year or '(latest filing)'} "
+          f"| {len(text):,} characters\n")
+    print(text[:SECTION_PREVIEW])
+    if len(text) > SECTION_PREVIEW:
+        print(f"\n... {len(text) - SECTION_PREVIEW:,} more characters; print it all with "
+              f"python scripts/section_index.py --company {company} --item {section['item']}"
+              f"{f' --year {year}' if year else ''}")
 
 if __name__ == "__main__":
-    print("Loaded index with {} chunks.".format(len(metadata)))
+    parser = argparse.ArgumentParser(description="Extractive Q&A over indexed 10-K chunks.")
+    parser.add_argument('--server', type=str, default=None, help="URL of a running qa_server.py (e.g. http://127.0.0.1:8765)")
+    parser.add_argument('--backend', choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help="Local inference backend: fp32 PyTorch, dynamic int8 or ONNX Runtime")
+    parser.add_argument('--no_diversify', action='store_true', help="Send the raw top-k to QA, duplicates included")
+    parser.add_argument('--years', type=int, nargs=2, metavar=('START', 'END'), default=None,
+                        help="Only search filings for fiscal years START..END (inclusive)")
+    parser.add_argument('--two_stage', nargs='?', const='index_coarse', default=None, metavar='COARSE_DIR',
+                        help="Coarse-to-fine search through section centroids built by coarse_index.py")
+    parser.add_argument('--item', type=str, default=None,
+                        help="Only search this 10-K item, e.g. 7 (MD&A) or 1A (risk factors)")
+    parser.add_argument('--no_materialized', action='store_true', help="Always search + QA, even for catalog questions")
+    parser.add_argument('--no_stream', action='store_true', help="Print only the final answer, not sources and interim answers")
+    parser.add_argument('--profile', action='store_true', help="Profile each question into profiles/ (cProfile, flamegraph, allocations)")
+    args = parser.parse_args()
+
+    engine = get_engine(args.server, args.backend, args.two_stage)
+    answers = None if args.server or args.no_materialized else AnswerStore.open()
+    if args.server:
+        print(f"Using QA server at {args.server}")
+    else:
+        print("Loaded index with {} chunks.".format(len(engine.metadata)))
     company = input("Enter company ticker (e.g., AAPL), or leave blank for all: ").strip().upper()
     if company == "":
         company = None
@@ -58,12 +91,49 @@ if __name__ == "__main__":
         q = input("\nAsk a financial question (or type 'exit'): ")
         if q.lower() == 'exit':
             break
-        best, all_answers = answer_question(q, company=company)
+        request = parse_section_request(q, engine.companies())
+        if request:
+            show_section(request, company=company, years=args.years)
+            continue
+        if args.no_stream:
+            with maybe_profile(args.profile, 'query', q):
+                best, all_answers = answer_question(engine, q, company=company, diversify=not args.no_diversify,
+                                                    years=args.years, answers=answers, item=args.item)
+        else:
+            # Sources print as soon as retrieval returns, then the best answer so far; Ctrl-C cancels the question
+            cancel = threading.Event()
+            events = answer_question_stream(engine, q, company=company, diversify=not args.no_diversify,
+                                            years=args.years, answers=answers, cancel=cancel, item=args.item)
+            best, shown = None, None
+            try:
+                with maybe_profile(args.profile, 'query', q):
+                    for event in events:
+                        if event['type'] == 'sources' and event['chunks']:
+                            print("\nSources: " + "; ".join(f"{c['meta'].get('company')} FY{c['meta'].get('year')} "
+                                                            f"{c['meta'].get('section') or ''}".strip()
+                                                            for c in event['chunks']))
+                        elif event['type'] == 'answer' and event['best']['answer'] != shown:
+                            shown = event['best']['answer']
+                            print(f"  ... {shown} (score: {event['best']['score']:.3f}, "
+                                  f"checked {event['done']}/{event['total']})", flush=True)
+                        elif event['type'] == 'done':
+                            best = event['best']
+            except KeyboardInterrupt:
+                cancel.set()
+                events.close()
+                print("\nCancelled.")
+                continue
         if not best:
             print("No relevant chunks found for this query. Try another question or company.")
             continue
         meta = best['meta']
         print(f"\nBest Answer: {best['answer']} (score: {best['score']:.3f})")
         print(f"Section: {meta.get('section')} | Subheading: {meta.get('subheading')}")
-        print(f"Context: {best['context'][:200].replace('\n', ' ')}...")
-        print(f"Source: {meta['company']} {meta['year']} File: {meta['filename']}\n")
\ No newline at end of file
+        preview = best['context'][:200].replace('\n', ' ')
+        print(f"Context: {preview}...")
+        print(f"Source: {meta['company']} FY{meta['year']} File: {meta['filename']}")
+        if best.get('materialized'):
+            print("(precomputed answer)")
+        if best.get('duplicates'):
+            print("Also in: " + ", ".join(f"{d['company']} {d['year']}" for d in best['duplicates']))
+        print()
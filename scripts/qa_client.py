@@ -0,0 +1,76 @@
+import os
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_URL = os.environ.get('QA_SERVER_URL', 'http://127.0.0.1:8765')
+
+class QAClient:
+    """Thin HTTP client for qa_server.py; mirrors the QAEngine search/answer calls."""
+
+    def __init__(self, url=DEFAULT_URL, timeout=120):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _post(self, path, payload):
+        res = requests.post(f"{self.url}/{path}", json=payload, timeout=self.timeout)
+        if res.status_code == 503:
+            raise RuntimeError("QA server is busy, try again in a moment.")
+        res.raise_for_status()
+        return res.json()
+
+    def companies(self):
+        res = requests.get(f"{self.url}/companies", timeout=self.timeout)
+        res.raise_for_status()
+        return res.json()['companies']
+
+    def health(self):
+        res = requests.get(f"{self.url}/health", timeout=self.timeout)
+        res.raise_for_status()
+        return res.json()
+
+    def reload(self):
+        """Have the server reopen rebuilt shards of a sharded index; returns their names."""
+        res = requests.post(f"{self.url}/reload", timeout=self.timeout)
+        res.raise_for_status()
+        return res.json()['reloaded']
+
+    def years(self):
+        res = requests.get(f"{self.url}/years", timeout=self.timeout)
+        res.raise_for_status()
+        return res.json()['years']
+
+    def search(self, question, top_k=None, company=None, candidates=None, min_words=None, skip_tables=False,
+               diversify=False, group_by_year=False, years=None, item=None):
+        payload = {'question': question, 'company': company, 'top_k': top_k, 'candidates': candidates,
+                   'min_words': min_words,
+                   'skip_tables': skip_tables, 'diversify': diversify, 'group_by_year': group_by_year,
+                   'years': list(years) if years else None, 'item': item}
+        return self._post('search', payload)['chunks']
+
+    def answer(self, question, top_k=None, company=None, candidates=None, min_words=None, skip_tables=False,
+               diversify=False, group_by_year=False, years=None, item=None):
+        payload = {'question': question, 'company': company, 'top_k': top_k, 'candidates': candidates,
+                   'min_words': min_words,
+                   'skip_tables': skip_tables, 'diversify': diversify, 'group_by_year': group_by_year,
+                   'years': list(years) if years else None, 'item': item}
+        result = self._post('answer', payload)
+        return result['best'], result['answers']
+
+    def answer_stream(self, question, cancel=None, **kwargs):
+        """QAEngine.answer_stream over HTTP: sources after the search request, the answer after the QA request."""
+        yield {'type': 'sources', 'chunks': self.search(question, **kwargs)}
+        if cancel is not None and cancel.is_set():
+            return
+        best, answers = self.answer(question, **kwargs)
+        yield {'type': 'done', 'best': best, 'answers': answers}
+
+    def compare(self, question, companies=None, years=None, top_k=3, **kwargs):
+        """Same rows as QAEngine.compare; slices are sent concurrently so the server batches them together."""
+        companies = companies or self.companies()
+        years = sorted(years or self.years(), reverse=True)
+        slices = [(c, y) for y in years for c in companies]
+        with ThreadPoolExecutor(max_workers=min(len(slices), 16) or 1) as pool:
+            results = list(pool.map(lambda s: self.answer(question, top_k=top_k, company=s[0], years=(s[1], s[1]),
+                                                          **kwargs), slices))
+        return [{'company': c, 'year': y, 'best': best, 'answers': answers}
+                for (c, y), (best, answers) in zip(slices, results)]
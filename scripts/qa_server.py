@@ -0,0 +1,241 @@
+import json
+import queue
+import threading
+import time
+import argparse
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from retrieval import QAEngine, INDEX_PATH, META_PATH
+from inference_backends import BACKENDS, DEFAULT_BACKEND
+import tracing
+
+# ----------------- CONFIGURATION -----------------
+HOST = '127.0.0.1'
+PORT = 8765
+MAX_BATCH = 16          # Most requests gathered into one forward pass
+MAX_WAIT_MS = 10        # How long the first request in a batch waits for others
+MAX_QUEUE = 128         # Pending requests before the server answers 503
+REQUEST_TIMEOUT = 120   # Seconds a handler waits for its batch result
+
+class Overloaded(Exception):
+    pass
+
+class MicroBatcher:
+    """
+    Collects requests from many handler threads into short time-window
+    micro-batches and hands each batch to `process_batch` on one worker thread.
+    The queue is bounded: when it is full, submit() raises Overloaded instead
+    of letting latency grow without limit.
+    """
+
+    def __init__(self, process_batch, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS, max_queue=MAX_QUEUE):
+        self.process_batch = process_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, item, timeout=REQUEST_TIMEOUT):
+        future = Future()
+        try:
+            self.queue.put_nowait((item, future))
+        except queue.Full:
+            raise Overloaded()
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            future.cancel()  # Still queued: the worker drops it instead of answering nobody
+            raise
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            # Skip requests whose handler gave up waiting; the rest can no longer be cancelled
+            collected = self._collect()
+            batch = [(item, future) for item, future in collected if future.set_running_or_notify_cancel()]
+            if len(batch) < len(collected):
+                tracing.count('server.expired', len(collected) - len(batch))
+            if not batch:
+                continue
+            try:
+                results = self.process_batch([item for item, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+def _int_or_none(value):
+    return None if value is None else int(value)
+
+def reload_engine(engine, force=False):
+    """Reopen shards of a sharded index that were rebuilt since it was read (all of its manifest with `force`)."""
+    opened = engine.reload() if force else engine.reload_if_changed()
+    if opened:
+        tracing.count('server.reloads')
+        print(f"Reloaded shards: {', '.join(opened)}")
+    return opened
+
+def make_batch_processor(engine, reload_lock):
+    """
+    Every request needs retrieval, so the whole batch is embedded and searched
+    together; the 'answer' requests then share one batched QA call. A rebuilt
+    shard is picked up before the next batch.
+    """
+    def process(items):
+        with reload_lock:
+            reload_engine(engine)
+            with tracing.span('server.batch', items=len(items)):
+                return _process(items)
+
+    def _process(items):
+        hits = engine.search_batch(
+            [it['question'] for it in items],
+            companies=[it.get('company') for it in items],
+            top_k=[it['top_k'] for it in items],  # None = the server's tuned profile
+            candidates=max((it['candidates'] for it in items if it['candidates']), default=None),
+            min_words=[it['min_words'] for it in items],
+            skip_tables=[it.get('skip_tables', False) for it in items],
+            diversify=[it.get('diversify', False) for it in items],
+            group_by_year=[it.get('group_by_year', False) for it in items],
+            years=[it.get('years') for it in items],
+            items=[it.get('item') for it in items],
+        )
+        results = [{'chunks': chunks} for chunks in hits]
+        qa_ids = [i for i, it in enumerate(items) if it['kind'] == 'answer' and hits[i]]
+        if qa_ids:
+            answers = engine.answer_batch([items[i]['question'] for i in qa_ids], [hits[i] for i in qa_ids])
+            for i, ans in zip(qa_ids, answers):
+                results[i] = {'best': ans[0], 'answers': ans}
+        for i, it in enumerate(items):
+            if it['kind'] == 'answer' and not hits[i]:
+                results[i] = {'best': None, 'answers': []}
+        return results
+    return process
+
+def make_handler(engine, batcher, reload_lock):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, payload, headers=None):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send(200, {'status': 'ok', 'chunks': len(engine.metadata), 'queued': batcher.queue.qsize()})
+            elif self.path == '/companies':
+                self._send(200, {'companies': engine.companies()})
+            elif self.path == '/years':
+                self._send(200, {'years': engine.years()})
+            elif self.path == '/metrics':
+                body = tracing.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            kind = self.path.strip('/')
+            if kind == 'reload':
+                with reload_lock:  # Between batches, so no batch sees half-swapped metadata
+                    opened = reload_engine(engine, force=True)
+                self._send(200, {'reloaded': opened, 'chunks': len(engine.metadata)})
+                return
+            if kind not in ('search', 'answer'):
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                question = request['question']
+                years = request.get('years')
+                years = (years[0], years[1]) if years else None
+            except (ValueError, KeyError, TypeError, IndexError):
+                self._send(400, {'error': "expected JSON body with a 'question' field (and 'years': [start, end])"})
+                return
+            item = {
+                'kind': kind,
+                'question': question,
+                'company': request.get('company') or None,
+                'top_k': _int_or_none(request.get('top_k')),
+                'candidates': _int_or_none(request.get('candidates')),
+                'min_words': _int_or_none(request.get('min_words')),
+                'skip_tables': bool(request.get('skip_tables', False)),
+                'diversify': bool(request.get('diversify', False)),
+                'group_by_year': bool(request.get('group_by_year', False)),
+                'years': years,
+                'item': request.get('item') or None,
+            }
+            try:
+                self._send(200, batcher.submit(item))
+            except Overloaded:
+                tracing.count('server.rejected')
+                self._send(503, {'error': 'server busy, retry shortly'}, headers={'Retry-After': '1'})
+            except Exception as e:
+                self._send(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+class QAHTTPServer(ThreadingHTTPServer):
+    """
+    ThreadingHTTPServer with a listen backlog of at least the batcher queue
+    (the default is 5), so a burst is turned away with 503 + Retry-After by
+    the bounded MicroBatcher queue instead of connection resets.
+    """
+
+    def __init__(self, address, handler, backlog=MAX_QUEUE):
+        self.request_queue_size = max(backlog, ThreadingHTTPServer.request_queue_size)
+        super().__init__(address, handler)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve 10-K retrieval and QA from one warm set of models.")
+    parser.add_argument('--host', type=str, default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--index', type=str, default=INDEX_PATH)
+    parser.add_argument('--metadata', type=str, default=META_PATH)
+    parser.add_argument('--max_batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--max_wait_ms', type=float, default=MAX_WAIT_MS)
+    parser.add_argument('--max_queue', type=int, default=MAX_QUEUE)
+    parser.add_argument('--backend', choices=BACKENDS, default=DEFAULT_BACKEND)
+    parser.add_argument('--two_stage', nargs='?', const='index_coarse', default=None, metavar='COARSE_DIR',
+                        help="Coarse-to-fine search through section centroids built by coarse_index.py")
+    args = parser.parse_args()
+
+    engine = QAEngine.load(args.index, args.metadata, backend=args.backend, coarse_dir=args.two_stage)
+    print(f"Loaded index with {len(engine.metadata)} chunks.")
+    reload_lock = threading.Lock()
+    batcher = MicroBatcher(make_batch_processor(engine, reload_lock), args.max_batch, args.max_wait_ms, args.max_queue)
+    server = QAHTTPServer((args.host, args.port), make_handler(engine, batcher, reload_lock), backlog=args.max_queue)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
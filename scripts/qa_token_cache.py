@@ -0,0 +1,201 @@
+import os
+import json
+import shutil
+from itertools import islice
+
+import numpy as np
+
+from index_store import publish_dir
+
+# ----------------- CONFIGURATION -----------------
+TOKEN_CACHE_DIR = "qa_token_cache"
+MAX_SEQ_LEN = 384       # Same windowing as the transformers QA pipeline
+DOC_STRIDE = 128
+MAX_QUESTION_LEN = 64
+MAX_ANSWER_LEN = 15
+
+# ----------------- BUILD -----------------
+
+def build_token_cache(texts, tokenizer_name, out_dir=TOKEN_CACHE_DIR, batch_size=256):
+    """
+    Tokenize every chunk once for the QA model and store input ids and
+    character offset mappings as flat arrays. Row i belongs to FAISS id i;
+    ptr[i]:ptr[i+1] are its tokens. Each batch is appended to raw spill files,
+    then copied block by block into exact-size .npy files, so memory stays at
+    one batch whatever the corpus size.
+    """
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    staging = out_dir.rstrip(os.sep) + '.building'
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    spill = {name: os.path.join(staging, name + '.raw') for name in ('input_ids', 'offsets', 'ptr')}
+    count, tokens = 0, 0
+    texts = iter(texts)  # Any iterable, so a streamed corpus needn't be held in memory
+    with open(spill['input_ids'], 'wb') as ids_file, open(spill['offsets'], 'wb') as offsets_file, \
+            open(spill['ptr'], 'wb') as ptr_file:
+        ptr_file.write(np.zeros(1, dtype=np.int64).tobytes())
+        while True:
+            batch = list(islice(texts, batch_size))
+            if not batch:
+                break
+            enc = tokenizer(batch, add_special_tokens=False, return_offsets_mapping=True)
+            lengths = np.array([len(ids) for ids in enc['input_ids']], dtype=np.int64)
+            ids_file.write(np.concatenate([np.asarray(ids, dtype=np.int32) for ids in enc['input_ids']]).tobytes())
+            offsets_file.write(np.concatenate([np.asarray(offsets, dtype=np.int32).reshape(-1, 2)
+                                               for offsets in enc['offset_mapping']]).tobytes())
+            ptr_file.write((tokens + np.cumsum(lengths)).tobytes())
+            count += len(batch)
+            tokens += int(lengths.sum())
+    _spill_to_npy(spill['input_ids'], os.path.join(staging, 'input_ids.npy'), np.int32, (tokens,))
+    _spill_to_npy(spill['offsets'], os.path.join(staging, 'offsets.npy'), np.int32, (tokens, 2))
+    _spill_to_npy(spill['ptr'], os.path.join(staging, 'ptr.npy'), np.int64, (count + 1,))
+    with open(os.path.join(staging, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'tokenizer': tokenizer_name, 'count': count, 'tokens': tokens}, f, indent=2)
+    publish_dir(staging, out_dir)
+    print(f"Token cache saved to {out_dir}: {count} chunks, {tokens} tokens.")
+
+def _spill_to_npy(raw_path, npy_path, dtype, shape, block_rows=1 << 20):
+    """Copy a raw spill file into a .npy of known shape one block of rows at a time, then delete it."""
+    out = np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=shape)
+    if shape[0]:
+        raw = np.memmap(raw_path, dtype=dtype, mode='r', shape=shape)
+        for b in range(0, shape[0], block_rows):
+            out[b:b + block_rows] = raw[b:b + block_rows]
+        del raw
+    out.flush()
+    del out
+    os.remove(raw_path)
+
+# ----------------- LOAD -----------------
+
+class QATokenCache:
+    """Read-only, memory-mapped view of a token cache built by build_token_cache()."""
+
+    def __init__(self, cache_dir=TOKEN_CACHE_DIR):
+        with open(os.path.join(cache_dir, 'meta.json'), encoding='utf-8') as f:
+            self.info = json.load(f)
+        self.input_ids = np.load(os.path.join(cache_dir, 'input_ids.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(cache_dir, 'offsets.npy'), mmap_mode='r')
+        self.ptr = np.load(os.path.join(cache_dir, 'ptr.npy'))
+
+    def __len__(self):
+        return len(self.ptr) - 1
+
+    def get(self, chunk_id):
+        start, end = self.ptr[chunk_id], self.ptr[chunk_id + 1]
+        return self.input_ids[start:end], self.offsets[start:end]
+
+def load_token_cache(cache_dir=TOKEN_CACHE_DIR, tokenizer_name=None, expected_count=None):
+    """Return the cache if it exists and matches the index/tokenizer, else None."""
+    if not os.path.exists(os.path.join(cache_dir, 'meta.json')):
+        return None
+    cache = QATokenCache(cache_dir)
+    if tokenizer_name and cache.info.get('tokenizer') != tokenizer_name:
+        print(f"Token cache built for {cache.info.get('tokenizer')}, not {tokenizer_name}; ignoring it.")
+        return None
+    if expected_count is not None and len(cache) != expected_count:
+        print(f"Token cache has {len(cache)} chunks but the index has {expected_count}; ignoring it.")
+        return None
+    return cache
+
+# ----------------- QA -----------------
+
+class PretokenizedQA:
+    """
+    Extractive QA over cached chunk tokens. Only the question is tokenized per
+    query; windows, batching and span decoding follow the QA pipeline, and the
+    stored offsets map answer spans back to characters of the chunk text.
+    """
+
+    def __init__(self, model, tokenizer, cache, max_seq_len=MAX_SEQ_LEN, doc_stride=DOC_STRIDE):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.cache = cache
+        self.max_seq_len = max_seq_len
+        self.doc_stride = doc_stride
+
+    def _windows(self, q_ids, ctx_ids):
+        room = self.max_seq_len - len(q_ids) - self.tokenizer.num_special_tokens_to_add(pair=True)
+        starts = list(range(0, max(len(ctx_ids) - room, 0) + 1, max(room - self.doc_stride, 1)))
+        if starts[-1] + room < len(ctx_ids):
+            starts.append(len(ctx_ids) - room)
+        for s in starts:
+            window = [int(t) for t in ctx_ids[s:s + room]]
+            input_ids = self.tokenizer.build_inputs_with_special_tokens(q_ids, window)
+            special = self.tokenizer.get_special_tokens_mask(q_ids, window)
+            # Positions of real tokens; the last len(window) of them are the context
+            positions = [i for i, m in enumerate(special) if not m][len(q_ids):]
+            yield input_ids, positions, s
+
+    def _forward(self, batch):
+        import torch
+        width = max(len(ids) for ids, _, _ in batch)
+        pad = self.tokenizer.pad_token_id or 0
+        input_ids = torch.full((len(batch), width), pad, dtype=torch.long)
+        mask = torch.zeros((len(batch), width), dtype=torch.long)
+        for i, (ids, _, _) in enumerate(batch):
+            input_ids[i, :len(ids)] = torch.tensor(ids)
+            mask[i, :len(ids)] = 1
+        inputs = {'input_ids': input_ids, 'attention_mask': mask}
+        if 'token_type_ids' in self.tokenizer.model_input_names:
+            types = torch.zeros_like(input_ids)
+            for i, (ids, positions, _) in enumerate(batch):
+                if positions:
+                    types[i, positions[0]:len(ids)] = 1
+            inputs['token_type_ids'] = types
+        with torch.no_grad():
+            out = self.model(**inputs)
+        return np.asarray(out.start_logits, dtype=np.float32), np.asarray(out.end_logits, dtype=np.float32)
+
+    def __call__(self, questions, chunk_ids, texts, batch_size=32):
+        """Answer questions[i] from chunk chunk_ids[i] (text texts[i]); one dict per pair."""
+        q_cache = {}
+        jobs = []
+        for pair, (question, cid) in enumerate(zip(questions, chunk_ids)):
+            if question not in q_cache:
+                q_cache[question] = self.tokenizer(question, add_special_tokens=False, truncation=True,
+                                                   max_length=MAX_QUESTION_LEN)['input_ids']
+            ctx_ids, _ = self.cache.get(cid)
+            for input_ids, positions, ctx_start in self._windows(q_cache[question], ctx_ids):
+                jobs.append((pair, input_ids, positions, ctx_start))
+
+        best = [None] * len(questions)
+        for b in range(0, len(jobs), batch_size):
+            chunk = jobs[b:b + batch_size]
+            starts, ends = self._forward([(ids, pos, s) for _, ids, pos, s in chunk])
+            for row, (pair, ids, positions, ctx_start) in enumerate(chunk):
+                span = self._best_span(starts[row, :len(ids)], ends[row, :len(ids)], positions)
+                if span and (best[pair] is None or span[0] > best[pair][0]):
+                    best[pair] = (span[0], ctx_start + span[1], ctx_start + span[2])
+
+        results = []
+        for pair, cid in enumerate(chunk_ids):
+            if best[pair] is None:
+                results.append({'answer': '', 'score': 0.0, 'start': 0, 'end': 0})
+                continue
+            score, tok_s, tok_e = best[pair]
+            _, offsets = self.cache.get(cid)
+            start, end = int(offsets[tok_s][0]), int(offsets[tok_e][1])
+            results.append({'answer': texts[pair][start:end], 'score': float(score), 'start': start, 'end': end})
+        return results
+
+    @staticmethod
+    def _best_span(start_logits, end_logits, positions):
+        """Best (score, ctx_start_tok, ctx_end_tok) restricted to context tokens, like the QA pipeline."""
+        if not positions:
+            return None
+        keep = np.full(len(start_logits), -1e4, dtype=np.float32)
+        keep[positions] = 0.0
+        s = start_logits + keep
+        e = end_logits + keep
+        s = np.exp(s - s.max()); s /= s.sum()
+        e = np.exp(e - e.max()); e /= e.sum()
+        scores = np.triu(np.tril(np.outer(s, e), MAX_ANSWER_LEN - 1))
+        flat = int(np.argmax(scores))
+        i, j = divmod(flat, scores.shape[1])
+        first = positions[0]
+        if i < first or j < first:
+            return None
+        return float(scores[i, j]), i - first, j - first
@@ -0,0 +1,161 @@
+import io
+import os
+import re
+import gzip
+import codecs
+import json
+import hashlib
+import argparse
+
+from tracing import span, count
+
+# ----------------- CONFIGURATION -----------------
+RAW_DIR = 'data/raw/10k_filings'
+HTML_EXTS = ('.htm', '.html')
+CODEC_EXTS = {'.zst': 'zstd', '.gz': 'gzip'}
+CODEC = os.environ.get('FDI_RAW_CODEC', 'zstd')  # Falls back to gzip when zstandard isn't installed
+ZSTD_LEVEL = 10        # Written once, read many times: spend a little more at download for smaller files
+GZIP_LEVEL = 9
+TEXT_BLOCK = 1 << 20   # Characters handed to the HTML parser at a time
+SNIFF_BYTES = 4096     # Leading bytes searched for a <meta charset>
+CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+
+def _zstd():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+def codec():
+    return 'zstd' if CODEC == 'zstd' and _zstd() is not None else 'gzip'
+
+# ----------------- NAMES -----------------
+
+def raw_name(accession, html_ext='.htm'):
+    """File name for a newly stored filing, e.g. 000032019323000106.htm.zst."""
+    return accession + html_ext + ('.zst' if codec() == 'zstd' else '.gz')
+
+def split_raw_name(fname):
+    """(accession, '.htm'/'.html', codec or None) for a raw filing file name, or None for anything else."""
+    base, ext = os.path.splitext(fname)
+    file_codec = CODEC_EXTS.get(ext)
+    if file_codec:
+        base, ext = os.path.splitext(base)
+    if ext not in HTML_EXTS:
+        return None
+    return base, ext, file_codec
+
+def find_raw(folder, accession):
+    """Path of a stored filing, preferring the compressed copy over a legacy uncompressed one."""
+    for suffix in ('.zst', '.gz', ''):
+        for ext in HTML_EXTS:
+            path = os.path.join(folder, accession + ext + suffix)
+            if os.path.exists(path):
+                return path
+    return None
+
+# ----------------- WRITE -----------------
+
+def write_raw(path, data, encoding=None):
+    """
+    Store the response bytes exactly as received, compressed by the codec
+    `path` names (.zst/.gz). A <path>.json sidecar keeps the charset the
+    server declared (None if it didn't), the size and a SHA-256 of the bytes.
+    """
+    file_codec = CODEC_EXTS.get(os.path.splitext(path)[1])
+    with span('raw_write', file=path, bytes=len(data)) as sp:
+        if file_codec == 'zstd':
+            packed = _zstd().ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+        elif file_codec == 'gzip':
+            packed = gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+        else:
+            packed = data
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(packed)
+        os.replace(tmp, path)
+        info = {'encoding': encoding, 'codec': file_codec, 'size': len(data), 'stored': len(packed),
+                'sha256': hashlib.sha256(data).hexdigest()}
+        with open(path + '.json', 'w', encoding='utf-8') as f:
+            json.dump(info, f)
+        sp['bytes_out'] = len(packed)
+    return info
+
+# ----------------- READ -----------------
+
+def open_raw(path):
+    """Binary stream of the original bytes, decompressed as it is read."""
+    file_codec = CODEC_EXTS.get(os.path.splitext(path)[1])
+    if file_codec == 'zstd':
+        return _zstd().ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    if file_codec == 'gzip':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def raw_encoding(path):
+    """Charset to decode with: the server's declared one, else the page's <meta charset>, else UTF-8."""
+    if os.path.exists(path + '.json'):
+        with open(path + '.json', encoding='utf-8') as f:
+            declared = json.load(f).get('encoding')
+        if declared:
+            return declared
+    with open_raw(path) as f:
+        m = CHARSET_RE.search(f.read(SNIFF_BYTES))
+    if m:
+        name = m.group(1).decode('ascii', 'ignore')
+        try:
+            return codecs.lookup(name).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+def iter_text(path, block=TEXT_BLOCK):
+    """Decoded text of a stored filing in blocks; never holds the whole file in memory."""
+    with open_raw(path) as raw:
+        text = io.TextIOWrapper(raw, encoding=raw_encoding(path), errors='replace', newline='')
+        while True:
+            chunk = text.read(block)
+            if not chunk:
+                break
+            yield chunk
+
+# ----------------- MIGRATION -----------------
+
+def compress_existing(raw_dir=RAW_DIR, keep=False):
+    """Compress legacy uncompressed .htm/.html filings in place. They were saved as UTF-8 text."""
+    before = after = 0
+    for ticker in sorted(os.listdir(raw_dir)):
+        folder = os.path.join(raw_dir, ticker)
+        if not os.path.isdir(folder):
+            continue
+        for fname in sorted(os.listdir(folder)):
+            parsed = split_raw_name(fname)
+            if not parsed or parsed[2] is not None:
+                continue
+            path = os.path.join(folder, fname)
+            with open(path, 'rb') as f:
+                data = f.read()
+            target = os.path.join(folder, raw_name(parsed[0], parsed[1]))
+            info = write_raw(target, data, encoding='utf-8')
+            with open_raw(target) as f:
+                if hashlib.sha256(f.read()).hexdigest() != info['sha256']:
+                    raise RuntimeError(f"round trip failed for {target}")
+            if not keep:
+                os.remove(path)
+            before += info['size']
+            after += info['stored']
+            count('raw.compressed')
+            print(f"{path} -> {target} ({info['size'] / max(info['stored'], 1):.1f}x)")
+    return before, after
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compress raw filings already on disk (zstd, or gzip without zstandard).")
+    parser.add_argument('--raw_dir', type=str, default=RAW_DIR)
+    parser.add_argument('--keep', action='store_true', help="Keep the uncompressed originals")
+    args = parser.parse_args()
+    before, after = compress_existing(args.raw_dir, keep=args.keep)
+    if before:
+        print(f"{before / 1e6:.1f} MB -> {after / 1e6:.1f} MB ({before / after:.1f}x smaller) with {codec()}")
+    else:
+        print("Nothing to compress.")
@@ -0,0 +1,408 @@
+import os
+import time
+import json
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+import inference_backends
+import index_store
+import tracing
+from inference_backends import DEFAULT_BACKEND
+from qa_token_cache import TOKEN_CACHE_DIR, PretokenizedQA, load_token_cache
+from retrieval_profile import PROFILE, apply_index_profile
+from section_index import item_key
+
+# ----------------- CONFIGURATION -----------------
+FAISS_INDEX_PATH = "faiss_index.bin"
+# Prefer the memory-mapped index when it has been built (see index_store.py), unless
+# `embed_chunks.py --stream --nlist` built an IVF index with on-disk lists next to it
+if os.path.isdir(index_store.MMAP_INDEX_DIR) and not os.path.exists(index_store.ivfdata_path(FAISS_INDEX_PATH)):
+    INDEX_PATH = index_store.MMAP_INDEX_DIR
+else:
+    INDEX_PATH = FAISS_INDEX_PATH
+# Pickle from the in-memory build, JSON lines from the streaming build: use whichever is newer
+META_PATH = max((p for p in ("chunk_metadata.pkl", "chunk_metadata.jsonl") if os.path.exists(p)),
+                key=os.path.getmtime, default="chunk_metadata.pkl")
+EMBED_MODEL = 'all-MiniLM-L6-v2'
+QA_MODEL = 'distilbert-base-cased-distilled-squad'
+
+# ----------------- ASSET LOADING -----------------
+
+def load_index(path=INDEX_PATH):
+    return index_store.load_index(path)
+
+def load_metadata(path=META_PATH):
+    if path.endswith('.jsonl'):
+        with open(path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def load_embedder(model_name=EMBED_MODEL, backend=DEFAULT_BACKEND):
+    return inference_backends.load_embedder(model_name, backend)
+
+def load_qa(model_name=QA_MODEL, backend=DEFAULT_BACKEND):
+    return inference_backends.load_qa(model_name, backend)
+
+# ----------------- DIVERSIFICATION -----------------
+MMR_LAMBDA = 0.7          # 1.0 = pure relevance, lower = more diverse
+DUPLICATE_SIMILARITY = 0.95  # cosine above which two chunks count as the same passage
+SEARCH_WORKERS = min(8, os.cpu_count() or 4)  # Parallel filtered searches (one per company/year slice)
+
+def get_vectors(index, ids):
+    """Stored embeddings for the given FAISS ids."""
+    ids = np.asarray(ids, dtype='int64')
+    if hasattr(index, 'reconstruct_batch'):
+        return np.asarray(index.reconstruct_batch(ids), dtype='float32')
+    return np.vstack([index.reconstruct(int(i)) for i in ids]).astype('float32')
+
+def mmr_select(query_emb, cand_embs, top_k, lambda_=MMR_LAMBDA, dup_threshold=DUPLICATE_SIMILARITY):
+    """
+    Maximal marginal relevance over a candidate pool. Returns
+    [(candidate_idx, [near-duplicate candidate idxs])] in selection order;
+    near-duplicates of a selected candidate are collapsed into it.
+    """
+    c = cand_embs / np.clip(np.linalg.norm(cand_embs, axis=1, keepdims=True), 1e-12, None)
+    q = query_emb / max(np.linalg.norm(query_emb), 1e-12)
+    relevance = c @ q
+    sim = c @ c.T
+    remaining = np.ones(len(c), dtype=bool)
+    max_sim = np.zeros(len(c), dtype='float32')  # similarity to the closest selected candidate
+    selected = []
+    while remaining.any() and len(selected) < top_k:
+        penalty = max_sim if selected else 0.0
+        scores = np.where(remaining, lambda_ * relevance - (1 - lambda_) * penalty, -np.inf)
+        best = int(np.argmax(scores))
+        dups = np.flatnonzero(remaining & (sim[best] >= dup_threshold))
+        dups = [int(j) for j in dups if j != best]
+        remaining[best] = False
+        remaining[dups] = False
+        max_sim = sim[best] if not selected else np.maximum(max_sim, sim[best])
+        selected.append((best, dups))
+    return selected
+
+def _provenance(meta, idx, similarity):
+    return {'id': int(idx), 'company': meta.get('company'), 'year': meta.get('year'),
+            'filename': meta.get('filename'), 'section': meta.get('section'),
+            'similarity': round(float(similarity), 4)}
+
+# ----------------- SEARCH & QA -----------------
+
+def _per_question(value, n):
+    return list(value) if isinstance(value, (list, tuple)) else [value] * n
+
+def _per_question_years(years, n):
+    """One (start, end) fiscal-year range, or a list of ranges/None with one per question."""
+    if years is None or all(y is None for y in years):
+        return [None] * n
+    if all(y is None or isinstance(y, (list, tuple)) for y in years):
+        return [tuple(y) if y is not None else None for y in years]
+    return [tuple(years)] * n
+
+def filing_year(meta):
+    """Fiscal year of a chunk's filing (catalog field, with the chunker's label as fallback)."""
+    year = meta.get('fiscal_year') or meta.get('year')
+    return int(year) if year else None
+
+def in_years(meta, years):
+    """True if the chunk's fiscal year lies in the inclusive (start, end) range; either end may be None."""
+    if not years:
+        return True
+    start, end = years
+    year = filing_year(meta)
+    if year is None:
+        return False
+    return (start is None or year >= int(start)) and (end is None or year <= int(end))
+
+@contextmanager
+def _stage(timings, stage, **attrs):
+    """Emit a 'query.<stage>' span and, if a timings dict is given, add the seconds to timings[stage]."""
+    start = time.perf_counter()
+    with tracing.span('query.' + stage, **attrs) as fields:
+        yield fields
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+class QAEngine:
+    """
+    Holds the FAISS index, chunk metadata and models for one process and
+    answers questions in batches, so callers can share a single warm copy.
+    """
+
+    def __init__(self, index, metadata, embedder, qa=None, token_cache=None):
+        self.index = index
+        self.metadata = metadata
+        self.embedder = embedder
+        self.qa = qa
+        self._filter_ids = {}  # (company, years, item) -> ids of matching chunks, for up-front restriction
+        self._search_pool = None
+        self.pretokenized_qa = None
+        if qa is not None and token_cache is not None:
+            # With a token cache, QA only tokenizes the question (see qa_token_cache.py)
+            self.pretokenized_qa = PretokenizedQA(qa.model, qa.tokenizer, token_cache)
+
+    @classmethod
+    def load(cls, index_path=INDEX_PATH, meta_path=META_PATH, with_qa=True, backend=DEFAULT_BACKEND,
+             token_cache_dir=TOKEN_CACHE_DIR, coarse_dir=None):
+        index = load_index(index_path)
+        qa = load_qa(backend=backend) if with_qa else None
+        if hasattr(index, 'shards'):
+            # A sharded index carries its own metadata and per-shard token caches
+            metadata, token_cache = index.metadata, index.token_cache() if with_qa else None
+        else:
+            metadata = load_metadata(meta_path)
+            token_cache = load_token_cache(token_cache_dir, QA_MODEL, index.ntotal) if with_qa else None
+        if coarse_dir:
+            # Coarse-to-fine: section centroids pick which chunks get scored (see coarse_index.py)
+            from coarse_index import TwoStageIndex
+            index = TwoStageIndex(apply_index_profile(index, PROFILE), coarse_dir)
+        # Tuned nprobe / n_sections, if the index has them (see tune_retrieval.py)
+        return cls(apply_index_profile(index, PROFILE), metadata, load_embedder(backend=backend), qa, token_cache)
+
+    def reload(self):
+        """Re-open rebuilt shards of a sharded index and pick up their metadata and token caches."""
+        if not hasattr(self.index, 'reload'):
+            return []
+        opened = self.index.reload()
+        self.metadata = self.index.metadata
+        self._filter_ids = {}
+        if self.qa is not None:
+            cache = self.index.token_cache()
+            self.pretokenized_qa = PretokenizedQA(self.qa.model, self.qa.tokenizer, cache) if cache else None
+        return opened
+
+    def reload_if_changed(self):
+        """reload() if the sharded index's manifest was swapped since it was read; [] otherwise."""
+        if hasattr(self.index, 'changed') and self.index.changed():
+            return self.reload()
+        return []
+
+    def companies(self):
+        return sorted(set(m['company'] for m in self.metadata))
+
+    def years(self):
+        return sorted(set(y for y in (filing_year(m) for m in self.metadata) if y))
+
+    def filter_ids(self, company=None, years=None, item=None):
+        """Ids of chunks from this company, fiscal-year range and 10-K ITEM (None = no restriction)."""
+        if not company and not years and not item:
+            return None
+        key = (company.lower() if company else None, tuple(years) if years else None, item)
+        if key not in self._filter_ids:
+            self._filter_ids[key] = np.asarray(
+                [i for i, m in enumerate(self.metadata)
+                 if (not company or m['company'].lower() == key[0]) and in_years(m, years)
+                 and (not item or m.get('item') == item)], dtype='int64')
+        return self._filter_ids[key]
+
+    def _search(self, q_embs, k, companies, years, items=None):
+        """Index search restricted up front to each question's company, year range and item."""
+        items = items or [None] * len(q_embs)
+        if getattr(self.index, 'supports_where', False) and not any(items):
+            # Sharded index: only search the shards that can match
+            wheres = [{'company': c, 'years': y} if c or y else None for c, y in zip(companies, years)]
+            return self.index.search(q_embs, k, where=wheres)
+        groups = {}
+        for i, key in enumerate(zip(companies, years, items)):
+            groups.setdefault(key, []).append(i)
+        if list(groups) == [(None, None, None)]:
+            return self.index.search(q_embs, k)
+        D = np.full((len(q_embs), k), np.inf, dtype='float32')
+        I = np.full((len(q_embs), k), -1, dtype='int64')
+
+        def search_group(group):
+            (company, yrs, item), rows = group
+            ids = self.filter_ids(company, yrs, item)
+            if ids is None:
+                return rows, self.index.search(q_embs[rows], k)
+            if len(ids):
+                return rows, index_store.search_subset(self.index, q_embs[rows], k, ids)
+            return rows, None
+
+        if len(groups) == 1:
+            results = map(search_group, groups.items())
+        else:
+            # Different filters can't share one search call; run them side by side (numpy/FAISS release the GIL)
+            if self._search_pool is None:
+                self._search_pool = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+            results = self._search_pool.map(search_group, groups.items())
+        for rows, found in results:
+            if found is not None:
+                D[rows], I[rows] = found
+        return D, I
+
+    def filter_hits(self, ids, top_k=5, company=None, min_words=10, skip_tables=False, years=None, item=None):
+        """Walk FAISS hits in rank order and keep the first top_k usable chunks (all if top_k is None)."""
+        results = []
+        for idx in ids:
+            if idx < 0:
+                continue
+            meta = self.metadata[idx]
+            if company and meta['company'].lower() != company.lower():
+                continue
+            if not in_years(meta, years):
+                continue
+            if item and meta.get('item') != item:
+                continue
+            if skip_tables and meta.get('type') == 'table':
+                continue
+            if len(meta['text'].split()) < min_words:
+                continue
+            results.append({'id': int(idx), 'text': meta['text'], 'meta': meta})
+            if top_k is not None and len(results) >= top_k:
+                break
+        return results
+
+    def diversify(self, query_emb, hits, top_k=5, group_by_year=False,
+                  lambda_=MMR_LAMBDA, dup_threshold=DUPLICATE_SIMILARITY):
+        """
+        Pick top_k hits by MMR on their stored embeddings. Near-duplicates
+        (e.g. the same paragraph repeated in later 10-Ks) are folded into the
+        kept hit under 'duplicates' so their provenance is not lost.
+        With group_by_year the result is ordered by filing year, newest first.
+        """
+        if len(hits) <= 1:
+            return hits[:top_k]
+        embs = get_vectors(self.index, [h['id'] for h in hits])
+        c = embs / np.clip(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12, None)
+        results = []
+        for rank, (i, dups) in enumerate(mmr_select(query_emb, embs, top_k, lambda_, dup_threshold)):
+            hit = dict(hits[i], rank=rank)
+            hit['duplicates'] = [_provenance(hits[j]['meta'], hits[j]['id'], c[i] @ c[j]) for j in dups]
+            results.append(hit)
+        if group_by_year:
+            results.sort(key=lambda h: (-int(h['meta'].get('year') or 0), h['rank']))
+        return results
+
+    def search_batch(self, questions, companies=None, top_k=None, candidates=None, min_words=None, skip_tables=False,
+                     diversify=False, group_by_year=False, timings=None, years=None, items=None):
+        """
+        Encode all questions in one forward pass and search them with a single
+        index.search call. `companies`, `top_k`, `min_words`, `skip_tables`,
+        `diversify` and `group_by_year` may be per-question lists; top_k,
+        candidates and min_words left as None come from the tuned profile. `years` is an inclusive
+        (start, end) fiscal-year range, or a list with one per question; like
+        the company it restricts the index search itself, not just the hits.
+        `items` (a 10-K ITEM such as '7' or '1A', or one per question) does the
+        same for sections: only that item's chunks are scored.
+        If `timings` is a dict, seconds spent in encode/search/filter are added to it.
+        """
+        if not questions:
+            return []
+        n = len(questions)
+        companies = _per_question(companies, n)
+        tuned = PROFILE['qa']
+        top_ks = [tuned['top_k'] if k is None else k for k in _per_question(top_k, n)]
+        min_words = [tuned['min_words'] if w is None else w for w in _per_question(min_words, n)]
+        candidates = candidates or tuned['candidates']
+        skips = _per_question(skip_tables, n)
+        diversifies = _per_question(diversify, n)
+        groupings = _per_question(group_by_year, n)
+        year_ranges = _per_question_years(years, n)
+        items = [item_key(i) for i in _per_question(items, n)]
+        with _stage(timings, 'encode', items=n):
+            # Encode each distinct question once (comparisons repeat one question per slice)
+            unique = list(dict.fromkeys(questions))
+            embs = np.asarray(self.embedder.encode(unique), dtype='float32')
+            q_embs = embs[[unique.index(q) for q in questions]]
+        with _stage(timings, 'search', items=n, candidates=candidates):
+            D, I = self._search(q_embs, candidates, companies, year_ranges, items)
+        with _stage(timings, 'filter', items=n) as fields:
+            results = []
+            for i in range(n):
+                if diversifies[i]:
+                    # Diversify over the whole filtered candidate pool, not just the first top_k
+                    pool = self.filter_hits(I[i], top_k=None, company=companies[i], min_words=min_words[i],
+                                            skip_tables=skips[i], years=year_ranges[i], item=items[i])
+                    results.append(self.diversify(q_embs[i], pool, top_ks[i], group_by_year=groupings[i]))
+                else:
+                    results.append(self.filter_hits(I[i], top_k=top_ks[i], company=companies[i],
+                                                    min_words=min_words[i], skip_tables=skips[i],
+                                                    years=year_ranges[i], item=items[i]))
+            fields['kept'] = sum(len(r) for r in results)
+        return results
+
+    def search(self, question, top_k=None, company=None, years=None, item=None, **kwargs):
+        return self.search_batch([question], companies=[company], top_k=top_k, years=[years], items=[item],
+                                 **kwargs)[0]
+
+    def answer_batch(self, questions, chunk_lists, timings=None):
+        """
+        Run QA over every (question, chunk) pair in one pipeline call and
+        return the answers for each question sorted by score.
+        """
+        pairs = [(qi, chunk) for qi, chunks in enumerate(chunk_lists) for chunk in chunks]
+        answers = [[] for _ in questions]
+        if not pairs:
+            return answers
+        with _stage(timings, 'qa', items=len(pairs)) as fields:
+            if self.pretokenized_qa is not None and all('id' in chunk for _, chunk in pairs):
+                fields['token_cache'] = True
+                tracing.count('qa.token_cache_hits', len(pairs))
+                outputs = self.pretokenized_qa([questions[qi] for qi, _ in pairs],
+                                               [chunk['id'] for _, chunk in pairs],
+                                               [chunk['text'] for _, chunk in pairs])
+            else:
+                tracing.count('qa.token_cache_misses', len(pairs))
+                inputs = [{'question': questions[qi], 'context': chunk['text']} for qi, chunk in pairs]
+                outputs = self.qa(inputs, batch_size=min(len(inputs), 32))
+                if isinstance(outputs, dict):
+                    outputs = [outputs]
+        for (qi, chunk), ans in zip(pairs, outputs):
+            answers[qi].append({
+                'answer': ans['answer'],
+                'score': ans['score'],
+                'start': ans['start'],  # character offsets into the chunk text
+                'end': ans['end'],
+                'context': chunk['text'],
+                'meta': chunk['meta'],
+                'duplicates': chunk.get('duplicates', [])
+            })
+        return [sorted(a, key=lambda x: x['score'], reverse=True) for a in answers]
+
+    def compare(self, question, companies=None, years=None, top_k=3, timings=None, item=None, **kwargs):
+        """
+        Ask one question of every company x fiscal-year filing. The slices are
+        searched together (one encode, parallel filtered searches) and share one
+        batched QA call. Returns one row per slice, newest year first:
+        {'company', 'year', 'best', 'answers'}; 'best' is None if nothing matched.
+        """
+        companies = companies or self.companies()
+        years = sorted(years or self.years(), reverse=True)
+        slices = [(c, y) for y in years for c in companies]
+        hits = self.search_batch([question] * len(slices), companies=[c for c, _ in slices],
+                                 years=[(y, y) for _, y in slices], top_k=top_k, timings=timings, items=item, **kwargs)
+        answers = self.answer_batch([question] * len(slices), hits, timings=timings)
+        return [{'company': c, 'year': y, 'best': a[0] if a else None, 'answers': a}
+                for (c, y), a in zip(slices, answers)]
+
+    def answer(self, question, top_k=None, company=None, timings=None, **kwargs):
+        chunks = self.search(question, top_k=top_k, company=company, timings=timings, **kwargs)
+        if not chunks:
+            return None, []
+        answers = self.answer_batch([question], [chunks], timings=timings)[0]
+        return answers[0], answers
+
+    def answer_stream(self, question, top_k=None, company=None, timings=None, cancel=None, **kwargs):
+        """
+        answer() as a stream of events for progressive display:
+        {'type': 'sources', 'chunks'} as soon as retrieval returns, then
+        {'type': 'answer', 'best', 'answers', 'done', 'total'} after each
+        candidate's QA pass, then {'type': 'done', 'best', 'answers'}.
+        Stops before the next QA pass if `cancel` (a threading.Event) is set
+        or the consumer closes the generator.
+        """
+        chunks = self.search(question, top_k=top_k, company=company, timings=timings, **kwargs)
+        yield {'type': 'sources', 'chunks': chunks}
+        answers = []
+        for i, chunk in enumerate(chunks):
+            if cancel is not None and cancel.is_set():
+                tracing.count('query.cancelled')
+                return
+            answers = sorted(answers + self.answer_batch([question], [[chunk]], timings=timings)[0],
+                             key=lambda x: x['score'], reverse=True)
+            yield {'type': 'answer', 'best': answers[0], 'answers': answers, 'done': i + 1, 'total': len(chunks)}
+        yield {'type': 'done', 'best': answers[0] if answers else None, 'answers': answers}
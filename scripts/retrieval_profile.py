@@ -0,0 +1,46 @@
+import os
+import copy
+import json
+
+# ----------------- CONFIGURATION -----------------
+# Written by tune_retrieval.py; read once at startup by the app, CLIs, server and chunker
+PROFILE_PATH = os.environ.get('FDI_RETRIEVAL_PROFILE', 'retrieval_profile.json')
+DEFAULT_PROFILE = {
+    'qa': {'candidates': 20, 'top_k': 5, 'min_words': 10},         # Extractive QA (app, qa-answer, server)
+    'summarize': {'candidates': 15, 'top_k': 3, 'min_words': 10},  # retrieve_and_answer.py
+    'index': {'nprobe': None, 'n_sections': None},                 # Approximate-search knobs, when present
+    'chunking': {'max_paragraph_len': 800, 'min_chunk_words': 8},  # Needs a re-chunk + re-embed to take effect
+}
+# Retrieval for extractive QA in the app, qa-answer.py and compare_filings.py; answer_store.py
+# materializes with the same settings so a precomputed answer is one the live path would give
+QA_SEARCH = {'diversify': True, 'skip_tables': True}
+
+def load_profile(path=PROFILE_PATH):
+    """Defaults overlaid with the tuned profile, if one has been written."""
+    profile = copy.deepcopy(DEFAULT_PROFILE)
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            tuned = json.load(f)
+        for section, values in tuned.items():
+            if section in profile and isinstance(values, dict):
+                profile[section].update({k: v for k, v in values.items() if k in profile[section]})
+            else:
+                profile[section] = values  # Tuning metadata (target, metrics, ...)
+    return profile
+
+def save_profile(profile, path=PROFILE_PATH):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp, path)
+
+def apply_index_profile(index, profile):
+    """Set nprobe (FAISS IVF) / n_sections (two-stage search) from the profile where the index has them."""
+    knobs = profile['index']
+    if knobs.get('nprobe') and hasattr(index, 'nprobe'):
+        index.nprobe = int(knobs['nprobe'])
+    if knobs.get('n_sections') and hasattr(index, 'n_sections'):
+        index.n_sections = int(knobs['n_sections'])
+    return index
+
+PROFILE = load_profile()
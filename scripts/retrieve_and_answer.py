@@ -1,52 +1,73 @@
-import faiss
-import pickle
-from sentence_transformers import SentenceTransformer
-from transformers import pipeline
+import argparse
+import threading
 
-INDEX_PATH = "faiss_index.bin"
-META_PATH = "chunk_metadata.pkl"
+from retrieval import QAEngine, INDEX_PATH, META_PATH
+from retrieval_profile import PROFILE
+from inference_backends import BACKENDS, DEFAULT_BACKEND
+from profiling import maybe_profile
+from summarize import SUMMARIZERS, load_summarizer, map_reduce_summarize, single_pass_summarize, stream_summarize
 
-# Load index and metadata
-index = faiss.read_index(INDEX_PATH)
-with open(META_PATH, 'rb') as f:
-    metadata = pickle.load(f)
+def get_engine(server=None, backend=DEFAULT_BACKEND, coarse_dir=None):
+    """Search through a running qa_server.py when given its URL, otherwise locally."""
+    if server:
+        from qa_client import QAClient
+        return QAClient(server)
+    return QAEngine.load(INDEX_PATH, META_PATH, with_qa=False, backend=backend, coarse_dir=coarse_dir)
 
-embedder = SentenceTransformer('all-MiniLM-L6-v2')
-summarizer = pipeline('summarization', model='facebook/bart-large-cnn')
-
-def search_chunks(question, top_k=3, company=None):
-    q_emb = embedder.encode([question])
-    D, I = index.search(q_emb, 15)
-    results = []
-    count = 0
-    for idx in I[0]:
-        meta = metadata[idx]
-        if company and meta['company'].lower() != company.lower():
-            continue
-        if len(meta['text'].split()) < 10:
-            continue
-        text = meta['text']
-        results.append({'text': text, 'meta': meta})
-        count += 1
-        if count >= top_k:
-            break
-    return results
-
-def answer_question(question, company=None):
-    # Retrieve top relevant chunks
-    chunks = search_chunks(question, top_k=3, company=company)
+def answer_question(engine, summarizer, question, company=None, mode='mapreduce', diversify=True, years=None):
+    # Retrieve top relevant chunks, folding repeated year-over-year paragraphs together
+    chunks = engine.search(question, company=company, diversify=diversify, years=years, **PROFILE['summarize'])
     if not chunks:
         return None, []
-    # Concatenate context from all retrieved chunks
-    context = "\n\n".join(chunk['text'] for chunk in chunks)
-    # BART has a max token limit; trim if needed (usually ~3500 chars is safe)
-    context = context[:3500]
-    prompt = f"Question: {question}\nContext: {context}"
-    summary = summarizer(prompt, max_length=200, min_length=50, do_sample=False)[0]['summary_text']
+    texts = [chunk['text'] for chunk in chunks]
+    if mode == 'single':
+        summary = single_pass_summarize(question, texts, summarizer)
+    else:
+        # Token-budgeted map-reduce: every retrieved chunk reaches the summariser
+        summary = map_reduce_summarize(question, texts, summarizer)
     return summary, chunks
 
+def answer_question_stream(engine, summarizer, question, company=None, mode='mapreduce', diversify=True, years=None,
+                           cancel=None):
+    """
+    answer_question as events: {'type': 'sources', 'chunks'} once retrieval
+    returns, {'type': 'token', 'text'} as the summary is generated, then
+    {'type': 'done', 'summary', 'chunks'}.
+    """
+    chunks = engine.search(question, company=company, diversify=diversify, years=years, **PROFILE['summarize'])
+    yield {'type': 'sources', 'chunks': chunks}
+    parts = []
+    if chunks:
+        for text in stream_summarize(question, [chunk['text'] for chunk in chunks], summarizer, mode=mode, cancel=cancel):
+            parts.append(text)
+            yield {'type': 'token', 'text': text}
+    yield {'type': 'done', 'summary': ''.join(parts) or None, 'chunks': chunks}
+
 if __name__ == "__main__":
-    print("Loaded index with {} chunks.".format(len(metadata)))
+    parser = argparse.ArgumentParser(description="Retrieve 10-K chunks and summarise an answer.")
+    parser.add_argument('--server', type=str, default=None, help="URL of a running qa_server.py (e.g. http://127.0.0.1:8765)")
+    parser.add_argument('--mode', choices=['mapreduce', 'single'], default='mapreduce',
+                        help="mapreduce: summarise chunk groups in parallel then reduce; single: one pass")
+    parser.add_argument('--summarizer', type=str, default='bart',
+                        help=f"One of {sorted(SUMMARIZERS)} or a Hugging Face model name")
+    parser.add_argument('--backend', choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help="Local inference backend: fp32 PyTorch, dynamic int8 or ONNX Runtime")
+    parser.add_argument('--no_diversify', action='store_true', help="Summarise the raw top-k, duplicates included")
+    parser.add_argument('--years', type=int, nargs=2, metavar=('START', 'END'), default=None,
+                        help="Only search filings for fiscal years START..END (inclusive)")
+    parser.add_argument('--two_stage', nargs='?', const='index_coarse', default=None, metavar='COARSE_DIR',
+                        help="Coarse-to-fine search through section centroids built by coarse_index.py")
+    parser.add_argument('--no_stream', action='store_true',
+                        help="Print the summary only when it is complete (beam search instead of streamed greedy decoding)")
+    parser.add_argument('--profile', action='store_true', help="Profile each question into profiles/ (cProfile, flamegraph, allocations)")
+    args = parser.parse_args()
+
+    engine = get_engine(args.server, args.backend, args.two_stage)
+    summarizer = load_summarizer(args.summarizer)
+    if args.server:
+        print(f"Using QA server at {args.server}")
+    else:
+        print("Loaded index with {} chunks.".format(len(engine.metadata)))
     company = input("Enter company ticker (e.g., AAPL), or leave blank for all: ").strip().upper()
     if company == "":
         company = None
@@ -55,13 +76,43 @@ if __name__ == "__main__":
         q = input("\nAsk a financial question (or type 'exit'): ")
         if q.lower() == 'exit':
             break
-        answer, used_chunks = answer_question(q, company=company)
+        if args.no_stream:
+            with maybe_profile(args.profile, 'query', q):
+                answer, used_chunks = answer_question(engine, summarizer, q, company=company, mode=args.mode,
+                                                     diversify=not args.no_diversify, years=args.years)
+            if answer:
+                print(f"\nGenerated Answer: {answer}\n")
+        else:
+            # Sources print as soon as retrieval returns, then the summary as it is generated; Ctrl-C cancels
+            cancel = threading.Event()
+            answer, used_chunks = None, []
+            try:
+                with maybe_profile(args.profile, 'query', q):
+                    for event in answer_question_stream(engine, summarizer, q, company=company, mode=args.mode,
+                                                        diversify=not args.no_diversify, years=args.years,
+                                                        cancel=cancel):
+                        if event['type'] == 'sources' and event['chunks']:
+                            print("\nSources: " + "; ".join(f"{c['meta'].get('company')} {c['meta'].get('year')} "
+                                                            f"{c['meta'].get('section') or ''}".strip()
+                                                            for c in event['chunks']))
+                        elif event['type'] == 'token':
+                            # Headed on the first token, so a truncation warning prints on its own line
+                            if answer is None:
+                                print("\nGenerated Answer: ", end='', flush=True)
+                                answer = ''
+                            print(event['text'], end='', flush=True)
+                        elif event['type'] == 'done':
+                            answer, used_chunks = event['summary'], event['chunks']
+            except KeyboardInterrupt:
+                cancel.set()
+                print("\nCancelled.")
+                continue
+            print("\n")
         if not answer:
             print("No relevant chunks found for this query. Try another question or company.")
             continue
         # Display a preview of the most relevant chunk for context info
         best_chunk = used_chunks[0]['meta'] if used_chunks else {}
-        print(f"\nGenerated Answer: {answer}\n")
         if used_chunks:
             print(f"Top Context Section: {best_chunk.get('section')} | Subheading: {best_chunk.get('subheading')}")
             print(f"File: {best_chunk.get('company')} {best_chunk.get('year')} - {best_chunk.get('filename')}\n")
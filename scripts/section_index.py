@@ -0,0 +1,255 @@
+import os
+import re
+import json
+import mmap
+import bisect
+import argparse
+
+from filing_catalog import TEXT_DIR, load_catalog
+from tracing import span, count
+
+# ----------------- CONFIGURATION -----------------
+SECTIONS_SUFFIX = '.sections.json'  # Written next to each processed <accession>.txt
+MAX_HEADING_CHARS = 200             # Longer lines are prose that happens to start with "Item"
+ITEM_RE = re.compile(r'^ITEM\s*(\d{1,2}[A-Z]?)\b(?!\.\d)\.?\s*(.*)$', re.IGNORECASE)
+PART_RE = re.compile(r'^PART\s+(I{1,3}|IV)\b\.?\s*(.*)$', re.IGNORECASE)
+TOC_ROW_RE = re.compile(r'\s{2,}\d{1,3}$')  # Table-of-contents rows end in a page number
+PARTS = {'I': 1, 'II': 2, 'III': 3, 'IV': 4}
+# Standard 10-K item titles, so "MD&A" or "risk factors" can name an item
+ITEM_TITLES = {
+    '1': 'Business', '1A': 'Risk Factors', '1B': 'Unresolved Staff Comments', '1C': 'Cybersecurity',
+    '2': 'Properties', '3': 'Legal Proceedings', '4': 'Mine Safety Disclosures',
+    '5': "Market for Registrant's Common Equity", '6': 'Selected Financial Data',
+    '7': "Management's Discussion and Analysis", '7A': 'Quantitative and Qualitative Disclosures About Market Risk',
+    '8': 'Financial Statements and Supplementary Data', '9': 'Changes in and Disagreements with Accountants',
+    '9A': 'Controls and Procedures', '9B': 'Other Information',
+    '10': 'Directors, Executive Officers and Corporate Governance', '11': 'Executive Compensation',
+    '12': 'Security Ownership', '13': 'Certain Relationships and Related Transactions',
+    '14': 'Principal Accountant Fees and Services', '15': 'Exhibits, Financial Statement Schedules',
+    '16': 'Form 10-K Summary',
+}
+ITEM_ALIASES = {'md&a': '7', 'mda': '7', 'risk factors': '1A', 'market risk': '7A', 'financial statements': '8',
+                'legal proceedings': '3', 'properties': '2', 'business': '1', 'controls and procedures': '9A',
+                'executive compensation': '11', 'exhibits': '15', 'cybersecurity': '1C'}
+# Item names a request can use instead of a number: the standard titles and the aliases above
+ITEM_NAMES = dict({title.lower().replace("'", ''): key for key, title in ITEM_TITLES.items()}, **ITEM_ALIASES)
+# A section request must open with a request verb, so "Item 7 changes in revenue?" stays a question
+REQUEST_RE = re.compile(r'^\s*(?:show|give|get|open|read|print|display)(?:\s+me)?\s+(?:the\s+)?'
+                        r'(?:item\s*(\d{1,2}[A-Z]?)\b|(' +
+                        '|'.join(re.escape(name) for name in sorted(ITEM_NAMES, key=len, reverse=True)) +
+                        r')(?![\w&]))', re.IGNORECASE)
+# Words that may follow the item in a request without making it a question
+REQUEST_FILLER = {'item', 'section', 'part', 'for', 'of', 'from', 'in', 'the', 'fy', 'fiscal', 'year', '10', 'k',
+                  'filing', 'please'}
+
+# ----------------- ITEMS -----------------
+
+def item_key(text):
+    """Canonical item key: 'Item 1a.' / '1A' / 'MD&A' / 'risk factors' -> '1A', '7', ...; None if unrecognised."""
+    if text is None:
+        return None
+    text = str(text).strip()
+    m = re.match(r'^(?:ITEM\s*)?(\d{1,2}[A-Z]?)\b\.?', text, re.IGNORECASE)
+    if m:
+        return m.group(1).upper()
+    lowered = text.lower()
+    for alias, key in ITEM_ALIASES.items():
+        if alias in lowered:
+            return key
+    return None
+
+def item_order(key):
+    m = re.match(r'(\d+)([A-Z]?)', key)
+    return int(m.group(1)), m.group(2)
+
+def part_of(key):
+    """PART an item belongs to; fixed by the Form 10-K layout."""
+    n = item_order(key)[0]
+    return 'I' if n <= 4 else 'II' if n <= 9 else 'III' if n <= 14 else 'IV'
+
+# ----------------- BUILD -----------------
+
+def _marks(lines):
+    """(byte offset, 'item'/'part', key, title) for every line that looks like a PART or ITEM heading."""
+    marks, offset = [], 0
+    for line in lines:
+        stripped = line.strip()
+        if stripped and len(stripped) <= MAX_HEADING_CHARS and not TOC_ROW_RE.search(stripped):
+            m = ITEM_RE.match(stripped)
+            if m:
+                marks.append((offset, 'item', m.group(1).upper(), m.group(2).strip()))
+            else:
+                m = PART_RE.match(stripped)
+                if m:
+                    marks.append((offset, 'part', m.group(1).upper(), m.group(2).strip()))
+        offset += len(line.encode('utf-8')) + 1
+    return marks, max(offset - 1, 0)
+
+def section_spans(lines):
+    """
+    Byte ranges of each ITEM in the processed text given as its lines:
+    [{'item', 'part', 'title', 'start', 'end'}] in document order. Item and
+    part numbers only move forward within one pass through the filing, so a
+    step back (the body after the table of contents, a stray heading) starts
+    a new run; the run covering the most text is the body. Repeated running
+    headers ("PART I" / "Item 1" on every page) don't start a section, and a
+    PART heading ends the last item of the previous part.
+    """
+    marks, size = _marks(lines)
+    runs, sections = [], []
+    item = part = None
+    for offset, kind, key, title in marks:
+        backwards = (kind == 'item' and item is not None and item_order(key) < item_order(item)) or \
+                    (kind == 'part' and part is not None and PARTS[key] < PARTS[part])
+        if backwards:
+            if sections and sections[-1]['end'] is None:
+                sections[-1]['end'] = offset
+            runs.append(sections)
+            sections, item, part = [], None, None
+        if kind == 'part':
+            if sections and sections[-1]['end'] is None and key != part_of(sections[-1]['item']):
+                sections[-1]['end'] = offset
+            part = key
+        elif key != item:
+            if sections and sections[-1]['end'] is None:
+                sections[-1]['end'] = offset
+            sections.append({'item': key, 'part': part_of(key), 'title': title or ITEM_TITLES.get(key),
+                             'start': offset, 'end': None})
+            item = key
+    if sections and sections[-1]['end'] is None:
+        sections[-1]['end'] = size
+    runs.append(sections)
+    return max(runs, key=lambda run: sum(s['end'] - s['start'] for s in run))
+
+def sections_path(text_path):
+    return os.path.splitext(text_path)[0] + SECTIONS_SUFFIX
+
+def write_sections(text_path, lines):
+    """Index the ITEM byte ranges of a processed text file (its lines as written) into the sidecar."""
+    sections = section_spans(lines)
+    info = {'size': os.path.getsize(text_path), 'sections': sections}
+    tmp = sections_path(text_path) + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(info, f, indent=2)
+    os.replace(tmp, sections_path(text_path))
+    count('sections.indexed', len(sections))
+    return sections
+
+def load_sections(text_path):
+    """Section ranges of a processed text file; re-indexed from the text if the sidecar is missing or stale."""
+    path = sections_path(text_path)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            info = json.load(f)
+        if info.get('size') == os.path.getsize(text_path):
+            return info['sections']
+    with open(text_path, encoding='utf-8') as f:
+        return write_sections(text_path, f.read().split('\n'))
+
+def section_at(sections, offset):
+    """{'item', 'part'} of the section containing a byte offset (both None outside every item)."""
+    if offset is not None:
+        i = bisect.bisect_right([s['start'] for s in sections], offset) - 1
+        if i >= 0 and offset < sections[i]['end']:
+            return {'item': sections[i]['item'], 'part': sections[i]['part']}
+    return {'item': None, 'part': None}
+
+def build_missing(text_dir=TEXT_DIR, force=False):
+    """Index processed text that was parsed before section indexing existed (or everything with `force`)."""
+    done = 0
+    for company in sorted(os.listdir(text_dir)):
+        folder = os.path.join(text_dir, company)
+        if not os.path.isdir(folder):
+            continue
+        for fname in sorted(f for f in os.listdir(folder) if f.endswith('.txt')):
+            text_path = os.path.join(folder, fname)
+            if force and os.path.exists(sections_path(text_path)):
+                os.remove(sections_path(text_path))
+            sections = load_sections(text_path)
+            print(f"{text_path}: {' '.join(s['item'] for s in sections)}")
+            done += 1
+    return done
+
+# ----------------- READ -----------------
+
+def find_text(company, year=None, accession=None, text_dir=TEXT_DIR, catalog=None):
+    """Processed text path of a filing by accession, or by fiscal year (latest filing if None) via the catalog."""
+    if accession is None:
+        catalog = load_catalog() if catalog is None else catalog
+        filings = sorted((rec.get('fiscal_year') or '', rec['accession']) for rec in catalog.values()
+                         if rec['ticker'].upper() == company.upper() and (year is None or str(rec.get('fiscal_year')) == str(year)))
+        if not filings:
+            return None
+        accession = filings[-1][1]
+    path = os.path.join(text_dir, company.upper(), accession + '.txt')
+    return path if os.path.exists(path) else None
+
+def read_section(text_path, item):
+    """
+    (section, text) of one ITEM of a processed filing, or None if the filing
+    has no such item. Only the section's bytes are read, through mmap.
+    """
+    key = item_key(item)
+    for section in load_sections(text_path):
+        if section['item'] == key:
+            with span('section_read', file=text_path, item=key, bytes=section['end'] - section['start']):
+                with open(text_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    text = mm[section['start']:section['end']].decode('utf-8', errors='replace')
+            count('sections.reads')
+            return section, text.strip()
+    return None
+
+def get_section(company, item, year=None, accession=None, text_dir=TEXT_DIR):
+    """read_section for a company's filing named by fiscal year or accession."""
+    text_path = find_text(company, year, accession, text_dir)
+    return read_section(text_path, item) if text_path else None
+
+def parse_section_request(text, companies=()):
+    """
+    {'item', 'company', 'year'} for a direct section request such as
+    "show me Item 7 MD&A for TSLA 2022" or "open risk factors for MSFT"; None
+    for an ordinary question, including one that mentions an item ("Item 7
+    changes in revenue for AAPL?", "show me item 7 revenue drivers"). Company
+    and year are None when not mentioned.
+    """
+    text = text.replace("'", '').replace('\u2019', '')  # "Management's" / "Managements"
+    m = REQUEST_RE.match(text)
+    if not m:
+        return None
+    key = m.group(1).upper() if m.group(1) else ITEM_NAMES[m.group(2).lower()]
+    rest = text[m.end():]
+    company = next((c for c in companies if re.search(rf'\b{re.escape(c)}\b', rest, re.IGNORECASE)), None)
+    year = re.search(r'(?<!\d)(?:19|20)\d{2}(?!\d)', rest)  # Also inside "FY2022"
+    # Anything beyond the item's own name, the company, the year and filler words is a question about it
+    names = ' '.join([ITEM_TITLES.get(key, '')] + [alias for alias, k in ITEM_ALIASES.items() if k == key]).lower()
+    allowed = REQUEST_FILLER | set(re.findall(r"[a-z0-9&]+", names.replace("'", ''))) | {key.lower()}
+    for word in re.findall(r"[a-z0-9&]+", rest.lower()):
+        word = re.sub(r'^fy(?=\d)', '', word)
+        if word not in allowed and (not company or word != company.lower()) and not (year and word == year.group(0)):
+            return None
+    return {'item': key, 'company': company, 'year': int(year.group(0)) if year else None}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Index PART/ITEM byte ranges of processed filings, or print one section.")
+    parser.add_argument('--text_dir', type=str, default=TEXT_DIR)
+    parser.add_argument('--build', action='store_true', help="Index every processed filing that has no section index yet")
+    parser.add_argument('--force', action='store_true', help="With --build, re-index every filing")
+    parser.add_argument('--company', type=str, help="Ticker of the filing to read from")
+    parser.add_argument('--year', type=int, default=None, help="Fiscal year (default: latest filing)")
+    parser.add_argument('--accession', type=str, default=None)
+    parser.add_argument('--item', type=str, help="Item to print, e.g. 7, 1A, 'MD&A'")
+    args = parser.parse_args()
+
+    if args.build:
+        print(f"Indexed {build_missing(args.text_dir, force=args.force)} filings.")
+    elif args.company and args.item:
+        found = get_section(args.company, args.item, args.year, args.accession, args.text_dir)
+        if found is None:
+            print(f"No Item {item_key(args.item)} found for {args.company.upper()} {args.year or '(latest)'}.")
+        else:
+            section, text = found
+            print(f"Item {section['item']}. {section['title']} (Part {section['part']}, "
+                  f"bytes {section['start']}-{section['end']})\n")
+            print(text)
+    else:
+        print("Pass --build, or --company and --item.")
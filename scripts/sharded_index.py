@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from index_store import MANIFEST, MemmapFlatIndex, _topk_merge, _write_manifest, search_subset, write_memmap_index
+from qa_token_cache import load_token_cache, build_token_cache
+from tracing import span
+
+# ----------------- CONFIGURATION -----------------
+SHARDED_INDEX_DIR = "index_shards"
+SHARD_KEYS = ('company', 'year')  # Metadata fields that name a shard, e.g. AAPL_2021
+SEARCH_WORKERS = min(8, os.cpu_count() or 4)
+CHUNKS_DIR = "data/chunks/10k_chunks"
+QA_MODEL = 'distilbert-base-cased-distilled-squad'
+
+def shard_name(meta, keys=SHARD_KEYS):
+    return '_'.join(str(meta.get(k) or 'unknown') for k in keys)
+
+def matches(shard, where):
+    """True if a shard's manifest entry satisfies a {'company': ..., 'years': (start, end)} filter."""
+    if not where:
+        return True
+    company = where.get('company')
+    if company and 'company' in shard and str(shard['company']).lower() != company.lower():
+        return False
+    years = where.get('years')
+    if years and shard.get('year'):
+        start, end = years
+        year = int(shard['year'])
+        if (start is not None and year < int(start)) or (end is not None and year > int(end)):
+            return False
+    return True
+
+# ----------------- BUILD -----------------
+
+def write_shard(out_dir, name, embeddings, metadata, keys=SHARD_KEYS, with_token_cache=True):
+    """
+    (Re)build one shard in a new versioned directory and point the manifest at
+    it. Other shards are untouched; the old version is deleted after the swap.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    version = str(time.time_ns())
+    shard_dir = f"{name}.{version}"
+    path = os.path.join(out_dir, shard_dir)
+    with span('shard_build', shard=name, items=len(metadata)):
+        write_memmap_index(embeddings, path)
+        with open(os.path.join(path, 'metadata.jsonl'), 'w', encoding='utf-8') as f:
+            for meta in metadata:
+                f.write(json.dumps(meta) + '\n')
+        if with_token_cache:
+            build_token_cache((m['text'] for m in metadata), QA_MODEL, os.path.join(path, 'qa_token_cache'))
+
+    manifest = read_manifest(out_dir) or {'dim': int(embeddings.shape[1]), 'keys': list(keys), 'shards': []}
+    entry = {'name': name, 'dir': shard_dir, 'version': version, 'rows': int(len(metadata))}
+    entry.update({k: metadata[0].get(k) for k in keys} if metadata else {})
+    old = [s for s in manifest['shards'] if s['name'] == name]
+    manifest['shards'] = sorted([s for s in manifest['shards'] if s['name'] != name] + [entry],
+                                key=lambda s: s['name'])
+    _write_manifest(out_dir, manifest)
+    for s in old:
+        # Readers that still have the old files mapped keep working until they reload
+        shutil.rmtree(os.path.join(out_dir, s['dir']), ignore_errors=True)
+    return entry
+
+def remove_shard(out_dir, name):
+    manifest = read_manifest(out_dir)
+    old = [s for s in manifest['shards'] if s['name'] == name]
+    manifest['shards'] = [s for s in manifest['shards'] if s['name'] != name]
+    _write_manifest(out_dir, manifest)
+    for s in old:
+        shutil.rmtree(os.path.join(out_dir, s['dir']), ignore_errors=True)
+
+def read_manifest(index_dir):
+    path = os.path.join(index_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def manifest_stamp(index_dir):
+    """Identity of the current manifest file; it changes whenever the manifest is swapped."""
+    try:
+        st = os.stat(os.path.join(index_dir, MANIFEST))
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+def group_chunks(chunks_dir=CHUNKS_DIR, keys=SHARD_KEYS):
+    """{shard name: (texts, metadata)} over every chunk file."""
+    from embed_chunks import load_chunks
+    groups = {}
+    texts, metadata = load_chunks(chunks_dir)
+    for text, meta in zip(texts, metadata):
+        t, m = groups.setdefault(shard_name(meta, keys), ([], []))
+        t.append(text)
+        m.append(meta)
+    return groups
+
+def build_sharded_index(out_dir=SHARDED_INDEX_DIR, chunks_dir=CHUNKS_DIR, only=None, keys=SHARD_KEYS):
+    """Embed chunks and write one shard per company/year (or only the shards named in `only`)."""
+    from embed_chunks import load_embedder
+    groups = group_chunks(chunks_dir, keys)
+    model = load_embedder()
+    for name, (texts, metadata) in sorted(groups.items()):
+        if only and name not in only:
+            continue
+        with span('embed', shard=name, items=len(texts)):
+            embeddings = model.encode(texts, convert_to_numpy=True)
+        write_shard(out_dir, name, embeddings, metadata, keys)
+        print(f"Shard {name}: {len(texts)} chunks.")
+    if not only:
+        # Drop shards whose filings no longer exist
+        for shard in (read_manifest(out_dir) or {}).get('shards', []):
+            if shard['name'] not in groups:
+                remove_shard(out_dir, shard['name'])
+                print(f"Removed shard {shard['name']}.")
+
+# ----------------- SEARCH -----------------
+
+class _Shard:
+    def __init__(self, index_dir, entry):
+        path = os.path.join(index_dir, entry['dir'])
+        self.entry = entry
+        self.index = MemmapFlatIndex(path)
+        with open(os.path.join(path, 'metadata.jsonl'), encoding='utf-8') as f:
+            self.metadata = [json.loads(line) for line in f]
+        self.token_cache = load_token_cache(os.path.join(path, 'qa_token_cache'), QA_MODEL, self.index.ntotal)
+        self._year_ids = {}
+
+    def year_ids(self, years):
+        """Local ids of this shard's chunks in a fiscal-year range (for shards that hold several years)."""
+        if years not in self._year_ids:
+            from retrieval import in_years
+            self._year_ids[years] = np.asarray([i for i, m in enumerate(self.metadata) if in_years(m, years)],
+                                               dtype=np.int64)
+        return self._year_ids[years]
+
+class _Snapshot:
+    """An immutable view of the loaded shards; global id = shard offset + local id."""
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.offsets = np.cumsum([0] + [s.index.ntotal for s in shards])[:-1].astype(np.int64)
+        self.ntotal = int(sum(s.index.ntotal for s in shards))
+        self.metadata = [m for s in shards for m in s.metadata]
+
+    def shard_of(self, ids):
+        return np.searchsorted(self.offsets, ids, side='right') - 1
+
+class ShardedTokenCache:
+    """QA token cache lookup by global id, dispatched to each shard's own cache."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.info = {'tokenizer': QA_MODEL, 'count': snapshot.ntotal}
+
+    def __len__(self):
+        return self.snapshot.ntotal
+
+    def get(self, chunk_id):
+        s = int(self.snapshot.shard_of(np.asarray([chunk_id]))[0])
+        return self.snapshot.shards[s].token_cache.get(chunk_id - int(self.snapshot.offsets[s]))
+
+class ShardedIndex:
+    """
+    Flat indexes per company/year behind one search()/reconstruct interface.
+    Queries fan out to the matching shards on a thread pool (the scoring
+    matmuls release the GIL) and the per-shard top-k lists are merged.
+    reload() re-reads the manifest and reopens only shards whose version changed;
+    changed() tells whether the manifest has been swapped since.
+    """
+
+    supports_where = True  # search() can skip shards up front (see QAEngine.search_batch)
+    supports_subset = True
+
+    def __init__(self, index_dir=SHARDED_INDEX_DIR, workers=SEARCH_WORKERS):
+        self.index_dir = index_dir
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._snap = _Snapshot([])
+        self._stamp = None
+        self.d = None
+        self.reload()
+
+    def reload(self):
+        """Pick up rebuilt/added/removed shards. Returns the names of shards (re)opened."""
+        with self._lock:
+            self._stamp = manifest_stamp(self.index_dir)  # Taken first: a swap during the read shows up next time
+            manifest = read_manifest(self.index_dir)
+            self.d = manifest['dim']
+            current = {s.entry['name']: s for s in self._snap.shards}
+            shards, opened = [], []
+            for entry in manifest['shards']:
+                shard = current.get(entry['name'])
+                if shard is None or shard.entry['version'] != entry['version']:
+                    shard = _Shard(self.index_dir, entry)
+                    opened.append(entry['name'])
+                shards.append(shard)
+            self._snap = _Snapshot(shards)  # Swapped in one assignment; running searches keep the old one
+        return opened
+
+    def changed(self):
+        return manifest_stamp(self.index_dir) != self._stamp
+
+    @property
+    def ntotal(self):
+        return self._snap.ntotal
+
+    @property
+    def metadata(self):
+        return self._snap.metadata
+
+    def shards(self):
+        return [s.entry for s in self._snap.shards]
+
+    def token_cache(self):
+        snap = self._snap
+        if snap.shards and all(s.token_cache is not None for s in snap.shards):
+            return ShardedTokenCache(snap)
+        return None
+
+    def reconstruct(self, i):
+        return self.reconstruct_batch([i])[0]
+
+    def reconstruct_batch(self, ids):
+        snap = self._snap
+        ids = np.asarray(ids, dtype=np.int64)
+        out = np.empty((len(ids), self.d), dtype=np.float32)
+        owners = snap.shard_of(ids)
+        for s in np.unique(owners):
+            rows = np.flatnonzero(owners == s)
+            out[rows] = snap.shards[s].index.reconstruct_batch(ids[rows] - snap.offsets[s])
+        return out
+
+    def search(self, q, k, subset=None, where=None):
+        """
+        (D, I) like faiss over global ids. `where` is one filter dict for all
+        queries or a list with one per query (None = all shards); only
+        matching shards are searched.
+        """
+        snap = self._snap
+        q = np.ascontiguousarray(q, dtype=np.float32).reshape(-1, self.d)
+        wheres = where if isinstance(where, (list, tuple)) else [where] * len(q)
+        D = np.full((len(q), k), np.inf, dtype=np.float32)
+        I = np.full((len(q), k), -1, dtype=np.int64)
+        subset = None if subset is None else np.unique(np.asarray(subset, dtype=np.int64))
+
+        def search_shard(s):
+            shard = snap.shards[s]
+            rows = [i for i, w in enumerate(wheres) if matches(shard.entry, w)]
+            if not rows or not shard.index.ntotal:
+                return rows, None, None
+            offset, n = int(snap.offsets[s]), shard.index.ntotal
+            local = None
+            if subset is not None:
+                local = subset[(subset >= offset) & (subset < offset + n)] - offset
+                if not len(local):
+                    return rows, None, None
+            # A shard without a year (--by company) holds every year: a year range becomes an id subset in it
+            groups = {}
+            for pos, r in enumerate(rows):
+                years = (wheres[r] or {}).get('years') if not shard.entry.get('year') else None
+                groups.setdefault(tuple(years) if years else None, []).append(pos)
+            d = np.full((len(rows), k), np.inf, dtype=np.float32)
+            i = np.full((len(rows), k), -1, dtype=np.int64)
+            with span('shard_search', shard=shard.entry['name'], items=len(rows)):
+                for years, positions in groups.items():
+                    ids = local
+                    if years:
+                        ids = shard.year_ids(years) if local is None else np.intersect1d(shard.year_ids(years), local)
+                        if not len(ids):
+                            continue
+                    queries = q[[rows[p] for p in positions]]
+                    if ids is None:
+                        d[positions], i[positions] = shard.index.search(queries, k)
+                    else:
+                        d[positions], i[positions] = search_subset(shard.index, queries, k, ids)
+            return rows, d, np.where(i >= 0, i + offset, -1)
+
+        for rows, d, i in self.pool.map(search_shard, range(len(snap.shards))):
+            if d is not None:
+                D[rows], I[rows] = _topk_merge(D[rows], I[rows], d, i, k)
+        return D, I
+
+def is_sharded(path):
+    manifest = read_manifest(path) if os.path.isdir(path) else None
+    return bool(manifest) and 'shards' in manifest and all('dir' in s for s in manifest['shards'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or rebuild a company/year-sharded search index.")
+    parser.add_argument('--out_dir', type=str, default=SHARDED_INDEX_DIR)
+    parser.add_argument('--chunks_dir', type=str, default=CHUNKS_DIR)
+    parser.add_argument('--shards', nargs='*', help="Rebuild only these shards (e.g. AAPL_2021)")
+    parser.add_argument('--by', nargs='+', default=list(SHARD_KEYS), choices=['company', 'year'],
+                        help="Metadata fields that define a shard")
+    parser.add_argument('--list', action='store_true', help="Print the manifest's shards and exit")
+    args = parser.parse_args()
+    if args.list:
+        for shard in (read_manifest(args.out_dir) or {}).get('shards', []):
+            print(f"{shard['name']:<20} rows={shard['rows']:<7} version={shard['version']}")
+    else:
+        build_sharded_index(args.out_dir, args.chunks_dir, only=set(args.shards or []), keys=tuple(args.by))
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import uuid
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# ----------------- CONFIGURATION -----------------
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# JSON-lines trace file, under the repo root wherever a script is run from; set FDI_TRACE_FILE="" to turn file output off
+TRACE_FILE = os.environ.get('FDI_TRACE_FILE', os.path.join(REPO_ROOT, 'traces', 'trace.jsonl'))
+METRICS_PORT = int(os.environ.get('FDI_METRICS_PORT', '0'))  # 0 = no metrics endpoint
+# Prometheus histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+RECENT = 500  # Durations kept per stage for the live latency panel
+
+_lock = threading.Lock()
+_local = threading.local()
+_trace_fh = None
+
+class _Stats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.recent = deque(maxlen=RECENT)
+
+_spans = defaultdict(_Stats)
+_counters = defaultdict(float)
+
+# ----------------- RECORDING -----------------
+
+def _write(record):
+    global _trace_fh
+    if not TRACE_FILE:
+        return
+    line = json.dumps(record, default=str)
+    with _lock:
+        if _trace_fh is None:
+            os.makedirs(os.path.dirname(TRACE_FILE) or '.', exist_ok=True)
+            _trace_fh = open(TRACE_FILE, 'a', encoding='utf-8', buffering=1)
+        _trace_fh.write(line + '\n')
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Time a pipeline stage. Yields a dict: add counts (items, bytes, ...) to it
+    while the stage runs. Nested spans share a trace id and link to their parent.
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1] if stack else None
+    record = {
+        'name': name,
+        'trace_id': parent['trace_id'] if parent else uuid.uuid4().hex[:16],
+        'span_id': uuid.uuid4().hex[:16],
+        'parent_id': parent['span_id'] if parent else None,
+        'start': time.time(),
+    }
+    fields = dict(attrs)
+    stack.append(record)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield fields
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stack.pop()
+        with _lock:
+            stats = _spans[name]
+            stats.count += 1
+            stats.total += duration
+            stats.recent.append(duration)
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    stats.buckets[i] += 1
+            if error:
+                stats.errors += 1
+            for key in ('items', 'bytes'):
+                if isinstance(fields.get(key), (int, float)):
+                    _counters[f"{name}.{key}"] += fields[key]
+        record.update(duration_ms=round(duration * 1000, 3), error=error, attrs=fields)
+        _write(record)
+
+def count(name, value=1):
+    """Increment a counter (cache hits, fallbacks, retries, ...)."""
+    with _lock:
+        _counters[name] += value
+
+# ----------------- READING -----------------
+
+def latency_summary():
+    """{span name: {count, errors, p50_ms, p95_ms, mean_ms}} over recent calls, for dashboards."""
+    out = {}
+    with _lock:
+        items = [(name, s.count, s.errors, s.total, sorted(s.recent)) for name, s in _spans.items()]
+    for name, n, errors, total, recent in items:
+        if not recent:
+            continue
+        pick = lambda q: recent[min(len(recent) - 1, int(q * len(recent)))] * 1000
+        out[name] = {'count': n, 'errors': errors, 'p50_ms': pick(0.5), 'p95_ms': pick(0.95),
+                     'mean_ms': 1000 * total / n}
+    return out
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+def _metric_name(name):
+    return 'fdi_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+def prometheus_text():
+    """Render span histograms and counters in the Prometheus text exposition format."""
+    lines = ['# HELP fdi_stage_duration_seconds Pipeline stage duration.',
+             '# TYPE fdi_stage_duration_seconds histogram']
+    with _lock:
+        spans = [(name, s.count, s.errors, s.total, list(s.buckets)) for name, s in sorted(_spans.items())]
+        counter_items = sorted(_counters.items())
+    for name, n, _, total, buckets in spans:
+        for bound, c in zip(BUCKETS, buckets):
+            lines.append(f'fdi_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {c}')
+        lines.append(f'fdi_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {n}')
+        lines.append(f'fdi_stage_duration_seconds_sum{{stage="{name}"}} {total}')
+        lines.append(f'fdi_stage_duration_seconds_count{{stage="{name}"}} {n}')
+    lines += ['# HELP fdi_stage_errors_total Stage calls that raised.', '# TYPE fdi_stage_errors_total counter']
+    for name, _, errors, _, _ in spans:
+        lines.append(f'fdi_stage_errors_total{{stage="{name}"}} {errors}')
+    for name, value in counter_items:
+        metric = _metric_name(name) + '_total'
+        lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+    return '\n'.join(lines) + '\n'
+
+def start_metrics_server(port=METRICS_PORT, host='0.0.0.0'):
+    """Serve prometheus_text() on http://host:port/metrics from a daemon thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return server
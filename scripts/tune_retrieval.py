@@ -0,0 +1,246 @@
+import os
+import atexit
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import itertools
+
+import numpy as np
+
+# benchmark_queries keeps Hugging Face offline and provides the stand-in models and scoring
+from benchmark_queries import QUESTIONS_PATH, build_tiny_engine, is_hit, is_correct, percentiles
+from retrieval import QAEngine, INDEX_PATH, META_PATH
+from retrieval_profile import PROFILE, PROFILE_PATH, save_profile
+
+# ----------------- CONFIGURATION -----------------
+QUERY_GRID = {
+    'candidates': [10, 15, 20, 30, 40],
+    'top_k': [3, 5, 7],
+    'min_words': [0, 5, 10, 15],
+}
+NPROBE_GRID = [1, 2, 4, 8, 16, 32, 64]       # FAISS IVF lists probed (only if the index is IVF)
+N_SECTIONS_GRID = [4, 8, 16, 32, 64]         # Section centroids kept by two-stage search
+CHUNKING_GRID = {
+    'max_paragraph_len': [400, 800, 1200],
+    'min_chunk_words': [5, 8, 12],
+}
+TARGET_P95_MS = 250.0  # Latency budget per question (retrieval + QA in qa mode, retrieval in summarize mode)
+ROUNDS = 2             # Coordinate-descent passes over the grid
+REPEATS = 3            # Times the question set is replayed per configuration
+TEXT_DIR = 'data/processed/10k_text'
+
+# ----------------- EVALUATION -----------------
+
+def knob_owner(index, name):
+    """The index (or wrapped fine/base index) that has the search knob `name`, or None."""
+    while index is not None:
+        if hasattr(index, name):
+            return index
+        index = getattr(index, 'fine', None) or getattr(index, 'base', None)
+    return None
+
+def index_grid(index):
+    """Approximate-search knobs this index has, with the values worth trying."""
+    grid = {}
+    ivf = knob_owner(index, 'nprobe')
+    if ivf is not None:
+        grid['nprobe'] = [v for v in NPROBE_GRID if v <= getattr(ivf, 'nlist', max(NPROBE_GRID))]
+    if knob_owner(index, 'n_sections') is not None:
+        grid['n_sections'] = N_SECTIONS_GRID
+    return grid
+
+def answer_in_chunks(item, chunks):
+    """Label-free hit: some retrieved chunk contains an expected answer (used when chunk ids change)."""
+    return any(a.lower() in c['text'].lower() for c in chunks for a in item.get('answers', []))
+
+def evaluate(engine, questions, config, mode='qa', repeats=REPEATS, labelled=True):
+    """
+    Replay the questions with one configuration. Returns hit rate (labelled
+    chunk retrieved, or answer text retrieved if not `labelled`), answer match
+    rate (qa mode) and latency percentiles in ms.
+    """
+    for name in ('nprobe', 'n_sections'):
+        owner = knob_owner(engine.index, name)
+        if name in config and owner is not None:
+            setattr(owner, name, config[name])
+    search_kw = {k: config[k] for k in QUERY_GRID}
+    totals, hits, correct = [], 0, 0
+    for rep in range(repeats):
+        for item in questions:
+            start = time.perf_counter()
+            chunks = engine.search(item['question'], company=item.get('company'), diversify=True, **search_kw)
+            best = None
+            if mode == 'qa' and chunks:
+                best = engine.answer_batch([item['question']], [chunks])[0][0]
+            totals.append(time.perf_counter() - start)
+            if rep == 0:
+                hits += is_hit(item, chunks) if labelled else answer_in_chunks(item, chunks)
+                correct += is_correct(item, best)
+    p = percentiles(totals)
+    return {'hit_rate': hits / len(questions), 'answer_match_rate': correct / len(questions) if mode == 'qa' else None,
+            'p50_ms': p['p50'], 'p95_ms': p['p95']}
+
+def score(metrics, mode, target_p95_ms):
+    """
+    Sort key: configurations within the latency budget beat those over it;
+    within budget, answer matches (qa) or hits (summarize) first, then the
+    other rate. Over budget, lower p95 wins. Latency is not a tie-breaker
+    within budget (it is noisy), so ties keep the configuration found first.
+    """
+    if metrics['p95_ms'] > target_p95_ms:
+        return (0, -metrics['p95_ms'])
+    quality = [metrics['answer_match_rate'] or 0.0, metrics['hit_rate']]
+    if mode != 'qa':
+        quality.reverse()
+    return (1, *quality)
+
+def tune_query(engine, questions, start, grid, mode, target_p95_ms, rounds=ROUNDS, repeats=REPEATS):
+    """Coordinate descent from `start`: vary one parameter at a time, keep any improvement."""
+    seen = {}
+
+    def run(config):
+        key = tuple(sorted(config.items()))
+        if key not in seen:
+            seen[key] = evaluate(engine, questions, config, mode, repeats)
+            m = seen[key]
+            print(f"  {_fmt(config):<60} hit={m['hit_rate']:.2f} "
+                  f"match={'-' if m['answer_match_rate'] is None else format(m['answer_match_rate'], '.2f')} "
+                  f"p95={m['p95_ms']:.1f}ms")
+        return seen[key]
+
+    best = dict(start)
+    best_m = run(best)
+    for _ in range(rounds):
+        improved = False
+        for name, values in grid.items():
+            for value in values:
+                config = dict(best, **{name: value})
+                m = run(config)
+                if score(m, mode, target_p95_ms) > score(best_m, mode, target_p95_ms):
+                    best, best_m, improved = config, m, True
+        if not improved:
+            break
+    return best, best_m, len(seen)
+
+# ----------------- CHUNKING SWEEP -----------------
+
+def rechunked_engine(engine, chunking, work_dir, text_dir=TEXT_DIR):
+    """Re-chunk and re-embed every filing with one chunking setting into work_dir; same models as `engine`."""
+    from chunk_10k_sections import chunk_file
+    from embed_chunks import load_chunks
+    from filing_catalog import load_catalog, resolve
+    from index_store import MemmapFlatIndex, write_memmap_index
+    catalog = load_catalog()
+    chunks_dir = os.path.join(work_dir, 'chunks')
+    for company in sorted(os.listdir(text_dir)):
+        folder = os.path.join(text_dir, company)
+        if not os.path.isdir(folder):
+            continue
+        for fname in sorted(f for f in os.listdir(folder) if f.endswith('.txt')):
+            text_path = os.path.join(folder, fname)
+            filing = resolve(company, os.path.splitext(fname)[0], text_path, catalog)
+            chunk_file(text_path, os.path.join(chunks_dir, company, fname.replace('.txt', '_fine_chunks.json')),
+                       company=company, filing=filing, **chunking)
+    texts, metadata = load_chunks(chunks_dir, chunking['min_chunk_words'])
+    write_memmap_index(np.asarray(engine.embedder.encode(texts), dtype=np.float32), os.path.join(work_dir, 'index'))
+    return QAEngine(MemmapFlatIndex(os.path.join(work_dir, 'index')), metadata, engine.embedder, engine.qa)
+
+def tune_chunking(engine, questions, query_config, mode, target_p95_ms, repeats=REPEATS):
+    """
+    Try each paragraph size x word cutoff with the tuned query settings.
+    Chunk ids change between settings, so hits are judged by whether the
+    retrieved text contains an expected answer rather than by label.
+    """
+    best, best_m = None, None
+    settings = [dict(zip(CHUNKING_GRID, values)) for values in itertools.product(*CHUNKING_GRID.values())]
+    current = dict(PROFILE['chunking'])
+    for chunking in [current] + [c for c in settings if c != current]:  # Current setting first: it wins ties
+        work_dir = tempfile.mkdtemp(prefix='tune_chunks_')
+        try:
+            m = evaluate(rechunked_engine(engine, chunking, work_dir), questions, query_config, mode, repeats,
+                         labelled=False)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        print(f"  {_fmt(chunking):<60} hit={m['hit_rate']:.2f} "
+              f"match={'-' if m['answer_match_rate'] is None else format(m['answer_match_rate'], '.2f')} "
+              f"p95={m['p95_ms']:.1f}ms")
+        if best is None or score(m, mode, target_p95_ms) > score(best_m, mode, target_p95_ms):
+            best, best_m = chunking, m
+    return best, best_m
+
+def _fmt(config):
+    return ' '.join(f"{k}={v}" for k, v in config.items())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tune retrieval parameters on a labelled question set under a p95 latency budget.")
+    parser.add_argument('--questions', type=str, default=QUESTIONS_PATH)
+    parser.add_argument('--mode', choices=['qa', 'summarize'], default='qa',
+                        help="qa: extractive answers (app, qa-answer, server); summarize: retrieve_and_answer.py")
+    parser.add_argument('--target_p95_ms', type=float, default=TARGET_P95_MS)
+    parser.add_argument('--repeats', type=int, default=REPEATS, help="Times the question set is replayed per configuration")
+    parser.add_argument('--rounds', type=int, default=ROUNDS)
+    parser.add_argument('--chunking', action='store_true',
+                        help="Also sweep paragraph size and word cutoff (re-chunks and re-embeds every filing per setting)")
+    parser.add_argument('--two_stage', nargs='?', const='index_coarse', default=None, metavar='COARSE_DIR',
+                        help="Tune n_sections of the coarse-to-fine search built by coarse_index.py")
+    parser.add_argument('--tiny', action='store_true', help="Use hashing/overlap stand-in models (no downloads)")
+    parser.add_argument('--out', type=str, default=None,
+                        help=f"Profile to write (default {PROFILE_PATH}; --tiny only writes when given)")
+    args = parser.parse_args()
+
+    with open(args.questions, encoding='utf-8') as f:
+        questions = json.load(f)
+    if args.tiny:
+        engine = build_tiny_engine()
+        if args.two_stage:
+            # Stand-in centroids go to a temp dir, never over the real coarse index
+            from coarse_index import TwoStageIndex, build_coarse_index
+            coarse_dir = tempfile.mkdtemp(prefix='tune_coarse_')
+            atexit.register(shutil.rmtree, coarse_dir, ignore_errors=True)
+            build_coarse_index(engine.index, engine.metadata, coarse_dir)
+            engine.index = TwoStageIndex(engine.index, coarse_dir)
+    else:
+        engine = QAEngine.load(INDEX_PATH, META_PATH, with_qa=args.mode == 'qa', coarse_dir=args.two_stage)
+    engine.search(questions[0]['question'])  # warm-up, not measured
+
+    # Start from the current profile so an already-tuned setup is the baseline to beat
+    grid = dict(QUERY_GRID, **index_grid(engine.index))
+    start = dict(PROFILE[args.mode])
+    for name in grid:
+        if name not in start:
+            owner = knob_owner(engine.index, name)
+            start[name] = PROFILE['index'].get(name) or getattr(owner, name)
+    print(f"Tuning {args.mode} over {len(questions)} questions, target p95 {args.target_p95_ms:.0f}ms "
+          f"({'tiny' if args.tiny else 'models'}); knobs: {', '.join(grid)}")
+    best, metrics, tried = tune_query(engine, questions, start, grid, args.mode, args.target_p95_ms,
+                                      args.rounds, args.repeats)
+    print(f"\nBest of {tried} configurations: {_fmt(best)}")
+
+    profile = json.loads(json.dumps(PROFILE))
+    profile[args.mode] = {k: best[k] for k in QUERY_GRID}
+    for name in ('nprobe', 'n_sections'):
+        if name in best:
+            profile['index'][name] = best[name]
+    if args.chunking:
+        print("\nChunking sweep (re-chunk + re-embed per setting):")
+        chunking, chunk_metrics = tune_chunking(engine, questions, best, args.mode, args.target_p95_ms, args.repeats)
+        print(f"Best chunking: {_fmt(chunking)}; re-run pipeline.py to re-chunk and re-embed with it.")
+        profile['chunking'] = chunking
+    profile.setdefault('tuning', {})[args.mode] = {
+        'target_p95_ms': args.target_p95_ms,
+        'questions': len(questions),
+        'models': 'tiny' if args.tiny else 'default',
+        'metrics': metrics,
+        'within_target': metrics['p95_ms'] <= args.target_p95_ms,
+        'tuned_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    if not metrics['p95_ms'] <= args.target_p95_ms:
+        print(f"No configuration met the {args.target_p95_ms:.0f}ms target; kept the fastest one.")
+    out = args.out or (None if args.tiny else PROFILE_PATH)
+    if out:
+        save_profile(profile, out)
+        print(f"Profile written to {out}; loaded at startup by the app, CLIs and server.")
+    else:
+        print(json.dumps(profile, indent=2))